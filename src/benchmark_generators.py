@@ -0,0 +1,233 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import circular_informed_spiral
+import generate_spiral_inductor
+import generate_spiral_transformer
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, get_backend
+
+DEFAULT_NUM_TURNS = [1, 2, 4, 8, 16]
+DEFAULT_REPEATS = 3
+DEFAULT_THRESHOLD = 0.1
+# Smallest absolute growth per metric that can count as a regression, so
+# that timer and allocator noise on microsecond-scale cases is ignored
+DEFAULT_MIN_DELTAS = {
+    'time_s': 50e-6,
+    'peak_memory_bytes': 64 << 10,
+    'gds_bytes': 0,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark_cases(num_turns=DEFAULT_NUM_TURNS):
+    # (name, generator, params) of every benchmarked configuration
+    cases = []
+    for nt in num_turns:
+        for vectorized in (False, True):
+            cases.append((
+                f'octagon_spiral.nt{nt}' + ('.vectorized' if vectorized else ''),
+                circular_informed_spiral.generate_octagon_spiral,
+                dict(num_turns=nt, vectorized=vectorized),
+            ))
+        cases.append((
+            f'octagon_spiral.nt{nt}.vectorized.merged',
+            circular_informed_spiral.generate_octagon_spiral,
+            dict(num_turns=nt, vectorized=True, labels=False, merge=True),
+        ))
+        for merge in (False, True):
+            cases.append((
+                f'spiral_inductor.nt{nt}' + ('.merged' if merge else ''),
+                generate_spiral_inductor.generate_spiral_inductor,
+                dict(
+                    trace_width=generate_spiral_inductor.DEFAULT_TRACE_WIDTH,
+                    inner_radius=generate_spiral_inductor.DEFAULT_INNER_RADIUS,
+                    num_turns=nt,
+                    guard_ring_distance=generate_spiral_inductor.DEFAULT_GUARD_RING_DISTANCE,
+                    spacing=generate_spiral_inductor.DEFAULT_SPACING,
+                    merge=merge,
+                ),
+            ))
+        for add_entry_exit_traces, include_vias, merge in [
+            (False, False, False), (True, False, False), (True, True, False), (True, True, True)
+        ]:
+            # Vias are only placed on the entry/exit traces
+            name = f'spiral_transformer.nt{nt}'
+            name += '' if add_entry_exit_traces else '.noentryexit'
+            name += '' if include_vias else '.novias'
+            name += '.merged' if merge else ''
+            cases.append((
+                name,
+                generate_spiral_transformer.generate_spiral_transformer,
+                dict(
+                    trace_width=generate_spiral_transformer.DEFAULT_TRACE_WIDTH,
+                    inner_radius=generate_spiral_transformer.DEFAULT_INNER_RADIUS,
+                    num_turns=nt,
+                    guard_ring_distance=generate_spiral_transformer.DEFAULT_GUARD_RING_DISTANCE,
+                    spacing=generate_spiral_transformer.DEFAULT_SPACING,
+                    opposite_side_entry=True,
+                    add_entry_exit_traces=add_entry_exit_traces,
+                    include_vias=include_vias,
+                    merge=merge,
+                ),
+            ))
+    return cases
+
+
+def run_case(generator, params, repeats=DEFAULT_REPEATS, backend=DEFAULT_BACKEND):
+    """
+    Benchmark one generator configuration.
+
+    Returns a dictionary with the best and mean wall time over repeats, the
+    peak traced memory of a separate run, polygon and vertex counts per
+    layer of the flattened cell, and the time and bytes of writing the GDS.
+    backend is the layout backend the cells are built and written with.
+    """
+    layout = get_backend(backend)
+
+    def build():
+        lib = layout.new_library()
+        cell = layout.new_cell('benchmark')
+        start = time.perf_counter()
+        generator(cell, **params)
+        elapsed = time.perf_counter() - start
+        layout.add_cell(lib, cell, include_dependencies=True)
+        return lib, cell, elapsed
+
+    # Untimed warm-up run so first-call costs (lazy imports, config and
+    # shared cell loading) do not skew small cases
+    build()
+    times = [build()[2] for _ in range(repeats)]
+
+    # Peak memory is measured separately since tracing slows the run down
+    tracemalloc.start()
+    lib, cell, _ = build()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    polygons = layout.polygons_by_spec(cell)
+    per_layer = {
+        f'{layer}/{datatype}': {'polygons': len(points), 'vertices': sum(len(p) for p in points)}
+        for (layer, datatype), points in sorted(polygons.items())
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gds_file = os.path.join(tmp_dir, 'benchmark.gds')
+        start = time.perf_counter()
+        layout.write_gds(lib, gds_file)
+        write_time = time.perf_counter() - start
+        gds_bytes = os.path.getsize(gds_file)
+
+    return {
+        'time_s': min(times),
+        'mean_time_s': sum(times)/len(times),
+        'peak_memory_bytes': peak_memory,
+        'polygons': sum(layer['polygons'] for layer in per_layer.values()),
+        'vertices': sum(layer['vertices'] for layer in per_layer.values()),
+        'layers': per_layer,
+        'write_gds_s': write_time,
+        'gds_bytes': gds_bytes,
+    }
+
+
+def environment(backend=DEFAULT_BACKEND):
+    # Versions and commit the results were measured with
+    import numpy as np
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'backend': backend,
+        backend: get_backend(backend).lib.__version__,
+        'commit': commit,
+        'timestamp': time.time(),
+    }
+
+
+def run_benchmarks(num_turns=DEFAULT_NUM_TURNS, repeats=DEFAULT_REPEATS, name_filter=None, backend=DEFAULT_BACKEND):
+    results = {}
+    for name, generator, params in benchmark_cases(num_turns):
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = run_case(generator, params, repeats, backend)
+        result = results[name]
+        logger.info(
+            '%-45s %9.4fs %8.1f KiB %7d polygons %8d vertices %9d GDS bytes',
+            name, result['time_s'], result['peak_memory_bytes']/1024,
+            result['polygons'], result['vertices'], result['gds_bytes']
+        )
+    return {'environment': environment(backend), 'results': results}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, min_deltas=None):
+    """
+    Compare two benchmark runs case by case. A case regresses when its time,
+    peak memory or GDS size grew by more than threshold (relative) and by
+    more than its min_deltas entry (absolute, defaults to
+    DEFAULT_MIN_DELTAS).
+
+    Returns the list of (case, metric, baseline value, new value) regressions.
+    """
+    min_deltas = dict(DEFAULT_MIN_DELTAS, **(min_deltas or {}))
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        reference = baseline['results'][name]
+        for metric in ('time_s', 'peak_memory_bytes', 'gds_bytes'):
+            grew = result[metric] - reference[metric]
+            if reference[metric] > 0 and grew > reference[metric]*threshold and grew > min_deltas[metric]:
+                regressions.append((name, metric, reference[metric], result[metric]))
+        logger.info(
+            '%-45s time x%.2f  memory x%.2f  GDS bytes x%.2f', name,
+            *(result[metric]/reference[metric] if reference[metric] else float('nan')
+              for metric in ('time_s', 'peak_memory_bytes', 'gds_bytes'))
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the geometry generators across numbers of turns')
+    parser.add_argument('--num_turns', type=int, nargs='+', default=DEFAULT_NUM_TURNS, help='Numbers of turns to benchmark')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='Timed repetitions per case (the best is reported)')
+    parser.add_argument('--filter', type=str, default=None, help='Only run cases whose name contains this string')
+    parser.add_argument('--output', type=str, default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline results JSON to compare against')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Layout library to build and write the cells with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Relative growth that counts as a regression')
+    parser.add_argument('--min_time_delta', type=float, default=DEFAULT_MIN_DELTAS['time_s'], help='Smallest time growth in seconds that counts as a regression')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+    # Keep the generators' own debug traces out of the measurements
+    for module in (circular_informed_spiral, generate_spiral_inductor, generate_spiral_transformer):
+        logging.getLogger(module.__name__).setLevel(logging.INFO)
+
+    results = run_benchmarks(args.num_turns, args.repeats, args.filter, args.backend)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info('Results saved to %s', args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, {'time_s': args.min_time_delta})
+        for name, metric, before, after in regressions:
+            logger.warning('Regression in %s %s: %.6g -> %.6g', name, metric, before, after)
+        sys.exit(1 if regressions else 0)
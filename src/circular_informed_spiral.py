@@ -1,10 +1,17 @@
 import numpy as np
-import gdspy
+import math
 import argparse
-import json
-import os
+import logging
+import time
 from collections import deque
 
+from diagnostics import RunReport, add_verbosity_arguments, configure_logging_from_args, report_stage
+from layout_cache import add_cache_arguments, cache_from_args, write_outputs_cached
+from layout_backend import backend_of, get_backend
+from layout_io import add_output_arguments, show_layout
+
+logger = logging.getLogger(__name__)
+
 # Define the 8 directions for an octagon (0°, 45°, 90°, 135°, 180°, 225°, 270°, 315°)
 DIRECTIONS = deque([
     (-1, 0),   # 180° (left)
@@ -26,6 +33,149 @@ DEFAULT_SPACING = 7 # um
 DEFAULT_LAYER = 0
 DEFAULT_DATATYPE = 0
 DEFAULT_INITIAL_DIRECTION = DIRECTIONS[6]
+
+
+def _octagon_spiral_vertices(x, y, next_radii, step_directions):
+    """
+    Walk the spiral vertex recurrence: each vertex is where the line through
+    the previous vertex along the current step direction meets the next
+    bounding circle. The recurrence is inherently sequential, so it runs on
+    plain floats; everything downstream of it is vectorized. It evaluates
+    the same expressions as the loop in generate_octagon_spiral, squares
+    included (x**2 rounds differently from x*x in the last bit), so the
+    vertices and the step labels placed on them are bit-identical.
+
+    Returns the (len(next_radii)+1,) arrays of x and y vertex coordinates.
+    """
+    xs = np.empty(len(next_radii) + 1)
+    ys = np.empty(len(next_radii) + 1)
+    x, y = float(x), float(y)
+    xs[0], ys[0] = x, y
+    for idx, (next_radius, (dx, dy)) in enumerate(zip(next_radii.tolist(), step_directions)):
+        if dx == 0:
+            xnext = x
+            quad_c = xnext**2 - next_radius**2
+            root = math.sqrt(-4*quad_c)
+            yn1 = -root/2
+            yn2 = root/2
+            ynext = yn1 if abs(yn1 - y) > abs(yn2 - y) else yn2
+        else:
+            m = dy/dx
+            b = y - m*x
+            quad_a = (1+m**2)
+            quad_b = 2*m*b
+            quad_c = b**2 - next_radius**2
+            root = math.sqrt(quad_b**2 - 4*quad_a*quad_c)
+            xn1 = (-quad_b - root)/(2*quad_a)
+            xn2 = (-quad_b + root)/(2*quad_a)
+            xnext = xn1 if abs(xn1 - x) > abs(xn2 - x) else xn2
+            ynext = m*xnext + b
+        x, y = xnext, ynext
+        xs[idx + 1], ys[idx + 1] = x, y
+    return xs, ys
+
+
+def _add_octagon_spiral_vectorized(cell, x, y, steps, ordered_directions, trace_width, inner_radius, spacing, labels=True, merge=False, report=None):
+    """
+    Vectorized equivalent of the per-step loop in generate_octagon_spiral.
+    Vertices come from _octagon_spiral_vertices, then every trace-edge offset
+    and half-side polygon is computed as whole arrays and added in one batch.
+    """
+    start = time.perf_counter()
+
+    COS_PI_8 = np.cos(np.pi/8)
+    num_steps = len(steps)
+    next_radii = inner_radius + (steps + 1/8) * (spacing + trace_width)/COS_PI_8
+
+    # Per-direction lookup tables, indexed by step % 8
+    directions = np.array(ordered_directions)
+    direction_idx = np.arange(num_steps) % len(directions)
+    dx, dy = directions[direction_idx, 0], directions[direction_idx, 1]
+    pdx, pdy = np.roll(directions, 1, axis=0)[direction_idx].T
+    ndx, ndy = np.roll(directions, -1, axis=0)[direction_idx].T
+
+    straight = (dx == 0) | (dy == 0)
+    vertex_angle = np.where(
+        straight,
+        np.arctan2(pdy, pdx) + np.pi/2 + np.pi/8,
+        np.arctan2(dy, dx) + np.pi/2 - np.pi/8)
+    next_vertex_angle = np.where(
+        straight,
+        np.arctan2(ndy, ndx) + np.pi/2 - np.pi/8,
+        np.arctan2(dy, dx) + np.pi/2 + np.pi/8)
+
+    xs, ys = _octagon_spiral_vertices(x, y, next_radii, [tuple(d) for d in directions[direction_idx].tolist()])
+    x, xnext = xs[:-1], xs[1:]
+    y, ynext = ys[:-1], ys[1:]
+    xmid = (x+xnext)/2
+    ymid = (y+ynext)/2
+    if logger.isEnabledFor(logging.DEBUG):
+        for idx in range(num_steps):
+            logger.debug("step %d: dx: %d dy: %d", idx, dx[idx], dy[idx],
+                         extra={'trace': {'step': idx, 'x': x[idx], 'y': y[idx], 'dx': dx[idx], 'dy': dy[idx]}})
+
+    # Outer trace edge offsets at the start and end of each step
+    ox = trace_width*np.cos(vertex_angle)/COS_PI_8
+    oy = trace_width*np.sin(vertex_angle)/COS_PI_8
+    nox = trace_width*np.cos(next_vertex_angle)/COS_PI_8
+    noy = trace_width*np.sin(next_vertex_angle)/COS_PI_8
+
+    # Each step emits up to two quadrilaterals: the first and second half
+    # side of a straight step, or the single polygon of a diagonal step
+    first_half = np.stack([
+        np.where(dx == 0, a, np.where(dy == 0, b, c)) for a, b, c in [
+            (x, x, x), (y, y, y),
+            (xnext, xmid, xnext), (ymid, y, ynext),
+            (xnext+nox, xmid, xnext+nox), (ymid, y+oy, ynext+noy),
+            (x+ox, x+ox, x+ox), (y+oy, y+oy, y+oy),
+        ]
+    ], axis=-1).reshape(num_steps, 4, 2)
+    second_half = np.stack([
+        np.where(dx == 0, a, b) for a, b in [
+            (xnext, xmid), (ymid, ynext),
+            (xnext, xnext), (ynext, ynext),
+            (xnext+nox, xnext+nox), (ynext+noy, ynext+noy),
+            (x+ox, xmid), (ymid, y+oy),
+        ]
+    ], axis=-1).reshape(num_steps, 4, 2)
+
+    is_first = np.arange(num_steps) == 0
+    is_last = np.arange(num_steps) == num_steps-1
+    emit = np.stack([~straight | ~is_first, straight & ~is_last], axis=-1)
+    polygons = np.around(np.stack([first_half, second_half], axis=1), ROUNDING_NUM_DIGITS)[emit]
+    if report is not None:
+        report.add_time('vertices', time.perf_counter() - start)
+
+    _add_labels_and_polygons(cell, list(zip(x, y)) if labels else [], list(polygons), merge, report)
+    return cell
+
+
+def _add_labels_and_polygons(cell, label_positions, polygons, merge=False, report=None):
+    # Step index labels (layer 30) and the spiral polygons (layer 37). Label
+    # text outlines are counted as one polygon per label. Both the loop and
+    # the vectorized path add every label ahead of the polygons, where the
+    # original loop interleaved them; only the element order differs.
+    backend = backend_of(cell)
+    with report_stage(report, 'labels'):
+        for idx, position in enumerate(label_positions):
+            backend.add(cell, backend.text(f"{idx}", 1, position, layer=30, datatype=0))
+    with report_stage(report, 'polygons'):
+        backend.add_polygons(cell, polygons, layer=37, datatype=0, merge=merge)
+    if report is not None:
+        report.count('30/0', len(label_positions), 0)
+        report.count_polygons('37/0', polygons)
+
+
+def variant_suffix(trace_width, inner_radius, num_turns, spacing, labels=True, merge=False):
+    # Output file suffix identifying a spiral variant, e.g. tw3.0_ir20.0_nt4_s7.0
+    suffix = f"tw{trace_width}_ir{inner_radius}_nt{num_turns}_s{spacing}"
+    if not labels:
+        suffix += "_nolabels"
+    if merge:
+        suffix += "_merged"
+    return suffix
+
+
 def generate_octagon_spiral(
     cell, trace_width=DEFAULT_TRACE_WIDTH, 
     inner_radius=DEFAULT_INNER_RADIUS,
@@ -33,7 +183,12 @@ def generate_octagon_spiral(
     spacing=DEFAULT_SPACING,
     layer=DEFAULT_LAYER,
     datatype=DEFAULT_DATATYPE,
-    initial_direction=DEFAULT_INITIAL_DIRECTION
+    initial_direction=DEFAULT_INITIAL_DIRECTION,
+    vectorized=False,
+    labels=True,
+    merge=False,
+    cache=None,
+    report=None
 ):
     """
     Generate a spiral with octagonal shape using only segments that are
@@ -42,8 +197,8 @@ def generate_octagon_spiral(
     
     Parameters:
     -----------
-    cell : gdspy.Cell
-        The cell to add the spiral to
+    cell : gdspy.Cell or gdstk.Cell
+        The cell to add the spiral to; its type selects the layout backend
     trace_width : float
         Width of the spiral trace
     inner_radius : float
@@ -56,15 +211,37 @@ def generate_octagon_spiral(
         Layer number for the polygon
     datatype : int
         Datatype for the polygon
+    initial_direction : tuple
+        Direction of the first step, one of DIRECTIONS
+    vectorized : bool
+        Compute all vertices and trace-edge offsets as whole arrays and add
+        the polygons in one batch. Produces the same geometry as the loop.
+    labels : bool
+        Add a text label with the step index at every vertex (layer 30)
+    merge : bool
+        Fuse the half-side polygons into a single outline instead of
+        emitting two polygons per straight side
+    cache : layout_cache.LayoutCache
+        Optional layout cache; identical spirals are loaded from it instead
+        of being regenerated
+    report : diagnostics.RunReport
+        Optional report to time the vertices, labels and polygons stages
+        into and count the polygons per layer in
     """
-    
+    if cache is not None:
+        params = dict(
+            trace_width=trace_width, inner_radius=inner_radius, num_turns=num_turns,
+            spacing=spacing, layer=layer, datatype=datatype, initial_direction=initial_direction,
+            labels=labels, merge=merge)
+        return cache.generate(generate_octagon_spiral, cell, params, {'vectorized': vectorized, 'report': report})
+
     assert initial_direction in DIRECTIONS, f"Invalid initial direction: {initial_direction}"
 
     starting_direction_idx = DIRECTIONS.index(initial_direction)
-    print(f"starting_direction_idx: {starting_direction_idx}")
+    logger.debug("starting_direction_idx: %s", starting_direction_idx)
     ordered_directions = DIRECTIONS.copy()
     ordered_directions.rotate(-starting_direction_idx)#.tolist()
-    print(f"ordered_directions: {ordered_directions}")
+    logger.debug("ordered_directions: %s", ordered_directions)
     # Starting point
     current_radius = inner_radius
     points = []
@@ -74,9 +251,17 @@ def generate_octagon_spiral(
     COS_PI_8 = np.cos(np.pi/8)
     x = inner_radius*np.cos(3*np.pi/8 + np.pi/4 * starting_direction_idx)
     y = inner_radius*np.sin(3*np.pi/8 + np.pi/4 * starting_direction_idx) 
-    print(f'starting point: {x}, {y}')
+    logger.debug("starting point: %s, %s", x, y)
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     steps = np.arange(0, num_turns+1/8, 1/8)
+    if vectorized:
+        return _add_octagon_spiral_vectorized(
+            cell, x, y, steps, ordered_directions, trace_width, inner_radius, spacing, labels, merge, report)
+
+    start = time.perf_counter()
+    polygons = []
+    label_positions = []
     for idx, step in enumerate(steps):
         radius = inner_radius + step * (spacing + trace_width)
         next_radius = inner_radius + (step + 1/8) * (spacing + trace_width)/COS_PI_8
@@ -96,12 +281,15 @@ def generate_octagon_spiral(
         #     layer=37, datatype=0
         #     )
         #print(f"x: {x} y: {y}")
-        path = gdspy.Text(f"{idx}", position=(x, y), size=1, layer=30, datatype=0)
-        cell.add(path)
+        if labels:
+            # Added after the loop, still ahead of the polygons
+            label_positions.append((x, y))
         pdx, pdy = ordered_directions[(idx-1) % len(ordered_directions)]
         dx, dy = ordered_directions[idx % len(ordered_directions)]
         ndx, ndy = ordered_directions[(idx+1) % len(ordered_directions)]
-        print(f"dx: {dx} dy: {dy}")
+        if debug:
+            logger.debug("step %d: dx: %d dy: %d", idx, dx, dy,
+                         extra={'trace': {'step': idx, 'x': x, 'y': y, 'dx': dx, 'dy': dy}})
         # Equation of circle cecntered at zero is:
         # x^2 + y^2 = radius^2
         # Equation of line is:
@@ -161,8 +349,7 @@ def generate_octagon_spiral(
                     (xnext+trace_width*np.cos(next_vertex_angle)/COS_PI_8, ymid),
                     (x+trace_width*np.cos(vertex_angle)/COS_PI_8, y+trace_width*np.sin(vertex_angle)/COS_PI_8)]),
                 ROUNDING_NUM_DIGITS)
-                path = gdspy.Polygon(points, layer=37, datatype=0)
-                cell.add(path)
+                polygons.append(points)
 
             # Add second half side of octagon
             if idx != len(steps)-1:
@@ -173,8 +360,7 @@ def generate_octagon_spiral(
                     (x+trace_width*np.cos(vertex_angle)/COS_PI_8, ymid)]),
 
                 ROUNDING_NUM_DIGITS)
-                path = gdspy.Polygon(points, layer=37, datatype=0)
-                cell.add(path)
+                polygons.append(points)
         elif dy == 0:
             xmid = (x+xnext)/2
 
@@ -186,8 +372,7 @@ def generate_octagon_spiral(
                     (xmid,y+trace_width*np.sin(vertex_angle)/COS_PI_8),
                     (x+trace_width*np.cos(vertex_angle)/COS_PI_8, y+trace_width*np.sin(vertex_angle)/COS_PI_8)]),
                 ROUNDING_NUM_DIGITS)
-                path = gdspy.Polygon(points, layer=37, datatype=0)
-                cell.add(path)
+                polygons.append(points)
 
             # Add second half side of octagon
             if idx != len(steps)-1:
@@ -197,8 +382,7 @@ def generate_octagon_spiral(
                     (xnext+trace_width*np.cos(next_vertex_angle)/COS_PI_8, ynext+trace_width*np.sin(next_vertex_angle)/COS_PI_8),
                     (xmid, y+trace_width*np.sin(vertex_angle)/COS_PI_8)]),
                 ROUNDING_NUM_DIGITS)
-                path = gdspy.Polygon(points, layer=37, datatype=0)
-                cell.add(path)
+                polygons.append(points)
         else:
             # points = np.around(np.array([
             #     (x-trace_width*np.cos(vertex_angle)/2,y-trace_width*np.sin(vertex_angle)/2),
@@ -212,19 +396,17 @@ def generate_octagon_spiral(
                 (xnext+trace_width*np.cos(next_vertex_angle)/COS_PI_8, ynext+trace_width*np.sin(next_vertex_angle)/COS_PI_8),
                 (x+trace_width*np.cos(vertex_angle)/COS_PI_8, y+trace_width*np.sin(vertex_angle)/COS_PI_8)]),
             ROUNDING_NUM_DIGITS)
-            path = gdspy.Polygon(points, layer=37, datatype=0)
-            cell.add(path)
+            polygons.append(points)
 
         x = xnext
         y = ynext
 
+    if report is not None:
+        report.add_time('vertices', time.perf_counter() - start)
+    _add_labels_and_polygons(cell, label_positions, polygons, merge, report)
     return cell
 
 if __name__ == "__main__":
-    # Create a new GDSII library and cell
-    lib = gdspy.GdsLibrary()
-    cell = lib.new_cell("octagon_spiral")
-    
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Generate an octagonal spiral")
     parser.add_argument("--trace_width", type=float, default=DEFAULT_TRACE_WIDTH, help="Width of the spiral trace")
@@ -233,30 +415,50 @@ if __name__ == "__main__":
     parser.add_argument("--spacing", type=float, default=DEFAULT_SPACING, help="Spacing between adjacent turns")
     parser.add_argument("--layer", type=int, default=DEFAULT_LAYER, help="Layer number for the polygon")
     parser.add_argument("--datatype", type=int, default=DEFAULT_DATATYPE, help="Datatype for the polygon")
+    parser.add_argument("--no_labels", action="store_true", default=False, help="Do not add the step index labels")
+    parser.add_argument("--merge", action="store_true", default=False, help="Fuse the spiral into a single outline instead of half-side polygons")
+    parser.add_argument("--vectorized", action="store_true", default=False, help="Compute the whole spiral with array operations instead of the per-step loop")
+    add_output_arguments(parser)
+    add_verbosity_arguments(parser)
+    add_cache_arguments(parser)
     args = parser.parse_args()
-    
-    # Generate the spiral
-    generate_octagon_spiral(
-        cell,
+    configure_logging_from_args(args)
+    params = dict(
         trace_width=args.trace_width,
         inner_radius=args.inner_radius,
         num_turns=args.num_turns,
         spacing=args.spacing,
         layer=args.layer,
-        datatype=args.datatype
+        datatype=args.datatype,
+        initial_direction=DEFAULT_INITIAL_DIRECTION,
+        labels=not args.no_labels,
+        merge=args.merge
     )
-    
-    # Save the GDSII file
-    output_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "outputs")
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, "octagon_spiral.gds")
-    lib.write_gds(output_file)
-    print(f"Spiral saved to {output_file}")
-    
-    # Also save as SVG for visualization
-    svg_file = os.path.join(output_dir, "octagon_spiral.svg")
-    cell.write_svg(svg_file)
-    print(f"SVG visualization saved to {svg_file}")
-    
+
+    report = RunReport() if args.report else None
+
+    def build():
+        # Create a new GDSII library and cell
+        backend = get_backend(args.backend)
+        lib = backend.new_library()
+        cell = backend.new_cell("octagon_spiral")
+
+        # Generate the spiral
+        with report_stage(report, "generate"):
+            generate_octagon_spiral(cell, vectorized=args.vectorized, **params, report=report)
+        backend.add_cell(lib, cell)
+        return lib, cell
+
+    # Save the requested outputs (GDSII, SVG for visualization), reusing
+    # those of an identical spiral if caching is enabled
+    outputs, lib = write_outputs_cached(
+        cache_from_args(args), generate_octagon_spiral, params, build,
+        "octagon_spiral", args.formats, args.output_dir, report, args.backend)
+    for output_format, output_file in outputs.items():
+        logger.info("%s saved to %s", output_format.upper(), output_file)
+    if report is not None:
+        logger.info("Report saved to %s", report.write(args.report))
+
     # Show the cell in a GUI window
-    gdspy.LayoutViewer(lib)
+    if not args.headless and (lib is not None or "gds" in outputs):
+        show_layout(lib if lib is not None else outputs["gds"])
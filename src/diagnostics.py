@@ -0,0 +1,160 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+LOG_FORMAT = '%(levelname)s %(name)s: %(message)s'
+
+
+class JsonTraceFormatter(logging.Formatter):
+    # One JSON object per record. Geometry traces attach their data with
+    # logger.debug(..., extra={'trace': {...}}) and it is emitted as fields.
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'trace', {}))
+        return json.dumps(entry, default=_json_default)
+
+
+def _json_default(value):
+    # NumPy scalars and arrays in trace data
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class RunReport:
+    """
+    Machine-readable instrumentation report of one generator run.
+
+    Generators and writers that take a report time their stages into it
+    (vertex computation, polygon construction, vias, GDS/SVG writing) and
+    count the polygons and vertices they add per layer and the bytes of the
+    files they write. Collection is off unless a report is passed, and only
+    costs a timer call per stage and a length per polygon batch when on.
+    Stages of the same name, e.g. over several generator calls, add up.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.layers = {}
+        self.outputs = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count_polygons(self, layer, polygons):
+        # Polygons given as point sequences, as passed to backend.add_polygons
+        self.count(layer, len(polygons), sum(len(points) for points in polygons))
+
+    def count(self, layer, polygons, vertices):
+        counts = self.layers.setdefault(layer, {'polygons': 0, 'vertices': 0})
+        counts['polygons'] += int(polygons)
+        counts['vertices'] += int(vertices)
+
+    def count_outputs(self, outputs):
+        # Sizes of the {format: path} files written
+        for fmt, path in outputs.items():
+            self.outputs[fmt] = {'path': path, 'bytes': os.path.getsize(path)}
+
+    def merge(self, other):
+        # Add the stages and counts of another report (or its to_dict), e.g.
+        # to total the reports of a sweep. Outputs are then counted per format
+        # as a number of files instead of a path.
+        other = other if isinstance(other, dict) else other.to_dict()
+        for name, seconds in other['stages'].items():
+            self.add_time(name, seconds)
+        for layer, counts in other['layers'].items():
+            self.count(layer, counts['polygons'], counts['vertices'])
+        for fmt, output in other['outputs'].items():
+            total = self.outputs.setdefault(fmt, {'files': 0, 'bytes': 0})
+            total['files'] += output.get('files', 1)
+            total['bytes'] += output['bytes']
+        return self
+
+    def to_dict(self):
+        return {
+            'stages': dict(self.stages),
+            'layers': {layer: dict(counts) for layer, counts in self.layers.items()},
+            'polygons': sum(counts['polygons'] for counts in self.layers.values()),
+            'vertices': sum(counts['vertices'] for counts in self.layers.values()),
+            'outputs': {fmt: dict(output) for fmt, output in self.outputs.items()},
+            'bytes_written': sum(output['bytes'] for output in self.outputs.values()),
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def report_stage(report, name):
+    # Time a stage into report, or do nothing when there is no report
+    return _NO_STAGE if report is None else report.stage(name)
+
+
+def verbosity_level(verbosity):
+    # 0 -> INFO, 1+ -> DEBUG, negative (quiet) -> WARNING
+    if verbosity < 0:
+        return logging.WARNING
+    return logging.DEBUG if verbosity > 0 else logging.INFO
+
+
+def add_verbosity_arguments(parser):
+    # Logging options shared by the CLIs
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Increase verbosity (-v shows geometry debug traces)')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help='Only show warnings and errors')
+    parser.add_argument('--trace_json', type=str, default=None, help='Write debug traces as JSON lines to this file')
+    return parser
+
+
+def configure_logging(verbosity=0, trace_path=None, stream=sys.stderr):
+    """
+    Configure the root logger with a console handler at the level given by
+    verbosity and, optionally, a JSON-lines trace sink that receives every
+    debug record.
+
+    Debug traces in the geometry loops are guarded by
+    logger.isEnabledFor(logging.DEBUG), so they are not formatted at all
+    unless -v or a trace sink is enabled.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+    console_level = verbosity_level(verbosity)
+    console = logging.StreamHandler(stream)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(console)
+    root.setLevel(console_level)
+
+    if trace_path is not None:
+        trace = logging.FileHandler(trace_path, mode='w')
+        trace.setLevel(logging.DEBUG)
+        trace.setFormatter(JsonTraceFormatter())
+        root.addHandler(trace)
+        root.setLevel(logging.DEBUG)
+    return root
+
+
+def configure_logging_from_args(args):
+    return configure_logging(-1 if args.quiet else args.verbose, args.trace_json)
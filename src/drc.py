@@ -0,0 +1,317 @@
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_backend import backend_of
+from layout_io import load_process_config, merge_polygons
+
+logger = logging.getLogger(__name__)
+
+# Distances within this many um of a rule still pass, and edges closer than
+# it are treated as touching (e.g. the bridges gdspy cuts into holes). The
+# merged outlines are snapped to the 1 nm database grid (the precision of
+# gdspy.boolean and of the written GDS), which moves 45 degree edges by up
+# to a grid step, so the tolerance is one grid step rather than float noise.
+# It only absorbs that snapping: the stepped quadrant of a transformer coil
+# really narrows the trace (to ~0.8-0.97 of its width, depending on the
+# inner radius and spacing), so coils drawn at M6 min_width are not clean.
+DRC_TOLERANCE = 1e-3
+# Fraction of an edge length that projections must overlap by to face it
+OVERLAP_TOLERANCE = 1e-6
+# Minimum |cos| between the gap and an edge normal for the edge to face the gap
+FACING_COS = 1e-6
+
+
+class DrcError(Exception):
+    # Raised when a generated layout violates the process rules
+    def __init__(self, violations):
+        self.violations = violations
+        super().__init__(f'{len(violations)} DRC violations, first: {violations[0] if violations else None}')
+
+
+def load_rules(process_config=None):
+    # Design rules by layer name from the 'rules' section of the process config
+    process_config = process_config or load_process_config()
+    return process_config.get('rules', {})
+
+
+def _layer_edges(polygons):
+    # Start and end points, inward unit normals and owning polygon of every
+    # edge, plus each edge's index within its polygon and the polygon size
+    starts, ends, normals, owners, positions, sizes = [], [], [], [], [], []
+    for idx, points in enumerate(polygons):
+        points = np.asarray(points, dtype=float)
+        following = np.roll(points, -1, axis=0)
+        # Signed area: positive for counterclockwise polygons, whose
+        # interior lies to the left of each edge
+        area = np.sum(points[:, 0]*following[:, 1] - following[:, 0]*points[:, 1])/2
+        direction = following - points
+        length = np.hypot(direction[:, 0], direction[:, 1])
+        length[length == 0] = 1
+        normal = np.sign(area)*np.stack([-direction[:, 1], direction[:, 0]], axis=1)/length[:, None]
+        starts.append(points)
+        ends.append(following)
+        normals.append(normal)
+        owners.append(np.full(len(points), idx))
+        positions.append(np.arange(len(points)))
+        sizes.append(np.full(len(points), len(points)))
+    if not starts:
+        empty = np.empty((0, 2))
+        return empty, empty, empty, np.empty(0, int), np.empty(0, int), np.empty(0, int)
+    return tuple(np.concatenate(x) for x in (starts, ends, normals, owners, positions, sizes))
+
+
+def candidate_pairs(starts, ends, distance):
+    """
+    Index pairs (i, j), i < j, of edges that may come within distance of each
+    other. Edges are cut into pieces no longer than distance and bucketed on
+    a uniform grid of distance-sized cells, so only edges sharing a cell are
+    paired and the work grows with the total edge length, not all pairs.
+    """
+    if len(starts) < 2:
+        return np.empty((0, 2), dtype=int)
+    length = np.hypot(*(ends - starts).T)
+    num_pieces = np.maximum(1, np.ceil(length/distance).astype(np.int64))
+    edge_idx = np.repeat(np.arange(len(starts)), num_pieces)
+    piece = np.arange(num_pieces.sum()) - np.repeat(np.cumsum(num_pieces) - num_pieces, num_pieces)
+    direction = (ends - starts)/num_pieces[:, None]
+    piece_start = starts[edge_idx] + piece[:, None]*direction[edge_idx]
+    piece_end = piece_start + direction[edge_idx]
+
+    # Each piece covers at most 3x3 cells once grown by half the distance
+    cell_low = np.floor((np.minimum(piece_start, piece_end) - distance/2)/distance).astype(np.int64)
+    cell_high = np.floor((np.maximum(piece_start, piece_end) + distance/2)/distance).astype(np.int64)
+    span = cell_high - cell_low + 1
+    counts = span[:, 0]*span[:, 1]
+    entry_piece = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cx = cell_low[entry_piece, 0] + local % span[entry_piece, 0]
+    cy = cell_low[entry_piece, 1] + local // span[entry_piece, 0]
+    cx -= cx.min()
+    cy -= cy.min()
+    bucket = cx*(cy.max() + 1) + cy
+    entry_edge = edge_idx[entry_piece]
+    # One entry per edge and bucket, sorted by bucket
+    entries = np.unique(bucket*len(starts) + entry_edge)
+    bucket, entry_edge = entries // len(starts), entries % len(starts)
+
+    # Pair every entry with the later entries of the same bucket
+    pairs = []
+    offset = 1
+    same = bucket[offset:] == bucket[:-offset]
+    while same.any():
+        first = np.flatnonzero(same)
+        pairs.append(np.stack([entry_edge[first], entry_edge[first + offset]], axis=1))
+        offset += 1
+        same = same[:-1] & (bucket[offset:] == bucket[:-offset])
+    if not pairs:
+        return np.empty((0, 2), dtype=int)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    codes = np.unique(pairs[:, 0]*len(starts) + pairs[:, 1])
+    return np.stack([codes // len(starts), codes % len(starts)], axis=1)
+
+
+def _closest_points(a0, a1, b0, b1):
+    # Closest points p on segment a0-a1 and q on b0-b1 (assumed not to
+    # cross), their distance, and whether either segment's projection onto
+    # the other overlaps it, i.e. the edges face each other directly rather
+    # than only meeting corner to corner
+    def project(p, s0, s1):
+        direction = s1 - s0
+        length2 = np.sum(direction**2, axis=1)
+        t = np.sum((p - s0)*direction, axis=1)/np.where(length2 > 0, length2, 1)
+        return s0 + np.clip(t, 0, 1)[:, None]*direction, t
+
+    def overlaps(t0, t1):
+        return np.maximum(np.minimum(t0, t1), 0) < np.minimum(np.maximum(t0, t1), 1) - OVERLAP_TOLERANCE
+
+    on_b0, tb0 = project(a0, b0, b1)
+    on_b1, tb1 = project(a1, b0, b1)
+    on_a0, ta0 = project(b0, a0, a1)
+    on_a1, ta1 = project(b1, a0, a1)
+    options = [(a0, on_b0), (a1, on_b1), (on_a0, b0), (on_a1, b1)]
+    distances = np.stack([np.hypot(*(q - p).T) for p, q in options])
+    best = np.argmin(distances, axis=0)
+    rows = np.arange(len(a0))
+    p = np.stack([option[0] for option in options])[best, rows]
+    q = np.stack([option[1] for option in options])[best, rows]
+    return p, q, distances[best, rows], overlaps(ta0, ta1) | overlaps(tb0, tb1)
+
+
+def check_width_spacing(polygons, min_width=0, min_spacing=0, layer_name=None):
+    """
+    Minimum width and spacing violations of merged polygons on one layer.
+
+    Edge pairs closer than the larger rule are found with candidate_pairs.
+    Each pair is classified by the inward normals of the two edges: a gap
+    both edges face into is interior (width), a gap both face away from is
+    exterior (spacing). Pairs within a polygon must overlap in projection,
+    so edges meeting corner to corner around a short edge do not count.
+
+    Returns a list of violation dictionaries.
+    """
+    distance = max(min_width, min_spacing)
+    if distance <= 0:
+        return []
+    starts, ends, normals, owners, positions, sizes = _layer_edges(polygons)
+    pairs = candidate_pairs(starts, ends, distance)
+    if not len(pairs):
+        return []
+    i, j = pairs.T
+    same = owners[i] == owners[j]
+    # Edges sharing a vertex always touch
+    adjacent = same & (
+        (np.abs(positions[i] - positions[j]) == 1)
+        | (np.abs(positions[i] - positions[j]) == sizes[i] - 1)
+    )
+    i, j, same = i[~adjacent], j[~adjacent], same[~adjacent]
+    p, q, gap, facing = _closest_points(starts[i], ends[i], starts[j], ends[j])
+
+    keep = (gap > DRC_TOLERANCE) & (gap < distance - DRC_TOLERANCE) & (facing | ~same)
+    i, j, same, p, q, gap = i[keep], j[keep], same[keep], p[keep], q[keep], gap[keep]
+    unit = (q - p)/gap[:, None]
+    facing_i = np.sum(unit*normals[i], axis=1)
+    facing_j = -np.sum(unit*normals[j], axis=1)
+    interior = same & (facing_i > FACING_COS) & (facing_j > FACING_COS)
+    exterior = (facing_i < -FACING_COS) & (facing_j < -FACING_COS)
+
+    violations = []
+    seen = set()
+    for rule, required, mask in [
+        ('min_width', min_width, interior & (gap < min_width - DRC_TOLERANCE)),
+        ('min_spacing', min_spacing, exterior & (gap < min_spacing - DRC_TOLERANCE)),
+    ]:
+        for idx in np.flatnonzero(mask):
+            location = (p[idx] + q[idx])/2
+            # The edges on either side of a vertex pair with the opposite
+            # edge at the same closest point, so report each location once
+            key = (rule, *np.round(location/DRC_TOLERANCE).astype(int).tolist())
+            if key in seen:
+                continue
+            seen.add(key)
+            violations.append({
+                'rule': rule, 'layer': layer_name, 'required': required,
+                'actual': float(gap[idx]), 'location': location.tolist(),
+            })
+    return violations
+
+
+def check_vias(vias, width, enclosures, layer_name=None, interacting_enclosures=None):
+    """
+    Via size and enclosure violations. vias are the via polygons and
+    enclosures maps each enclosing layer name to (its merged polygons, the
+    required enclosure in um). interacting_enclosures has the same form but
+    only applies to the vias that overlap the enclosing layer, i.e. land on
+    it, so vias connecting other layers are not required to be inside it.
+    """
+    import gdspy
+    violations = []
+    for via in vias:
+        via = np.asarray(via, dtype=float)
+        (x_min, y_min), (x_max, y_max) = via.min(axis=0), via.max(axis=0)
+        center = [float(x_min + x_max)/2, float(y_min + y_max)/2]
+        if width and (len(via) != 4 or max(abs(x_max - x_min - width), abs(y_max - y_min - width)) > DRC_TOLERANCE):
+            violations.append({
+                'rule': 'width', 'layer': layer_name, 'required': width,
+                'actual': float(max(x_max - x_min, y_max - y_min)), 'location': center,
+            })
+        checked = dict(enclosures)
+        for metal_name, (metal, enclosure) in (interacting_enclosures or {}).items():
+            landed = gdspy.Rectangle(
+                (x_min + DRC_TOLERANCE, y_min + DRC_TOLERANCE), (x_max - DRC_TOLERANCE, y_max - DRC_TOLERANCE))
+            if metal and gdspy.boolean(landed, metal, 'and') is not None:
+                checked[metal_name] = (metal, enclosure)
+        for metal_name, (metal, enclosure) in checked.items():
+            # The via grown by the enclosure must lie entirely inside the metal
+            grown = gdspy.Rectangle(
+                (x_min - enclosure + DRC_TOLERANCE, y_min - enclosure + DRC_TOLERANCE),
+                (x_max + enclosure - DRC_TOLERANCE, y_max + enclosure - DRC_TOLERANCE))
+            if metal and gdspy.boolean(grown, metal, 'not') is None:
+                continue
+            violations.append({
+                'rule': 'enclosure', 'layer': layer_name, 'enclosing_layer': metal_name,
+                'required': enclosure, 'actual': None, 'location': center,
+            })
+    return violations
+
+
+def check_polygons(polygons, rules=None, process_config=None, layers=None):
+    """
+    Check flattened polygons against the process design rules.
+
+    Parameters:
+    -----------
+    polygons : dict
+        {(layer, datatype): list of polygon point arrays}, as returned by
+        gdspy.Cell.get_polygons(by_spec=True)
+    rules : dict
+        Rules by layer name, defaults to the 'rules' section of the process
+        config. Metal layers take 'min_width' and 'min_spacing', via layers
+        'width', 'min_spacing', 'enclosure' ({metal layer name: um}) and
+        'interacting_enclosure' (the same, for the vias landing on the metal).
+    process_config : dict
+        Layer name to layer/datatype map, defaults to the process config
+    layers : dict
+        Overrides of the (layer, datatype) checked for a layer name, e.g.
+        {'M6': (37, 0)} to check a spiral drawn on another layer
+
+    Returns a list of violation dictionaries with 'rule', 'layer',
+    'required', 'actual' and 'location'.
+    """
+    process_config = process_config or load_process_config()
+    rules = load_rules(process_config) if rules is None else rules
+    specs = {
+        name: tuple((layers or {}).get(name, (process_config[name]['layer'], process_config[name]['datatype'])))
+        for name in rules
+    }
+    merged = {}
+    def layer_polygons(name):
+        # Overlapping fragments are merged so that only true outlines are checked
+        if name not in merged:
+            merged_set = merge_polygons(polygons.get(specs.get(name), []), *specs.get(name, (0, 0)))
+            merged[name] = merged_set.polygons if merged_set is not None else []
+        return merged[name]
+
+    violations = []
+    for name, layer_rules in rules.items():
+        if 'enclosure' in layer_rules or 'interacting_enclosure' in layer_rules or 'width' in layer_rules:
+            vias = layer_polygons(name)
+            enclosures, interacting = (
+                {
+                    metal_name: (layer_polygons(metal_name), enclosure)
+                    for metal_name, enclosure in layer_rules.get(key, {}).items()
+                }
+                for key in ('enclosure', 'interacting_enclosure')
+            )
+            violations += check_vias(vias, layer_rules.get('width'), enclosures, name, interacting)
+        violations += check_width_spacing(
+            layer_polygons(name), layer_rules.get('min_width', 0), layer_rules.get('min_spacing', 0), name)
+    return violations
+
+
+def check_cell(cell, rules=None, process_config=None, layers=None):
+    # check_polygons over the flattened geometry of cell and its references,
+    # a gdspy or gdstk cell
+    return check_polygons(backend_of(cell).polygons_by_spec(cell), rules, process_config, layers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check a GDS file against the process design rules')
+    parser.add_argument('gds_file', type=str, help='GDS file to check')
+    parser.add_argument('--cell', type=str, default=None, help='Cell to check (default: the top level cell)')
+    parser.add_argument('--max_report', type=int, default=20, help='Number of violations to print')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    import gdspy
+    lib = gdspy.GdsLibrary(infile=args.gds_file)
+    cell = lib.cells[args.cell] if args.cell else lib.top_level()[0]
+    violations = check_cell(cell)
+    for violation in violations[:args.max_report]:
+        logger.warning('%s', violation)
+    logger.info('%s: %d DRC violations', cell.name, len(violations))
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,225 @@
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import generate_spiral_transformer
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from inductance_estimator import DEFAULT_THICKNESS, GMD_PERIMETER_RATIO, MU_0, UM, estimate_spiral_transformer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WIDTH_FILAMENTS = 1 # Parallel filaments across each trace
+DEFAULT_ORDER = 8 # Gauss-Legendre points per filament
+# Filament-pair quadrature evaluations per chunk, bounding the temporary memory
+CHUNK_SIZE = 1 << 20
+# Largest sine of the angle between filaments treated as parallel
+PARALLEL_TOLERANCE = 1e-9
+# Pairs whose midpoints are closer than this times their mean length are
+# integrated with NEAR_ORDER_FACTOR times the quadrature order
+NEAR_DISTANCE = 1.5
+NEAR_ORDER_FACTOR = 4
+
+
+def transformer_filaments(trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True, width_filaments=DEFAULT_WIDTH_FILAMENTS):
+    """
+    Straight current filaments along both coils of generate_spiral_transformer.
+
+    Every octagon side of every quadrant segment is cut into width_filaments
+    parallel filaments across the trace, all pointing counterclockwise.
+    Entry/exit traces and vias are not included.
+
+    Returns a dictionary with the filament 'start' and 'end' points (N, 2)
+    in um, their 'width' (N,) in um and the 'coil' (N,) they belong to.
+    """
+    fractions = (np.arange(width_filaments) + 0.5)/width_filaments
+    starts, ends, coils = [], [], []
+    for coil_idx in range(2):
+        segments = np.array(generate_spiral_transformer.coil_segment_points(
+            trace_width, inner_radius, num_turns, spacing, opposite_side_entry, coil_idx))
+        if not len(segments):
+            continue
+        # Inner edge and matching outer edge points of each segment, (S, 5, 2)
+        inner, outer = segments[:, :5], segments[:, :4:-1]
+        lines = inner[:, np.newaxis] + fractions[np.newaxis, :, np.newaxis, np.newaxis]*(outer - inner)[:, np.newaxis]
+        starts.append(lines[:, :, :-1].reshape(-1, 2))
+        ends.append(lines[:, :, 1:].reshape(-1, 2))
+        coils.append(np.full(len(starts[-1]), coil_idx))
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+    return {
+        'start': starts,
+        'end': ends,
+        'width': np.full(len(starts), trace_width/width_filaments),
+        'coil': np.concatenate(coils),
+    }
+
+
+def grover_self_inductance(length, width, thickness):
+    # Partial self inductance in H of a straight rectangular bar (Grover);
+    # dimensions in um and broadcast
+    length, width, thickness = (np.asarray(x, dtype=float)*UM for x in (length, width, thickness))
+    return MU_0*length/(2*np.pi)*(np.log(2*length/(width + thickness)) + 0.5 + (width + thickness)/(3*length))
+
+
+def _cross(a, b):
+    return a[..., 0]*b[..., 1] - a[..., 1]*b[..., 0]
+
+
+def _parallel_integral(length, a, b, distance2):
+    # Neumann integral of filament 1 along [0, length] and a parallel filament
+    # 2 running from a to b along the same axis at a squared distance
+    def primitive(x):
+        distance = np.sqrt(distance2)
+        return x*np.arcsinh(x/distance) - np.sqrt(x**2 + distance2)
+    return primitive(b) - primitive(a) - primitive(b - length) + primitive(a - length)
+
+
+def _quadrature_integral(starts_i, vectors_i, starts_j, vectors_j, distance2, order):
+    # Neumann integral of filament pairs with Gauss-Legendre quadrature, the
+    # squared distances regularized by distance2
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    nodes, weights = (nodes + 1)/2, weights/2
+    points_i = starts_i[:, np.newaxis] + nodes[:, np.newaxis]*vectors_i[:, np.newaxis]
+    points_j = starts_j[:, np.newaxis] + nodes[:, np.newaxis]*vectors_j[:, np.newaxis]
+    distance2 = distance2[:, np.newaxis, np.newaxis]
+    for axis in range(2):
+        distance2 = distance2 + (points_i[:, :, np.newaxis, axis] - points_j[:, np.newaxis, :, axis])**2
+    return np.sum(vectors_i*vectors_j, axis=1)*np.einsum('p,kpq,q->k', weights, 1/np.sqrt(distance2), weights)
+
+
+def _matrix_rows(rows, starts, ends, widths, thickness, order):
+    # Neumann mutual inductances in H between filaments rows and filaments
+    # rows.start onwards, (len(rows), N - rows.start). Lengths are in um.
+    vectors = ends - starts
+    lengths = np.linalg.norm(vectors, axis=1)
+    directions = vectors/lengths[:, np.newaxis]
+    columns = np.arange(rows.start, len(starts))
+    row_idx, column_idx = (idx.ravel() for idx in np.meshgrid(np.arange(rows.start, rows.stop), columns, indexing='ij'))
+    # The current spreads over the cross section: replace the distance R by
+    # sqrt(R^2 + g^2), with g the geometric mean distance, which keeps pairs
+    # sharing an end point finite
+    gmd2 = (GMD_PERIMETER_RATIO*(widths + thickness))**2
+    gmd2 = (gmd2[row_idx] + gmd2[column_idx])/2
+    integral = np.empty(len(row_idx))
+    parallel = np.abs(_cross(directions[row_idx], directions[column_idx])) < PARALLEL_TOLERANCE
+
+    # Parallel pairs (including every pair of sub-filaments of one trace)
+    # have a closed form
+    i, j = row_idx[parallel], column_idx[parallel]
+    offsets = starts[j] - starts[i]
+    integral[parallel] = _parallel_integral(
+        lengths[i], np.sum(offsets*directions[i], axis=1), np.sum((ends[j] - starts[i])*directions[i], axis=1),
+        _cross(directions[i], offsets)**2 + gmd2[parallel])
+
+    # Other pairs are integrated with Gauss-Legendre quadrature, at a higher
+    # order for the few pairs meeting at or near a corner
+    i, j = row_idx[~parallel], column_idx[~parallel]
+    near = np.linalg.norm((starts[i] + ends[i] - starts[j] - ends[j])/2, axis=1) < NEAR_DISTANCE*(lengths[i] + lengths[j])/2
+    for pairs, pair_order in [(near, NEAR_ORDER_FACTOR*order), (~near, order)]:
+        integral[np.flatnonzero(~parallel)[pairs]] = _quadrature_integral(
+            starts[i[pairs]], vectors[i[pairs]], starts[j[pairs]], vectors[j[pairs]], gmd2[~parallel][pairs], pair_order)
+    return MU_0/(4*np.pi)*UM*integral.reshape(rows.stop - rows.start, len(columns))
+
+
+def partial_inductance_matrix(starts, ends, widths, thickness=DEFAULT_THICKNESS, order=DEFAULT_ORDER, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Partial inductance matrix of straight filaments.
+
+    Mutual terms are the Neumann double integral along each filament pair,
+    evaluated for all pairs of a chunk of rows at once: in closed form for
+    parallel filaments and with Gauss-Legendre quadrature otherwise. The
+    diagonal is Grover's self inductance of a rectangular bar. Only the upper
+    triangle is computed.
+
+    Parameters:
+    -----------
+    starts, ends : (N, 2) array
+        Filament end points in um
+    widths : (N,) array
+        Filament widths in um
+    thickness : float
+        Metal thickness in um
+    order : int
+        Gauss-Legendre points per filament
+    workers : int
+        Worker processes evaluating chunks in parallel; 1 evaluates in this
+        process, None uses the CPU count
+    chunk_size : int
+        Filament-pair quadrature evaluations per chunk
+
+    Returns the symmetric (N, N) matrix in H.
+    """
+    starts, ends, widths = (np.asarray(x, dtype=float) for x in (starts, ends, widths))
+    num_filaments = len(starts)
+    rows_per_chunk = max(1, chunk_size//(num_filaments*order**2))
+    chunks = [slice(start, min(start + rows_per_chunk, num_filaments)) for start in range(0, num_filaments, rows_per_chunk)]
+    args = (starts, ends, widths, thickness, order)
+    if workers == 1:
+        blocks = [_matrix_rows(rows, *args) for rows in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(_matrix_rows, chunks, *([arg] * len(chunks) for arg in args)))
+    matrix = np.zeros((num_filaments, num_filaments))
+    for rows, block in zip(chunks, blocks):
+        matrix[rows, rows.start:] = block
+    matrix = np.triu(matrix, 1)
+    lengths = np.linalg.norm(ends - starts, axis=1)
+    return matrix + matrix.T + np.diag(grover_self_inductance(lengths, widths, thickness))
+
+
+def transformer_inductance(
+    trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True,
+    thickness=DEFAULT_THICKNESS, width_filaments=DEFAULT_WIDTH_FILAMENTS, order=DEFAULT_ORDER, workers=1):
+    """
+    Self and mutual inductance of the two coils of generate_spiral_transformer
+    from the partial inductance matrix of their filaments.
+
+    Parameters:
+    -----------
+    trace_width, inner_radius, num_turns, spacing, opposite_side_entry
+        Transformer parameters as in generate_spiral_transformer (um)
+    thickness : float
+        Metal thickness in um
+    width_filaments : int
+        Parallel filaments across each trace, each carrying an equal share
+        of the coil current
+    order : int
+        Gauss-Legendre points per filament
+    workers : int
+        Worker processes, see partial_inductance_matrix
+
+    Returns a dictionary with 'L1', 'L2', 'M' (H) and 'k'.
+    """
+    filaments = transformer_filaments(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, width_filaments)
+    logger.debug('Partial inductance matrix of %d filaments', len(filaments['start']))
+    matrix = partial_inductance_matrix(
+        filaments['start'], filaments['end'], filaments['width'], thickness, order, workers)
+    # Filaments of a coil are in series (parallel across the width), so the
+    # coil inductances are block sums of the matrix
+    masks = [filaments['coil'] == coil_idx for coil_idx in range(2)]
+    (L1, M), (_, L2) = [[matrix[rows][:, columns].sum()/width_filaments**2 for columns in masks] for rows in masks]
+    return {'L1': L1, 'L2': L2, 'M': M, 'k': M/np.sqrt(L1*L2)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute transformer inductances and coupling from filament partial inductances')
+    parser.add_argument('--trace_width', type=float, default=generate_spiral_transformer.DEFAULT_TRACE_WIDTH, help='Width of the spiral in um')
+    parser.add_argument('--inner_radius', type=float, default=generate_spiral_transformer.DEFAULT_INNER_RADIUS, help='Inner radius of the spiral in um')
+    parser.add_argument('--num_turns', type=int, default=generate_spiral_transformer.DEFAULT_NUM_TURNS, help='Number of turns in the spiral')
+    parser.add_argument('--spacing', type=float, default=generate_spiral_transformer.DEFAULT_SPACING, help='Spacing between the turns in um')
+    parser.add_argument('--same_side_entry', action='store_true', default=False, help='Second coil enters from the same side')
+    parser.add_argument('--thickness', type=float, default=DEFAULT_THICKNESS, help='Metal thickness in um')
+    parser.add_argument('--width_filaments', type=int, default=DEFAULT_WIDTH_FILAMENTS, help='Parallel filaments across each trace')
+    parser.add_argument('--order', type=int, default=DEFAULT_ORDER, help='Gauss-Legendre points per filament')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes (0: CPU count)')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    geometry = (args.trace_width, args.inner_radius, args.num_turns, args.spacing, not args.same_side_entry)
+    result = transformer_inductance(*geometry, args.thickness, args.width_filaments, args.order, args.workers or None)
+    estimate = estimate_spiral_transformer(*geometry, thickness=args.thickness)
+    print(f'{"":>10} {"filament":>12} {"wheeler":>12}')
+    for name in result:
+        print(f'{name:>10} {result[name]:12.4g} {float(estimate[name]):12.4g}')
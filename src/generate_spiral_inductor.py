@@ -1,9 +1,12 @@
-import phidl
 import numpy as np
-import gdspy
 import argparse
-import json
-import os
+import logging
+
+from diagnostics import RunReport, add_verbosity_arguments, configure_logging_from_args, report_stage
+from layout_cache import add_cache_arguments, cache_from_args, write_outputs_cached
+from layout_backend import backend_of, get_backend
+from layout_io import add_output_arguments, load_process_config, show_layout
+from octagon_geometry import inductor_template, inductor_vertex_table
 # using parameters from cadence initially:
 DEFAULT_TRACE_WIDTH = 3 #um
 DEFAULT_INNER_RADIUS = 20 #um
@@ -12,9 +15,45 @@ DEFAULT_GUARD_RING_DISTANCE = 50 #um
 DEFAULT_SPACING = 8 #um
 POLYGON_NSIDES = 8 # Octagon
 
-process_config = json.load(open(os.path.join(os.path.dirname(__file__), 'configs/my_process.json')))
-print(process_config)
-def generate_spiral_inductor(cell, trace_width, inner_radius, num_turns, guard_ring_distance, spacing):
+logger = logging.getLogger(__name__)
+
+def __getattr__(name):
+    # process_config is loaded on first use instead of at import time
+    if name == 'process_config':
+        return load_process_config()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def variant_suffix(trace_width, inner_radius, num_turns, spacing, merge=False):
+    # Output file suffix identifying an inductor variant, e.g. tw3.0_ir20.0_nt1_s8.0
+    suffix = f'tw{trace_width}_ir{inner_radius}_nt{num_turns}_s{spacing}'
+    if merge:
+        suffix += '_merged'
+    return suffix
+
+def _trace_segments(segments, radius, turns, vertex_angles):
+    # Per-vertex debug traces of the inductor segments, quadrant by quadrant
+    for segment_idx, points in enumerate(segments):
+        turn_idx, quad_idx = divmod(segment_idx, 4)
+        if quad_idx == 0:
+            logger.debug('turn_idx: %d', turn_idx)
+        logger.debug('quad_idx: %d', quad_idx)
+        angle_indices = list(range(3*quad_idx, 3*quad_idx + 4))
+        for point_idx, angle_idx in enumerate(angle_indices + angle_indices[::-1]):
+            edge = 'inner' if point_idx < 4 else 'outer'
+            angle = vertex_angles[angle_idx % len(vertex_angles)]
+            x2, y2 = points[point_idx]
+            logger.debug(
+                '%s vertex angle_idx: %d, angle: %s, radius: %s, fractional_turn_idx: %s',
+                edge, angle_idx, np.degrees(angle), radius[segment_idx, point_idx], turns[segment_idx, point_idx],
+                extra={'trace': {
+                    'turn_idx': turn_idx, 'quad_idx': quad_idx, 'angle_idx': angle_idx,
+                    'edge': edge, 'angle': angle, 'radius': radius[segment_idx, point_idx],
+                    'fractional_turn_idx': turns[segment_idx, point_idx], 'x': x2, 'y': y2,
+                }}
+            )
+        logger.debug('points: %s', np.around(points, 10))
+
+def generate_spiral_inductor(cell, trace_width, inner_radius, num_turns, guard_ring_distance, spacing, merge=False, cache=None, report=None):
     # Generates a spiral inductor with the given parameters
     # Define transition to be at bottom of octagon and entry/exit to be at top of octagon   
     
@@ -25,67 +64,82 @@ def generate_spiral_inductor(cell, trace_width, inner_radius, num_turns, guard_r
     #   num_turns: the number of turns in the spiral
     #   guard_ring_distance: the distance of the guard ring from the spiral 
     #   spacing: the spacing between the turns
+    #   merge: fuse the per-quadrant segments into a single outline
+    #   The layout backend (gdspy or gdstk) follows from the type of cell
+    #   cache: optional layout_cache.LayoutCache to load identical inductors from
+    #   report: optional diagnostics.RunReport to time the vertices and
+    #       polygons stages into and count the polygons in
+    if cache is not None:
+        return cache.generate(generate_spiral_inductor, cell, dict(
+            trace_width=trace_width, inner_radius=inner_radius, num_turns=num_turns,
+            guard_ring_distance=guard_ring_distance, spacing=spacing, merge=merge), {'report': report})
+    backend = backend_of(cell)
+    process_config = load_process_config()
 
-    POLYGON_OUTER_ANGLE = (POLYGON_NSIDES - 2) * np.pi / POLYGON_NSIDES
-    POLYGON_INNER_ANGLE = (np.pi - POLYGON_OUTER_ANGLE/2 - np.pi/2)*2
-    vertex_indices = np.arange(4, 4+(POLYGON_NSIDES*2)) % (POLYGON_NSIDES*2)
-    # Drop vertices that are multiple of 45 degrees
-    vertex_indices = vertex_indices[np.arange(0, len(vertex_indices)) % 4 != 2]
-    print(f'vertex_indices: {vertex_indices}')
-    vertex_angles = np.pi/POLYGON_NSIDES * vertex_indices
-
-    print(len(vertex_angles))
-    vertex_normalized_radius = np.ones_like(vertex_angles) 
-    vertex_normalized_radius[vertex_indices % 2 == 0] = np.cos(np.pi/8)
-   
-    print(f'vertex_angles: {np.degrees(vertex_angles)}')
+    debug = logger.isEnabledFor(logging.DEBUG)
+    vertex_angles = inductor_vertex_table(POLYGON_NSIDES)[0]
+    logger.debug('num vertex_angles: %d', len(vertex_angles))
+    if debug:
+        logger.debug('vertex_angles: %s', np.degrees(vertex_angles))
 
-    for turn_idx in range(num_turns):
-        print(f'\nturn_idx: {turn_idx}\n')
-        for quad_idx in range(4):
-            points = []
-            print(f'quad_idx: {quad_idx}')
-            for radius_modifier, stride in [(-trace_width/2, 1), (trace_width/2, -1)]:
-                if stride == 1:
-                    print(f'INNER:\n')
-                else:
-                    print(f'OUTER:\n')
-                for angle_idx in range(3*quad_idx, 3*quad_idx + 4)[::stride]:
-                    angle = vertex_angles[angle_idx % len(vertex_angles)]
-                    fractional_turn_idx = turn_idx+ quad_idx/4 + (angle_idx > (3*quad_idx+1))/4
-                    radius = (inner_radius + fractional_turn_idx * (spacing + trace_width) + radius_modifier)*vertex_normalized_radius[angle_idx % len(vertex_normalized_radius)]
-                    print(f'''angle_idx: {angle_idx},angle: {np.degrees(angle)}, radius: {radius},'''
-                          f'''turn_idx: {turn_idx}, quad_idx: {quad_idx}, fractional_turn_idx: {fractional_turn_idx}''')
-
-                    x2 = radius * np.cos(angle)#np.around(local_radius_x * np.cos(angle), 10)    
-                    y2 = radius * np.sin(angle) #np.around(local_radius_y * np.sin(angle), 10)
-                    points.append((x2, y2))
-            print(f'points: \n{np.around(np.array(points), 10)}')
-            segment = gdspy.Polygon(points, **process_config['M6'])
-            cell.add(segment)
+    with report_stage(report, 'vertices'):
+        # The unit spiral is cached per turn count (see octagon_geometry), so
+        # an inductor only scales and offsets it
+        cos, sin, normalized_radius, outer, turns = inductor_template(num_turns, POLYGON_NSIDES)
+        radius = (inner_radius + turns * (spacing + trace_width) + np.where(outer, trace_width/2, -trace_width/2))*normalized_radius
+        segments = list(np.stack([radius * cos, radius * sin], axis=-1))
+    if debug:
+        _trace_segments(segments, radius, turns, vertex_angles)
 
+    with report_stage(report, 'polygons'):
+        backend.add_polygons(cell, segments, merge=merge, **process_config['M6'])
+    if report is not None:
+        # Counted as generated, before any merging
+        report.count_polygons('M6', segments)
 
     
     #outer_radius = inner_radius + (num_turns - 1) * spacing
 if __name__ == "__main__":
-    # The GDSII file is called a library, which contains multiple cells.
-    lib = gdspy.GdsLibrary()
-    # Geometry must be placed in cells.
-    cell = lib.new_cell('spiral_inductor_python')
-
     parser = argparse.ArgumentParser(description='Generate a spiral inductor')
     parser.add_argument('--trace_width', type=float, default=DEFAULT_TRACE_WIDTH, help='Width of the spiral')
     parser.add_argument('--inner_radius', type=float, default=DEFAULT_INNER_RADIUS, help='Inner radius of the spiral')
     parser.add_argument('--num_turns', type=int, default=DEFAULT_NUM_TURNS, help='Number of turns in the spiral')
     parser.add_argument('--guard_ring_distance', type=float, default=DEFAULT_GUARD_RING_DISTANCE, help='Distance of the guard ring from the spiral')
     parser.add_argument('--spacing', type=float, default=DEFAULT_SPACING, help='Spacing between the turns')
+    parser.add_argument('--merge', action='store_true', default=False, help='Fuse the spiral into a single outline instead of per-quadrant segments')
+    add_output_arguments(parser)
+    add_verbosity_arguments(parser)
+    add_cache_arguments(parser)
     args = parser.parse_args()
+    configure_logging_from_args(args)
+    params = dict(
+        trace_width=args.trace_width, inner_radius=args.inner_radius, num_turns=args.num_turns,
+        guard_ring_distance=args.guard_ring_distance, spacing=args.spacing, merge=args.merge
+    )
+
+    report = RunReport() if args.report else None
+
+    def build():
+        backend = get_backend(args.backend)
+        # The GDSII file is called a library, which contains multiple cells.
+        lib = backend.new_library()
+        # Geometry must be placed in cells.
+        cell = backend.new_cell('spiral_inductor_python')
+        with report_stage(report, 'generate'):
+            generate_spiral_inductor(cell, **params, report=report)
+        backend.add_cell(lib, cell)
+        return lib, cell
+
+    # Save as GDS file and/or SVG file for visualization, reusing cached outputs if enabled
+    outputs, lib = write_outputs_cached(
+        cache_from_args(args), generate_spiral_inductor, params, build,
+        'spiral_inductor', args.formats, args.output_dir, report, args.backend
+    )
+    for output_file in outputs.values():
+        logger.info('Saved %s', output_file)
+    if report is not None:
+        logger.info('Report saved to %s', report.write(args.report))
 
-    generate_spiral_inductor(cell, args.trace_width, args.inner_radius, args.num_turns, args.guard_ring_distance, args.spacing)
-    # Save as GDS file
-    lib.write_gds('outputs/spiral_inductor.gds')
-    # Save as SVG file for visualization
-    cell.write_svg('outputs/ spiral_inductor.svg')
-    
     # Show the cell in a GUI window
-    gdspy.LayoutViewer(lib)
\ No newline at end of file
+    if not args.headless and (lib is not None or 'gds' in outputs):
+        show_layout(lib if lib is not None else outputs['gds'])
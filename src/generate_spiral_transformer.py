@@ -1,8 +1,12 @@
 import numpy as np
-import gdspy
 import argparse
-import json
-import os
+import logging
+
+from diagnostics import RunReport, add_verbosity_arguments, configure_logging_from_args, report_stage
+from layout_cache import add_cache_arguments, cache_from_args, write_outputs_cached
+from layout_backend import backend_of, get_backend
+from layout_io import add_output_arguments, load_process_config, shared_cell, show_layout
+from octagon_geometry import coil_template
 # using parameters from cadence initially:
 DEFAULT_TRACE_WIDTH = 3 #um
 DEFAULT_INNER_RADIUS = 20 #um
@@ -12,15 +16,84 @@ DEFAULT_SPACING = 5 #um
 POLYGON_NSIDES = 8 # Octagon
 DEFAULT_VIA_SIDE_LENGTH = 0.36 #um
 DEFAULT_VIA_SPACING = 1.06 #um
+DEFAULT_VIA_ENCLOSURE = 0.1 #um, without a via enclosure rule in the process config
 DEFAULT_ENTRY_EXIT_DISTANCE = 10 #um
 
-process_config = json.load(open(os.path.join(os.path.dirname(__file__), 'configs/my_process.json')))
-print(process_config)
+logger = logging.getLogger(__name__)
+
+def __getattr__(name):
+    # process_config is loaded on first use instead of at import time
+    if name == 'process_config':
+        return load_process_config()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def variant_suffix(trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True, add_entry_exit_traces=True, include_vias=True, merge=False):
+    # Output file suffix identifying a transformer variant, e.g. tw3.0_ir20.0_nt3_s5.0
+    suffix = f'tw{trace_width}_ir{inner_radius}_nt{num_turns}_s{spacing}'
+    if not opposite_side_entry:
+        suffix += '_sameside'
+    if not add_entry_exit_traces:
+        suffix += '_noentryexit'
+    if not include_vias:
+        suffix += '_novias'
+    if merge:
+        suffix += '_merged'
+    return suffix
+
+def get_via_cell(via_side_length=DEFAULT_VIA_SIDE_LENGTH, backend=None):
+    # Single via cell per via size and layout backend, shared by every via
+    # array reference. Libraries that contain a transformer cell must
+    # include it, e.g. with lib.add(cell, include_dependencies=True).
+    backend = backend or get_backend()
+    def build(via_cell):
+        backend.add(via_cell, backend.rectangle(
+            (-via_side_length/2, -via_side_length/2),
+            (via_side_length/2, via_side_length/2),
+            **load_process_config()['vias']
+        ))
+    return shared_cell(f'via_{round(via_side_length*1000)}nm', build, backend)
+
+def via_enclosure(process_config=None):
+    # Metal enclosure the via arrays keep from the trace edges: the largest
+    # via enclosure rule of the process config, or the default without rules
+    process_config = process_config or load_process_config()
+    via_rules = process_config.get('rules', {}).get('vias', {})
+    enclosures = [*via_rules.get('enclosure', {}).values(), *via_rules.get('interacting_enclosure', {}).values()]
+    return max(enclosures, default=DEFAULT_VIA_ENCLOSURE)
+
+def via_array_size(trace_width, via_side_length=DEFAULT_VIA_SIDE_LENGTH, via_spacing=DEFAULT_VIA_SPACING, enclosure=None):
+    # Number of vias per row/column across a trace of the given width: every
+    # via takes one via_spacing pitch of the width inside the enclosure on
+    # both trace edges (2x2 for the default 3 um trace), and at least one via
+    # is placed. Raises ValueError if not even one enclosed via fits.
+    enclosure = via_enclosure() if enclosure is None else enclosure
+    available = trace_width - 2*enclosure
+    count = max(1, int(np.floor(available/via_spacing + 1e-9)))
+    if (count - 1)*via_spacing + via_side_length > available + 1e-9:
+        raise ValueError(
+            f'A {trace_width} um trace cannot enclose a {via_side_length} um via by {enclosure} um on both sides')
+    return count
+
+def coil_segment_points(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, coil_idx):
+    # Outline points of every quadrant segment of one transformer coil, turn
+    # by turn. Each segment runs counterclockwise along the inner edge of the
+    # trace over one octagon quadrant and back along its outer edge (5 points
+    # each); the quadrant where the coil steps out ends on the next turn.
+    # The unit coil template is cached per turn count and entry mode, so a
+    # coil only scales and offsets it (see octagon_geometry).
+    logger.debug('coil_idx: %d', coil_idx)
+    cos, sin, normalized_radius, odd, outer, step, pitch = coil_template(num_turns, coil_idx, opposite_side_entry)
+    octagon_inner_radius = (inner_radius + pitch * (spacing + trace_width))*normalized_radius
+    octagon_outer_radius = octagon_inner_radius + np.where(odd, trace_width/np.cos(np.pi/8), trace_width)
+    local_radius = np.where(outer, octagon_outer_radius, octagon_inner_radius)
+    y_modifier = 2*(spacing+trace_width)*step
+    return list(np.stack([local_radius * cos, (local_radius + y_modifier) * sin], axis=-1))
+
 def generate_spiral_transformer(
     cell, trace_width, inner_radius,
     num_turns, guard_ring_distance,
     spacing, opposite_side_entry, add_entry_exit_traces,
-    include_vias):
+    include_vias, merge=False, cache=None, report=None):
     # Generates a spiral transformer with the given parameters
     # Define transition to be at bottom of octagon and entry/exit to be at top of octagon   
     
@@ -32,76 +105,46 @@ def generate_spiral_transformer(
     #   num_turns: the number of turns in the spiral
     #   guard_ring_distance: the distance of the guard ring from the spiral 
     #   spacing: the spacing between the turns
+    #   merge: fuse each coil and the entry/exit traces into single outlines
+    #       per layer instead of per-quadrant segments
+    #   cache: optional layout_cache.LayoutCache to load identical transformers from
+    #   report: optional diagnostics.RunReport to time the vertices, vias and
+    #       polygons stages into and count the polygons per layer in
+    #   The layout backend (gdspy or gdstk) follows from the type of cell
+    if cache is not None:
+        return cache.generate(generate_spiral_transformer, cell, dict(
+            trace_width=trace_width, inner_radius=inner_radius, num_turns=num_turns,
+            guard_ring_distance=guard_ring_distance, spacing=spacing,
+            opposite_side_entry=opposite_side_entry, add_entry_exit_traces=add_entry_exit_traces,
+            include_vias=include_vias, merge=merge), {'report': report})
+    backend = backend_of(cell)
+    process_config = load_process_config()
 
-    POLYGON_OUTER_ANGLE = (POLYGON_NSIDES - 2) * np.pi / POLYGON_NSIDES
-    POLYGON_INNER_ANGLE = (np.pi - POLYGON_OUTER_ANGLE/2 - np.pi/2)*2
-    vertex_angles = np.arange(np.pi/2, 2*np.pi+np.pi/2, POLYGON_INNER_ANGLE/2)
-    vertex_normalized_radius = np.ones_like(vertex_angles) 
-    vertex_normalized_radius[np.arange(0, len(vertex_angles)) % 2 == 0] = np.cos(np.pi/8)
-    def generate_via_polygons(x, y, number_of_x_vias=2, number_of_y_vias=2, via_side_length=DEFAULT_VIA_SIDE_LENGTH, via_spacing=DEFAULT_VIA_SPACING):
-        for nx in range(number_of_x_vias):
-            for ny in range(number_of_y_vias):
-                xx = x + (nx-(number_of_x_vias-1)/2)*via_spacing
-                yy = y + (ny-(number_of_y_vias-1)/2)*via_spacing
-                # via_points = np.array([
-                #     (xx+via_side_length/2, yy+via_side_length/2),
-                #     (xx+via_side_length/2, yy-via_side_length/2),
-                #     (xx-via_side_length/2, yy-via_side_length/2),
-                #     (xx-via_side_length/2, yy+via_side_length/2),
-                # ])
-                # segment = gdspy.Polygon(via_points, **process_config['vias'])
-                segment = gdspy.Rectangle(
-                    point1=(xx-via_side_length/2, yy-via_side_length/2), 
-                    point2=(xx+via_side_length/2, yy+via_side_length/2), 
-                    **process_config['vias']
-                )
-                cell.add(segment)  
+    def generate_via_polygons(x, y, number_of_x_vias=None, number_of_y_vias=None, via_side_length=DEFAULT_VIA_SIDE_LENGTH, via_spacing=DEFAULT_VIA_SPACING):
+        # Place a via array centered on (x, y) as a single reference to the shared via cell
+        if number_of_x_vias is None:
+            number_of_x_vias = via_array_size(trace_width, via_side_length, via_spacing)
+        if number_of_y_vias is None:
+            number_of_y_vias = via_array_size(trace_width, via_side_length, via_spacing)
+        with report_stage(report, 'vias'):
+            via_array = backend.cell_array(
+                get_via_cell(via_side_length, backend),
+                columns=number_of_x_vias,
+                rows=number_of_y_vias,
+                spacing=(via_spacing, via_spacing),
+                origin=(x-(number_of_x_vias-1)/2*via_spacing, y-(number_of_y_vias-1)/2*via_spacing)
+            )
+            backend.add(cell, via_array)
+        if report is not None:
+            report.count('vias', number_of_x_vias*number_of_y_vias, 4*number_of_x_vias*number_of_y_vias)
+    # Polygons are collected per layer and added at the end, merged if requested
+    coil_segments = []
+    trace_segments = []
     for coil_idx in range(2):
-        for turn_idx in range(num_turns):
-            turn_inner_radius = inner_radius + (2*turn_idx + coil_idx) * (spacing + trace_width)
-            quad_range = range(4)
-            if turn_idx == 0:
-                print(f'coil_idx: {coil_idx}')
-            if opposite_side_entry and coil_idx == 1 and turn_idx == 0:
-                quad_range = [0,1]
-            elif opposite_side_entry and coil_idx == 1 and turn_idx == num_turns - 1:
-                quad_range = [2,3]
-            for quad_idx in quad_range:
-                points = []
-                for radius, stride in [('inner', 1), ('outer', -1)]:
-                    for angle_idx in range(4*quad_idx, 4*quad_idx + 5)[::stride]:
-                        original_angle_idx = angle_idx
-                        if opposite_side_entry and coil_idx == 1:
-                            angle_idx = angle_idx + len(vertex_angles)//2
-                        angle = vertex_angles[angle_idx % len(vertex_angles)]
-                        octagon_radius = vertex_normalized_radius[angle_idx % len(vertex_normalized_radius)]
-                        octagon_inner_radius = turn_inner_radius*vertex_normalized_radius[angle_idx % len(vertex_normalized_radius)]
-                        #print(f'angle_idx: {angle_idx}, angle {angle}, angled {np.degrees(angle)}')
-                        if angle_idx % 2 == 1:
-                            octagon_outer_radius = octagon_inner_radius + trace_width/np.cos(np.pi/8)
-                        else:
-                         octagon_outer_radius = octagon_inner_radius + trace_width
-                        y_modifier = 0
-                        if quad_idx == 3 and angle_idx >= 4*quad_idx  and (coil_idx == 0 or not opposite_side_entry):
-                            y_modifier = 2*(spacing+trace_width)
-                            if angle_idx == len(vertex_angles):
-                                y_modifier = 2*(spacing+trace_width)*np.cos(np.pi/8) 
-                        elif opposite_side_entry and coil_idx == 1 and quad_idx == 1 and angle_idx > 4*quad_idx:
-                            y_modifier = 2*(spacing+trace_width)
-                            if angle_idx == len(vertex_angles):
-                                y_modifier = 2*(spacing+trace_width)*np.cos(np.pi/8)                             
-                        if radius == 'inner':
-                            local_radius_x = octagon_inner_radius
-                            local_radius_y = octagon_inner_radius + y_modifier
-                        else:
-                            local_radius_x = octagon_outer_radius
-                            local_radius_y = octagon_outer_radius + y_modifier
-                        x2 = local_radius_x * np.cos(angle)   
-                        y2 = local_radius_y * np.sin(angle)
-                        points.append((x2, y2))
-                if coil_idx == 0:
-                    segment = gdspy.Polygon(points, **process_config['M6'])
-                    cell.add(segment)
+        with report_stage(report, 'vertices'):
+            segments = coil_segment_points(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, coil_idx)
+        if coil_idx == 0:
+            coil_segments.extend(segments)
         # Draw entry/exit traces:
         if add_entry_exit_traces and opposite_side_entry:
             COS_PI_8 = np.cos(np.pi/8)
@@ -129,8 +172,7 @@ def generate_spiral_transformer(
                 coil_points = rectangle_points.copy()
                 coil_points[:,0] += coil_entry[0]
                 coil_points[:,1] += coil_entry[1]
-                segment = gdspy.Polygon(coil_points, **process_config['M5'])
-                cell.add(segment)
+                trace_segments.append(coil_points)
                 if include_vias:
                     generate_via_polygons(x=coil_entry[0], y=coil_entry[1])
             
@@ -152,15 +194,16 @@ def generate_spiral_transformer(
                 coil_1_exit, y_direction=-1, 
                 rectangle_length=(max_radius-np.abs(coil_1_exit[1])+DEFAULT_ENTRY_EXIT_DISTANCE)
             )   
- 
+
+    for segments, layer_name in [(coil_segments, 'M6'), (trace_segments, 'M5')]:
+        with report_stage(report, 'polygons'):
+            backend.add_polygons(cell, segments, merge=merge, **process_config[layer_name])
+        if report is not None:
+            # Counted as generated, before any merging
+            report.count_polygons(layer_name, segments)
             
     #outer_radius = inner_radius + (num_turns - 1) * spacing
 if __name__ == "__main__":
-    # The GDSII file is called a library, which contains multiple cells.
-    lib = gdspy.GdsLibrary()
-    # Geometry must be placed in cells.
-
-
     parser = argparse.ArgumentParser(description='Generate a spiral transformer')
     parser.add_argument('--trace_width', type=float, default=DEFAULT_TRACE_WIDTH, help='Width of the spiral')
     parser.add_argument('--inner_radius', type=float, default=DEFAULT_INNER_RADIUS, help='Inner radius of the spiral')
@@ -170,28 +213,53 @@ if __name__ == "__main__":
     parser.add_argument('--same_side_entry', action='store_true', default=False, help='Whether to have the second coil enter from the opposite side')
     parser.add_argument('--no_entry_exit_traces', action='store_true', default=False, help='Do not add entry/exit traces')
     parser.add_argument('--no_vias', action='store_true', default=False, help='Do not add vias')
+    parser.add_argument('--merge', action='store_true', default=False, help='Fuse each coil into a single outline instead of per-quadrant segments')
+    add_output_arguments(parser)
+    add_verbosity_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
-        
-    if args.no_vias:
-        cell = lib.new_cell('spiral_transformer_novias')
-    else:
-        cell = lib.new_cell('spiral_transformer_python')
-    generate_spiral_transformer(
-        cell, args.trace_width, args.inner_radius,
-        args.num_turns, args.guard_ring_distance,
-        args.spacing, not args.same_side_entry, not args.no_entry_exit_traces, not args.no_vias
+    configure_logging_from_args(args)
+    logger.debug('args: %s', args)
+    params = dict(
+        trace_width=args.trace_width, inner_radius=args.inner_radius,
+        num_turns=args.num_turns, guard_ring_distance=args.guard_ring_distance,
+        spacing=args.spacing, opposite_side_entry=not args.same_side_entry,
+        add_entry_exit_traces=not args.no_entry_exit_traces, include_vias=not args.no_vias,
+        merge=args.merge
     )
-    suffix = f'tw{args.trace_width}_ir{args.inner_radius}_nt{args.num_turns}_s{args.spacing}'
-    print(args)
-    if args.no_vias:
-        print('novias!')
-        suffix+='_novias'
-    # Save as GDS file
-    lib.write_gds(f'{os.path.join(os.path.dirname(__file__), "..", "outputs", f"spiral_transformer.{suffix}.gds")}')
-    print(f'{os.path.join(os.path.dirname(__file__), "..", "outputs", f"spiral_transformer.{suffix}.gds")}')
-    # Save as SVG file for visualization
-    cell.write_svg(f'{os.path.join(os.path.dirname(__file__), "..", "outputs", f"spiral_transformer.{suffix}.svg")}')
-    
+
+    report = RunReport() if args.report else None
+
+    def build():
+        backend = get_backend(args.backend)
+        # The GDSII file is called a library, which contains multiple cells.
+        lib = backend.new_library()
+        # Geometry must be placed in cells.
+        if args.no_vias:
+            cell = backend.new_cell('spiral_transformer_novias')
+        else:
+            cell = backend.new_cell('spiral_transformer_python')
+        with report_stage(report, 'generate'):
+            generate_spiral_transformer(cell, **params, report=report)
+        # Via arrays reference a shared via cell that must be written too
+        backend.add_cell(lib, cell, include_dependencies=True)
+        return lib, cell
+
+    suffix = variant_suffix(
+        args.trace_width, args.inner_radius, args.num_turns, args.spacing,
+        not args.same_side_entry, not args.no_entry_exit_traces, not args.no_vias, args.merge
+    )
+    # Save as GDS file and/or SVG file for visualization, reusing cached outputs if enabled
+    outputs, lib = write_outputs_cached(
+        cache_from_args(args), generate_spiral_transformer, params, build,
+        f'spiral_transformer.{suffix}', args.formats, args.output_dir, report, args.backend
+    )
+    for output_file in outputs.values():
+        logger.info('Saved %s', output_file)
+    if report is not None:
+        logger.info('Report saved to %s', report.write(args.report))
+
     # Show the cell in a GUI window
-    gdspy.LayoutViewer(lib)
+    if not args.headless and (lib is not None or 'gds' in outputs):
+        show_layout(lib if lib is not None else outputs['gds'])
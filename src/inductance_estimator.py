@@ -0,0 +1,265 @@
+import argparse
+import json
+import numpy as np
+
+import generate_spiral_inductor
+import generate_spiral_transformer
+from transformer_aoki_equations import design_grid
+
+MU_0 = 4e-7*np.pi
+UM = 1e-6
+COS_PI_8 = np.cos(np.pi/8)
+
+# Layout-dependent coefficients from Mohan et al., "Simple Accurate
+# Expressions for Planar Spiral Inductances", JSSC 1999
+WHEELER_COEFFICIENTS = {
+    # K1, K2
+    'square': (2.34, 2.75),
+    'hexagonal': (2.33, 3.82),
+    'octagonal': (2.25, 3.55),
+}
+CURRENT_SHEET_COEFFICIENTS = {
+    # c1, c2, c3, c4
+    'square': (1.27, 2.07, 0.18, 0.13),
+    'hexagonal': (1.09, 2.23, 0.00, 0.17),
+    'octagonal': (1.07, 2.29, 0.00, 0.19),
+}
+ESTIMATORS = ('wheeler', 'current_sheet')
+DEFAULT_THICKNESS = 2 #um, top metal thickness
+# Geometric mean distance of a rectangular cross section over its perimeter w + t
+GMD_PERIMETER_RATIO = 0.2235
+# Radius of the circle with the perimeter of an octagon of unit apothem
+OCTAGON_PERIMETER_RADIUS = 8*np.tan(np.pi/8)/np.pi
+# Gauss-Legendre points of the half loop mutual inductance integral
+HALF_LOOP_ORDER = 64
+# Fewest turns, by opposite_side_entry, for which transformer_coupling is
+# within 0.05 of filament_inductance.transformer_inductance (checked over
+# trace widths and spacings of 2-15 um and inner radii of 10-100 um). A
+# single turn with opposite side entry leaves coil 1 a stepped half turn,
+# whose k the loop model overestimates by up to 0.14.
+COUPLING_MIN_TURNS = {True: 2, False: 1}
+
+
+def modified_wheeler_inductance(num_turns, d_out, d_in, shape='octagonal'):
+    # Modified Wheeler inductance in H of a planar spiral; diameters in um
+    K1, K2 = WHEELER_COEFFICIENTS[shape]
+    d_out, d_in = np.asarray(d_out, dtype=float)*UM, np.asarray(d_in, dtype=float)*UM
+    d_avg = (d_out + d_in)/2
+    fill_ratio = (d_out - d_in)/(d_out + d_in)
+    return K1*MU_0*np.asarray(num_turns, dtype=float)**2*d_avg/(1 + K2*fill_ratio)
+
+
+def current_sheet_inductance(num_turns, d_out, d_in, shape='octagonal'):
+    # Current sheet inductance in H of a planar spiral; diameters in um
+    c1, c2, c3, c4 = CURRENT_SHEET_COEFFICIENTS[shape]
+    d_out, d_in = np.asarray(d_out, dtype=float)*UM, np.asarray(d_in, dtype=float)*UM
+    d_avg = (d_out + d_in)/2
+    fill_ratio = (d_out - d_in)/(d_out + d_in)
+    return (
+        MU_0*np.asarray(num_turns, dtype=float)**2*d_avg*c1/2
+        * (np.log(c2/fill_ratio) + c3*fill_ratio + c4*fill_ratio**2)
+    )
+
+
+def spiral_inductance(num_turns, d_out, d_in, method='wheeler', shape='octagonal'):
+    if method == 'wheeler':
+        return modified_wheeler_inductance(num_turns, d_out, d_in, shape)
+    if method == 'current_sheet':
+        return current_sheet_inductance(num_turns, d_out, d_in, shape)
+    raise ValueError(f'Unknown inductance estimator {method!r}, expected one of {ESTIMATORS}')
+
+
+def spiral_inductor_dimensions(trace_width, inner_radius, num_turns, spacing):
+    """
+    Flat-to-flat outer and inner diameters in um of the octagon drawn by
+    generate_spiral_inductor. Its trace centerline grows continuously from
+    inner_radius by one pitch per turn, so the turn-averaged innermost and
+    outermost centerlines sit half a pitch inside the ends of the spiral.
+    """
+    trace_width, inner_radius, num_turns, spacing = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (trace_width, inner_radius, num_turns, spacing)))
+    pitch = spacing + trace_width
+    d_in = 2*COS_PI_8*(inner_radius + pitch/2 - trace_width/2)
+    d_out = 2*COS_PI_8*(inner_radius + (num_turns - 1/2)*pitch + trace_width/2)
+    return d_out, d_in
+
+
+def spiral_transformer_coil_dimensions(trace_width, inner_radius, num_turns, spacing, coil_idx, opposite_side_entry=True):
+    """
+    Number of turns and flat-to-flat outer and inner diameters in um of one
+    coil of generate_spiral_transformer. The two coils are interleaved, so
+    each coil's turns are two pitches apart and coil 1 starts one pitch out.
+    With opposite side entry coil 1 drops its first and last half turn.
+    """
+    trace_width, inner_radius, num_turns, spacing = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (trace_width, inner_radius, num_turns, spacing)))
+    pitch = spacing + trace_width
+    d_in = 2*COS_PI_8*(inner_radius + coil_idx*pitch)
+    d_out = 2*(COS_PI_8*(inner_radius + (2*(num_turns - 1) + coil_idx)*pitch) + trace_width)
+    turns = num_turns
+    if coil_idx == 1 and opposite_side_entry:
+        turns = np.where(num_turns > 1, num_turns - 1, 0.5)
+    return turns, d_out, d_in
+
+
+def estimate_spiral_inductor(trace_width, inner_radius, num_turns, spacing, method='wheeler'):
+    """
+    Inductance in H of generate_spiral_inductor geometries. Parameters are the
+    generator's (um) and broadcast, so whole sweep grids evaluate at once.
+    """
+    d_out, d_in = spiral_inductor_dimensions(trace_width, inner_radius, num_turns, spacing)
+    return spiral_inductance(num_turns, d_out, d_in, method)
+
+
+def _elliptic_integrals(m):
+    # Complete elliptic integrals K(m) and E(m) by the arithmetic-geometric
+    # mean, converged to double precision for m up to 1 - 1e-12
+    a, b = np.ones_like(m), np.sqrt(1 - m)
+    total, scale = m/2, 0.5
+    for _ in range(7):
+        a, b, c = (a + b)/2, np.sqrt(a*b), (a - b)/2
+        scale *= 2
+        total = total + scale*c**2
+    K = np.pi/(2*a)
+    return K, K*(1 - total)
+
+
+def loop_mutual_inductance(a, b):
+    # Mutual inductance in H of coplanar concentric circular loops with radii
+    # a and b in m (Maxwell's formula)
+    m = 4*a*b/(a + b)**2
+    K, E = _elliptic_integrals(m)
+    k = np.sqrt(m)
+    return MU_0*np.sqrt(a*b)*((2/k - k)*K - 2/k*E)
+
+
+def half_loop_mutual_inductance(a, b):
+    # Mutual inductance in H between opposite halves of coplanar concentric
+    # circular loops with radii a and b in m, both running the same way
+    # around (negative). The Neumann integral over both half circles
+    # reduces to one over their angle difference, weighted by its overlap.
+    x, w = np.polynomial.legendre.leggauss(HALF_LOOP_ORDER)
+    angle = (x + 1)*np.pi/2
+    a, b = np.asarray(a, dtype=float)[..., np.newaxis], np.asarray(b, dtype=float)[..., np.newaxis]
+    distance = np.sqrt(a**2 + b**2 - 2*a*b*np.cos(angle))
+    return MU_0*(a*b)[..., 0]/4*np.sum(w*angle*np.cos(angle)/distance, axis=-1)
+
+
+def _coupling(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, thickness):
+    # transformer_coupling of 1D arrays of geometries with the same number of turns
+    pitch = spacing + trace_width
+    # Loop radius of every turn centerline from the inside out; coil 0 has
+    # the even and coil 1 the odd ones
+    radius = ((inner_radius + np.arange(2*num_turns)[:, np.newaxis]*pitch)*COS_PI_8 + trace_width/2)*OCTAGON_PERIMETER_RADIUS*UM
+    gmd = GMD_PERIMETER_RATIO*(trace_width + thickness)*UM
+    # Fraction of each turn drawn: with opposite side entry coil 1 starts
+    # and ends with a half turn
+    weight = np.ones((2*num_turns, 1))
+    halves = []
+    if opposite_side_entry:
+        halves = [1, 2*num_turns - 1] if num_turns > 1 else [1]
+        weight[halves] = 0.5
+    L1, L2, M = 0, 0, 0
+    # Turn pairs by their distance in the interleaved order: odd distances
+    # couple the coils, even ones add to a self inductance. A turn with
+    # itself is two loops one GMD of its cross section apart.
+    for offset in range(2*num_turns):
+        inner, outer = radius[:2*num_turns - offset], radius[offset:]
+        mutual = loop_mutual_inductance(inner, inner - gmd if offset == 0 else outer)
+        mutual = mutual*weight[:2*num_turns - offset]*weight[offset:]
+        if offset % 2:
+            M = M + mutual.sum(axis=0)
+        else:
+            L1 = L1 + (1 if offset == 0 else 2)*mutual[0::2].sum(axis=0)
+            L2 = L2 + (1 if offset == 0 else 2)*mutual[1::2].sum(axis=0)
+    # Weighting by the drawn fraction is exact between a half and a full
+    # turn, but not for a half turn with itself or with the opposite half
+    for idx in halves:
+        a = radius[idx]
+        L2 = L2 + loop_mutual_inductance(a, a - gmd)/4 - half_loop_mutual_inductance(a, a - gmd)
+    if len(halves) == 2:
+        a, b = radius[halves[0]], radius[halves[1]]
+        L2 = L2 + 2*(half_loop_mutual_inductance(a, b) - loop_mutual_inductance(a, b)/4)
+    return M/np.sqrt(L1*L2)
+
+
+def transformer_coupling(trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True, thickness=DEFAULT_THICKNESS):
+    """
+    Coupling coefficient of the two interleaved coils of
+    generate_spiral_transformer geometries. Parameters are the generator's
+    (um) and broadcast.
+
+    Every turn is a circular loop with the perimeter of its octagon
+    centerline, so the self and mutual inductances are sums of loop mutual
+    inductances. The loops are concentric, which ignores the step of each
+    turn and the entry/exit traces. The loop radius and the GMD of the
+    trace cross section were chosen against filament_inductance; see
+    COUPLING_MIN_TURNS for the turn range where the two agree.
+    """
+    trace_width, inner_radius, num_turns, spacing = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (trace_width, inner_radius, num_turns, spacing)))
+    k = np.empty(trace_width.shape)
+    for turns in np.unique(num_turns):
+        group = num_turns == turns
+        k[group] = _coupling(
+            trace_width[group], inner_radius[group], int(turns), spacing[group], opposite_side_entry, thickness)
+    return k[()]
+
+
+def estimate_spiral_transformer(trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True, method='wheeler', thickness=DEFAULT_THICKNESS):
+    """
+    Self inductances, mutual inductance and coupling of the two interleaved
+    coils of generate_spiral_transformer geometries. Parameters are the
+    generator's (um) and broadcast, so whole sweep grids evaluate at once.
+
+    The self inductances use the spiral expression of each coil; the
+    coupling comes from transformer_coupling and M = k*sqrt(L1*L2).
+
+    Returns a dictionary with 'L1', 'L2', 'M' (H) and 'k'.
+    """
+    L1, L2 = estimate_transformer_coils(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, method)
+    k = transformer_coupling(trace_width, inner_radius, num_turns, spacing, opposite_side_entry, thickness)
+    return {'L1': L1, 'L2': L2, 'M': k*np.sqrt(L1*L2), 'k': k}
+
+
+def estimate_transformer_coils(trace_width, inner_radius, num_turns, spacing, opposite_side_entry=True, method='wheeler'):
+    # Self inductances in H of both coils of generate_spiral_transformer geometries
+    return tuple(
+        spiral_inductance(*spiral_transformer_coil_dimensions(
+            trace_width, inner_radius, num_turns, spacing, coil_idx, opposite_side_entry), method)
+        for coil_idx in range(2)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Estimate spiral inductances from generator parameters over a grid')
+    parser.add_argument('--generator', choices=['transformer', 'inductor'], default='transformer', help='Which generator geometry to estimate')
+    parser.add_argument('--trace_width', type=float, nargs='+', default=[generate_spiral_transformer.DEFAULT_TRACE_WIDTH], help='Trace width(s) in um')
+    parser.add_argument('--inner_radius', type=float, nargs='+', default=[generate_spiral_transformer.DEFAULT_INNER_RADIUS], help='Inner radius(es) in um')
+    parser.add_argument('--num_turns', type=int, nargs='+', default=None, help='Number(s) of turns')
+    parser.add_argument('--spacing', type=float, nargs='+', default=None, help='Turn spacing(s) in um')
+    parser.add_argument('--same_side_entry', action='store_true', default=False, help='Transformer only: second coil enters from the same side')
+    parser.add_argument('--method', choices=ESTIMATORS, default='wheeler', help='Inductance expression')
+    parser.add_argument('--json', type=str, default=None, help='Write the grid and estimates to this JSON file')
+    args = parser.parse_args()
+
+    module = generate_spiral_transformer if args.generator == 'transformer' else generate_spiral_inductor
+    grid = design_grid(
+        trace_width=args.trace_width,
+        inner_radius=args.inner_radius,
+        num_turns=args.num_turns or [module.DEFAULT_NUM_TURNS],
+        spacing=args.spacing or [module.DEFAULT_SPACING],
+    )
+    if args.generator == 'transformer':
+        estimates = estimate_spiral_transformer(**grid, opposite_side_entry=not args.same_side_entry, method=args.method)
+    else:
+        estimates = {'L': estimate_spiral_inductor(**grid, method=args.method)}
+
+    arrays = np.broadcast_arrays(*grid.values(), *estimates.values())
+    columns = {name: np.ravel(values) for name, values in zip([*grid, *estimates], arrays)}
+    print(' '.join(f'{name:>12}' for name in columns))
+    for row in zip(*columns.values()):
+        print(' '.join(f'{value:12.4g}' for value in row))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({name: values.tolist() for name, values in columns.items()}, f, indent=2)
@@ -0,0 +1,302 @@
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from drc import check_cell, load_rules
+from inductance_estimator import (
+    COUPLING_MIN_TURNS, ESTIMATORS, estimate_transformer_coils, spiral_transformer_coil_dimensions, transformer_coupling
+)
+from transformer_aoki_equations import DEFAULT_CL, DEFAULT_F, DEFAULT_K, DEFAULT_N, aoki_inductances
+
+logger = logging.getLogger(__name__)
+
+# Search bounds (um, turns) used where the process rules set no limit
+DEFAULT_MAX_TRACE_WIDTH = 15
+DEFAULT_MAX_SPACING = 15
+DEFAULT_INNER_RADIUS_RANGE = (10, 100)
+DEFAULT_NUM_TURNS_RANGE = (1, 10)
+DEFAULT_STEPS = 40
+DEFAULT_TOP = 10
+# Candidates evaluated per batch (and per worker task)
+BATCH_SIZE = 200_000
+# Weight of the absolute coupling error relative to the inductance errors
+K_WEIGHT = 1.0
+# Candidates whose coupling is evaluated at a time while ranking
+COUPLING_CHUNK_SIZE = 4096
+# Ranked candidates checked against the design rules per requested
+# geometry, doubled until enough of them pass
+DRC_CANDIDATE_FACTOR = 4
+
+
+def search_space(trace_width=None, spacing=None, inner_radius=DEFAULT_INNER_RADIUS_RANGE,
+                 num_turns=DEFAULT_NUM_TURNS_RANGE, steps=DEFAULT_STEPS, process_config=None):
+    """
+    1D value arrays of every searched parameter. Continuous parameters take
+    steps values between their (min, max) bounds, the number of turns every
+    integer in its range. The trace width and spacing lower bounds default
+    to the M6 min_width and min_spacing process rules.
+    """
+    rules = load_rules(process_config).get('M6', {})
+    trace_width = trace_width or (rules.get('min_width', 1), DEFAULT_MAX_TRACE_WIDTH)
+    spacing = spacing or (rules.get('min_spacing', 1), DEFAULT_MAX_SPACING)
+    return {
+        'trace_width': np.linspace(*trace_width, steps),
+        'spacing': np.linspace(*spacing, steps),
+        'inner_radius': np.linspace(*inner_radius, steps),
+        'num_turns': np.arange(num_turns[0], num_turns[1] + 1),
+    }
+
+
+def design_error(estimates, L1, L2, k=None):
+    # Sum of relative inductance errors plus the weighted coupling error
+    error = np.abs(estimates['L1']/L1 - 1) + np.abs(estimates['L2']/L2 - 1)
+    if k is not None:
+        error = error + K_WEIGHT*np.abs(estimates['k'] - k)
+    return error
+
+
+def _add_coupling_error(candidates, estimates, error, k, opposite_side_entry, top):
+    # Add the weighted coupling error to the inductance errors. The coupling
+    # model costs far more than the inductance expressions, so it is only
+    # evaluated in order of increasing inductance error until that alone is
+    # worse than the top-th best total error: the coupling error is never
+    # negative, so the candidates left out could not rank. Fills in
+    # estimates['k'] where it was evaluated.
+    total = np.full(len(error), np.inf)
+    order = np.argsort(error, kind='stable')
+    bound = np.inf
+    for start in range(0, len(order), COUPLING_CHUNK_SIZE):
+        chunk = order[start:start + COUPLING_CHUNK_SIZE]
+        chunk = chunk[error[chunk] <= bound]
+        if not len(chunk) or not np.isfinite(error[chunk[0]]):
+            break
+        estimates['k'][chunk] = transformer_coupling(
+            *(candidates[name][chunk] for name in ('trace_width', 'inner_radius', 'num_turns', 'spacing')),
+            opposite_side_entry)
+        total[chunk] = error[chunk] + K_WEIGHT*np.abs(estimates['k'][chunk] - k)
+        if len(total) >= top:
+            bound = np.partition(total, top - 1)[top - 1]
+    return total
+
+
+def evaluate_batch(candidates, L1, L2, k=None, opposite_side_entry=True, method='wheeler', max_outer_diameter=None, top=DEFAULT_TOP):
+    """
+    Estimate one batch of candidate geometries and keep the best ones.
+
+    candidates is a dictionary of equally long 1D arrays with trace_width,
+    spacing, inner_radius and num_turns. Returns the top candidates as a
+    dictionary of arrays including the estimates, 'd_out' and 'error'.
+    When matching a coupling k, candidates with fewer turns than
+    COUPLING_MIN_TURNS are rejected, since the coupling model is not
+    accurate enough for them to be ranked on it.
+    """
+    geometry = [candidates[name] for name in ('trace_width', 'inner_radius', 'num_turns', 'spacing')]
+    coil_L1, coil_L2 = estimate_transformer_coils(*geometry, opposite_side_entry, method)
+    estimates = {'L1': coil_L1, 'L2': coil_L2, 'k': np.full(len(coil_L1), np.nan)}
+    _, d_out, _ = spiral_transformer_coil_dimensions(*geometry, 1, opposite_side_entry)
+    error = design_error(estimates, L1, L2)
+    if max_outer_diameter is not None:
+        error = np.where(d_out <= max_outer_diameter, error, np.inf)
+    if k is not None:
+        # Only rank the coupling of geometries the coupling model covers
+        error = np.where(candidates['num_turns'] >= COUPLING_MIN_TURNS[opposite_side_entry], error, np.inf)
+        error = _add_coupling_error(candidates, estimates, error, k, opposite_side_entry, top)
+    # Ties (e.g. equal errors) prefer the smaller footprint
+    keep = np.argpartition(error, min(top, len(error)) - 1)[:top] if len(error) > top else np.arange(len(error))
+    keep = keep[np.lexsort((d_out[keep], error[keep]))]
+    keep = keep[np.isfinite(error[keep])]
+    estimates = {name: values[keep] for name, values in estimates.items()}
+    if k is None:
+        estimates['k'] = transformer_coupling(*(values[keep] for values in geometry), opposite_side_entry)
+    estimates['M'] = estimates['k']*np.sqrt(estimates['L1']*estimates['L2'])
+    result = {name: np.asarray(values)[keep] for name, values in candidates.items()}
+    result.update(estimates)
+    result['d_out'] = d_out[keep]
+    result['error'] = error[keep]
+    return result
+
+
+def _batches(space, batch_size=BATCH_SIZE):
+    # Cartesian product of the search space, flattened and cut into batches
+    names = list(space)
+    shape = tuple(len(space[name]) for name in names)
+    total = int(np.prod(shape))
+    for start in range(0, total, batch_size):
+        idx = np.unravel_index(np.arange(start, min(start + batch_size, total)), shape)
+        yield {name: space[name][axis_idx] for name, axis_idx in zip(names, idx)}
+
+
+def drc_violations(variant):
+    # Number of process design rule violations of the transformer generated
+    # from a to_variants() variant
+    from layout_backend import get_backend
+    from parameter_sweep import build_variant, normalize_variant
+    cell = get_backend().new_cell('inverse_design_candidate')
+    build_variant('transformer', cell, normalize_variant('transformer', variant))
+    return len(check_cell(cell))
+
+
+def _rank(L1, L2, k, space, opposite_side_entry, method, max_outer_diameter, top, workers, batch_size):
+    # The top candidates of the whole search space, best first
+    options = dict(L1=L1, L2=L2, k=k, opposite_side_entry=opposite_side_entry, method=method,
+                   max_outer_diameter=max_outer_diameter, top=top)
+    batches = _batches(space, batch_size)
+    if workers == 1:
+        results = [evaluate_batch(batch, **options) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(evaluate_batch, batch, **options) for batch in batches]
+            results = [future.result() for future in futures]
+    if not results or not any(len(result['error']) for result in results):
+        raise ValueError(
+            'No candidate geometries to rank: the search space is empty'
+            + (f' or none is within {max_outer_diameter} um' if max_outer_diameter is not None else ''))
+    best = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+    order = np.lexsort((best['d_out'], best['error']))[:top]
+    return {name: values[order] for name, values in best.items()}
+
+
+def solve(L1, L2, k=None, space=None, opposite_side_entry=True, method='wheeler',
+          max_outer_diameter=None, top=DEFAULT_TOP, workers=1, batch_size=BATCH_SIZE, drc=False):
+    """
+    Search generate_spiral_transformer geometries for target inductances.
+
+    Every combination in the search space is estimated with the analytic
+    model in inductance_estimator, batch by batch, and the candidates with
+    the lowest design_error are returned. With drc, the ranked candidates
+    are generated and checked against the process design rules in order,
+    and only the ones without violations are returned.
+
+    Parameters:
+    -----------
+    L1, L2 : float
+        Target primary and secondary self inductance in H
+    k : float
+        Target coupling coefficient, or None to ignore coupling. Geometries
+        with fewer than COUPLING_MIN_TURNS turns are then not considered
+    space : dict
+        Searched values per parameter, defaults to search_space()
+    opposite_side_entry : bool
+        Entry configuration of the generated transformers
+    method : str
+        Inductance expression, one of inductance_estimator.ESTIMATORS
+    max_outer_diameter : float
+        Discard candidates with a larger outer diameter in um
+    top : int
+        Number of geometries to return
+    workers : int
+        Worker processes evaluating batches in parallel; 1 evaluates in
+        this process, None uses the CPU count
+    batch_size : int
+        Candidates per batch
+    drc : bool
+        Only return geometries that pass drc.check_cell. The candidates are
+        checked best first, DRC_CANDIDATE_FACTOR per requested geometry and
+        more as long as too few of them pass.
+
+    Returns a dictionary of 1D arrays, best geometry first, with the
+    parameters, 'L1', 'L2', 'M', 'k', 'd_out' (um) and 'error'. Raises
+    ValueError when the search space is empty, max_outer_diameter rules
+    out every candidate or, with drc, no candidate passes the rules.
+    """
+    space = space or search_space()
+    search = (L1, L2, k, space, opposite_side_entry, method, max_outer_diameter)
+    if not drc:
+        return _rank(*search, top, workers, batch_size)
+    # Violations per checked geometry, kept while the ranking is extended
+    checked = {}
+    fetch = top*DRC_CANDIDATE_FACTOR
+    while True:
+        best = _rank(*search, fetch, workers, batch_size)
+        clean = []
+        for idx, variant in enumerate(to_variants(best, opposite_side_entry)):
+            key = tuple(variant.values())
+            if key not in checked:
+                checked[key] = drc_violations(variant)
+                logger.debug('%s: %d DRC violations', variant, checked[key])
+            if not checked[key]:
+                clean.append(idx)
+            if len(clean) == top:
+                break
+        if len(clean) == top or len(best['error']) < fetch:
+            break
+        fetch *= 2
+    if not clean:
+        raise ValueError(f'None of the {len(checked)} best candidate geometries passes the design rules')
+    return {name: values[clean] for name, values in best.items()}
+
+
+def to_variants(best, opposite_side_entry=True):
+    # parameter_sweep variant dictionaries of solve() results
+    return [
+        dict(trace_width=float(tw), spacing=float(s), inner_radius=float(ir), num_turns=int(nt),
+             opposite_side_entry=opposite_side_entry)
+        for tw, s, ir, nt in zip(best['trace_width'], best['spacing'], best['inner_radius'], best['num_turns'])
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search spiral transformer geometries for target inductances and coupling')
+    parser.add_argument('--L1', type=float, default=None, help='Target primary inductance in H (default: from --CL, --f and --n)')
+    parser.add_argument('--L2', type=float, default=None, help='Target secondary inductance in H (default: from --CL and --f)')
+    parser.add_argument('--CL', type=float, default=DEFAULT_CL, help='Load capacitance in F the secondary resonates with')
+    parser.add_argument('--f', type=float, default=DEFAULT_F, help='Operating frequency in Hz')
+    parser.add_argument('--n', type=float, default=DEFAULT_N, help='Turns ratio')
+    parser.add_argument('--k', type=float, default=DEFAULT_K, help='Target coupling coefficient')
+    parser.add_argument('--ignore_k', action='store_true', default=False, help='Only match the inductances')
+    parser.add_argument('--trace_width', type=float, nargs=2, default=None, help='Trace width range in um (default: M6 min_width to %s)' % DEFAULT_MAX_TRACE_WIDTH)
+    parser.add_argument('--spacing', type=float, nargs=2, default=None, help='Spacing range in um (default: M6 min_spacing to %s)' % DEFAULT_MAX_SPACING)
+    parser.add_argument('--inner_radius', type=float, nargs=2, default=DEFAULT_INNER_RADIUS_RANGE, help='Inner radius range in um')
+    parser.add_argument('--num_turns', type=int, nargs=2, default=DEFAULT_NUM_TURNS_RANGE, help='Number of turns range')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help='Values per continuous parameter')
+    parser.add_argument('--max_outer_diameter', type=float, default=None, help='Largest allowed outer diameter in um')
+    parser.add_argument('--same_side_entry', action='store_true', default=False, help='Second coil enters from the same side')
+    parser.add_argument('--method', choices=ESTIMATORS, default='wheeler', help='Inductance expression')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help='Number of geometries to report')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for the search (0: CPU count)')
+    parser.add_argument('--json', type=str, default=None, help='Write the best geometries to this JSON file')
+    parser.add_argument('--generate', action='store_true', default=False, help='Generate the GDS of the best geometries with the parameter sweep')
+    parser.add_argument('--no_drc', action='store_true', default=False, help='Rank geometries without checking them against the process design rules')
+    parser.add_argument('--drc', action='store_true', default=False, help='With --generate, check the geometries against the process design rules')
+    parser.add_argument('--output_dir', type=str, default=None, help='With --generate, output directory of the sweep')
+    parser.add_argument('--inductance', action='store_true', default=False, help='With --generate, compute the inductances of the geometries with the filament solver')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    derived_L1, derived_L2 = aoki_inductances(args.CL, args.f, args.n)
+    L1 = args.L1 if args.L1 is not None else float(derived_L1)
+    L2 = args.L2 if args.L2 is not None else float(derived_L2)
+    logger.info('Targets: L1 %.4g H, L2 %.4g H, k %s', L1, L2, None if args.ignore_k else args.k)
+    space = search_space(args.trace_width, args.spacing, args.inner_radius, args.num_turns, args.steps)
+    try:
+        best = solve(
+            L1, L2, None if args.ignore_k else args.k, space, not args.same_side_entry, args.method,
+            args.max_outer_diameter, args.top, args.workers or None, drc=not args.no_drc
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    print(' '.join(f'{name:>12}' for name in best))
+    for row in zip(*best.values()):
+        print(' '.join(f'{value:12.4g}' for value in row))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({name: values.tolist() for name, values in best.items()}, f, indent=2)
+
+    if args.generate:
+        from parameter_sweep import DEFAULT_OUTPUT_DIR, run_sweep
+        output_dir = args.output_dir or os.path.join(DEFAULT_OUTPUT_DIR, 'inverse_design')
+        manifest = run_sweep(
+            'transformer', to_variants(best, not args.same_side_entry), output_dir,
+            args.workers or None, drc=args.drc, inductance=args.inductance
+        )
+        logger.info('%d geometries generated (%d failed) in %s', manifest['num_variants'], manifest['num_failed'], output_dir)
+        for record in manifest['variants']:
+            if 'inductance' in record:
+                logger.info('%s: filament L1 %.4g H, L2 %.4g H, k %.3f', record['name'],
+                            record['inductance']['L1'], record['inductance']['L2'], record['inductance']['k'])
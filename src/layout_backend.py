@@ -0,0 +1,228 @@
+# Thin layout backend abstraction over gdspy and gdstk. The generators build
+# geometry through the backend of the cell they are given (backend_of), and
+# the CLIs create their cells with get_backend(args.backend). Both backends
+# produce the same vertices from the same points; merged outlines cover the
+# same area but may start at another vertex, and text labels use each
+# library's own font.
+import numpy as np
+
+BACKEND_NAMES = ('gdspy', 'gdstk')
+DEFAULT_BACKEND = 'gdspy'
+# GDSII boundaries hold at most 8191 points, including the closing point
+GDS_MAX_POINTS = 8190
+
+
+class GdspyBackend:
+    name = 'gdspy'
+
+    def __init__(self):
+        import gdspy
+        self.lib = gdspy
+
+    def new_library(self):
+        return self.lib.GdsLibrary()
+
+    def new_cell(self, name):
+        # Not registered in gdspy.current_library, so names may repeat
+        return self.lib.Cell(name, exclude_from_current=True)
+
+    def add(self, cell, elements):
+        cell.add(elements)
+        return cell
+
+    def add_polygons(self, cell, polygons, layer=0, datatype=0, merge=False):
+        # Add a list of point arrays as one polygon set, or as their union
+        if not len(polygons):
+            return cell
+        if merge:
+            merged = self.lib.boolean(
+                [np.asarray(points) for points in polygons], None, 'or',
+                max_points=GDS_MAX_POINTS, layer=layer, datatype=datatype)
+            if merged is not None:
+                cell.add(merged)
+            return cell
+        cell.add(self.lib.PolygonSet([np.asarray(points) for points in polygons], layer=layer, datatype=datatype))
+        return cell
+
+    def rectangle(self, point1, point2, layer=0, datatype=0):
+        return self.lib.Rectangle(point1, point2, layer=layer, datatype=datatype)
+
+    def text(self, text, size, position, layer=0, datatype=0):
+        return self.lib.Text(text, size, position, layer=layer, datatype=datatype)
+
+    def cell_array(self, cell, columns, rows, spacing, origin):
+        return self.lib.CellArray(cell, columns=columns, rows=rows, spacing=spacing, origin=origin)
+
+    def reference(self, cell, origin):
+        # cell may also be the name of a cell written elsewhere (GdsStream)
+        return self.lib.CellReference(cell, origin, ignore_missing=isinstance(cell, str))
+
+    def label(self, text, position, layer=0, texttype=0, magnification=1):
+        return self.lib.Label(text, position, layer=layer, texttype=texttype, magnification=magnification)
+
+    def references(self, cell):
+        return cell.references
+
+    def dependencies(self, cell):
+        # Every cell referenced by cell, recursively
+        return cell.get_dependencies(True)
+
+    def referenced_cell(self, reference):
+        return reference.ref_cell
+
+    def set_referenced_cell(self, reference, ref_cell):
+        reference.ref_cell = ref_cell
+
+    def add_cell(self, lib, cell, include_dependencies=True):
+        lib.add(cell, include_dependencies=include_dependencies)
+        return lib
+
+    def copy_contents(self, source, cell):
+        # Add every element of source to cell
+        cell.add(source.polygons)
+        cell.add(source.paths)
+        cell.add(source.labels)
+        cell.add(source.references)
+        return cell
+
+    def polygons_by_spec(self, cell):
+        # {(layer, datatype): [point arrays]} of the flattened cell
+        return cell.get_polygons(by_spec=True)
+
+    def bounding_box(self, cell):
+        return cell.get_bounding_box()
+
+    def text_bounding_box(self, text, size, position=(0, 0)):
+        # Extent of the polygon text, None for blank text
+        return self.text(text, size, position).get_bounding_box()
+
+    def read_top_cell(self, path):
+        return self.lib.GdsLibrary(infile=path).top_level()[0]
+
+    def write_gds(self, lib, path):
+        lib.write_gds(path)
+
+    def gds_writer(self, path, name='library', unit=1e-6, precision=1e-9):
+        return self.lib.GdsWriter(path, name=name, unit=unit, precision=precision)
+
+    def write_cell(self, writer, cell):
+        writer.write_cell(cell)
+
+    def write_svg(self, cell, path):
+        cell.write_svg(path)
+
+
+class GdstkBackend(GdspyBackend):
+    name = 'gdstk'
+
+    def __init__(self):
+        import gdstk
+        self.lib = gdstk
+
+    def new_library(self):
+        return self.lib.Library()
+
+    def new_cell(self, name):
+        return self.lib.Cell(name)
+
+    def add(self, cell, elements):
+        if isinstance(elements, (list, tuple)):
+            cell.add(*elements)
+        else:
+            cell.add(elements)
+        return cell
+
+    def add_polygons(self, cell, polygons, layer=0, datatype=0, merge=False):
+        if not len(polygons):
+            return cell
+        if merge:
+            cell.add(*self.lib.boolean(
+                [np.asarray(points) for points in polygons], [], 'or', layer=layer, datatype=datatype))
+            return cell
+        cell.add(*(self.lib.Polygon(points, layer=layer, datatype=datatype) for points in polygons))
+        return cell
+
+    def rectangle(self, point1, point2, layer=0, datatype=0):
+        # Same vertex order as gdspy.Rectangle
+        (x1, y1), (x2, y2) = point1, point2
+        return self.lib.Polygon([(x1, y1), (x1, y2), (x2, y2), (x2, y1)], layer=layer, datatype=datatype)
+
+    def text(self, text, size, position, layer=0, datatype=0):
+        return self.lib.text(text, size, position, layer=layer, datatype=datatype)
+
+    def cell_array(self, cell, columns, rows, spacing, origin):
+        return self.lib.Reference(cell, origin, columns=columns, rows=rows, spacing=spacing)
+
+    def reference(self, cell, origin):
+        return self.lib.Reference(cell, origin)
+
+    def referenced_cell(self, reference):
+        return reference.cell
+
+    def dependencies(self, cell):
+        return cell.dependencies(True)
+
+    def set_referenced_cell(self, reference, ref_cell):
+        reference.cell = ref_cell
+
+    def add_cell(self, lib, cell, include_dependencies=True):
+        present = {existing.name for existing in lib.cells}
+        cells = [cell, *cell.dependencies(True)] if include_dependencies else [cell]
+        lib.add(*(new for new in cells if new.name not in present))
+        return lib
+
+    def copy_contents(self, source, cell):
+        cell.add(*source.polygons, *source.paths, *source.labels, *source.references)
+        return cell
+
+    def polygons_by_spec(self, cell):
+        polygons = {}
+        for polygon in cell.get_polygons():
+            polygons.setdefault((polygon.layer, polygon.datatype), []).append(polygon.points)
+        return polygons
+
+    def bounding_box(self, cell):
+        box = cell.bounding_box()
+        return None if box is None else np.array(box)
+
+    def text_bounding_box(self, text, size, position=(0, 0)):
+        polygons = self.text(text, size, position)
+        if not polygons:
+            return None
+        points = np.concatenate([polygon.points for polygon in polygons])
+        return np.array([points.min(axis=0), points.max(axis=0)])
+
+    def read_top_cell(self, path):
+        return self.lib.read_gds(path).top_level()[0]
+
+    def write_gds(self, lib, path):
+        # gdspy does not fracture on write; keep outlines whole up to the GDSII limit
+        lib.write_gds(path, max_points=GDS_MAX_POINTS)
+
+    def gds_writer(self, path, name='library', unit=1e-6, precision=1e-9):
+        return self.lib.GdsWriter(path, name=name, unit=unit, precision=precision, max_points=GDS_MAX_POINTS)
+
+    def write_cell(self, writer, cell):
+        writer.write(cell)
+
+
+_backends = {}
+def get_backend(name=DEFAULT_BACKEND):
+    # Backend instance by name, importing its layout library on first use
+    if name not in _backends:
+        if name == 'gdspy':
+            _backends[name] = GdspyBackend()
+        elif name == 'gdstk':
+            _backends[name] = GdstkBackend()
+        else:
+            raise ValueError(f'Unknown layout backend {name!r}, expected one of {BACKEND_NAMES}')
+    return _backends[name]
+
+
+def backend_of(obj):
+    # Backend of a cell or library from the package that defines its type.
+    # Other cell types (polygon_buffer.PolygonBuffer) name their own backend.
+    if getattr(obj, 'layout_backend', None) is not None:
+        return obj.layout_backend
+    name = type(obj).__module__.split('.')[0]
+    return get_backend(name if name in BACKEND_NAMES else DEFAULT_BACKEND)
@@ -0,0 +1,310 @@
+import ast
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from diagnostics import report_stage
+from layout_backend import DEFAULT_BACKEND, backend_of
+from layout_io import DEFAULT_FORMATS, OUTPUT_DIR, PROCESS_CONFIG_PATH, register_shared_cell, write_outputs
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'VLSI_SCRIPTS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vlsi_scripts', 'layouts')
+)
+DEFAULT_MAX_MB = 1024
+# Bump when the cache layout or key scheme changes
+CACHE_FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(value):
+    # Canonical JSON-able form so that e.g. 3 and 3.0 hash the same
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if hasattr(value, 'tolist'):
+        return _normalize(value.tolist())
+    raise TypeError(f'Cannot use {type(value).__name__} as a cache key parameter')
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _source_info(path, mtime_ns, size):
+    # Digest of the source file at path and the files next to it of the
+    # modules it imports anywhere, including the lazy imports inside
+    # functions. Memoized per file version, so a key only stats the files.
+    with open(path, 'rb') as f:
+        source = f.read()
+    names = set()
+    for node in ast.walk(ast.parse(source, path)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module)
+    candidates = (os.path.join(os.path.dirname(path), name.split('.')[0] + '.py') for name in names)
+    imports = tuple(candidate for candidate in candidates if os.path.exists(candidate))
+    return hashlib.sha256(source).hexdigest(), imports
+
+
+def code_version(generator):
+    # Hash of the source file that defines the generator and of every
+    # in-repo module it imports directly or indirectly (geometry templates,
+    # layout backends, output writers), so editing any of them invalidates
+    # the cached layouts
+    pending = [os.path.abspath(inspect.getsourcefile(generator))]
+    digests = {}
+    while pending:
+        path = pending.pop()
+        if path not in digests:
+            stat = os.stat(path)
+            digests[path], imports = _source_info(path, stat.st_mtime_ns, stat.st_size)
+            pending.extend(imports)
+    digest = hashlib.sha256()
+    for path in sorted(digests):
+        digest.update(f'{os.path.basename(path)}:{digests[path]}\n'.encode())
+    return digest.hexdigest()
+
+
+class LayoutCache:
+    """
+    Content-addressed on-disk cache of generated layouts.
+
+    Entries are keyed on a hash of the generator name, its geometry
+    parameters, the layout backend, the process config contents and the
+    source code of the generator and the in-repo modules it imports.
+    Each entry is a directory holding the stored GDS (and optionally SVG).
+    Hits refresh the entry's timestamp and the least recently used entries
+    are evicted once the cache grows past max_bytes.
+
+    Parameters:
+    -----------
+    cache_dir : str
+        Directory holding the cache entries
+    max_bytes : int
+        Size bound for all entries together
+    process_config_path : str
+        Process config file whose contents are part of every key
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_MB << 20, process_config_path=PROCESS_CONFIG_PATH):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.process_config_digest = _file_digest(process_config_path)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, generator, params, backend=DEFAULT_BACKEND):
+        payload = json.dumps({
+            'format': CACHE_FORMAT_VERSION,
+            'generator': generator.__name__,
+            'params': _normalize(params),
+            'backend': backend,
+            'process_config': self.process_config_digest,
+            'code_version': code_version(generator),
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key, formats=('gds',)):
+        """
+        Return {format: path} of the stored files if the entry exists and
+        holds every requested format, otherwise None.
+        """
+        entry_dir = self._entry_dir(key)
+        paths = {fmt: os.path.join(entry_dir, f'layout.{fmt}') for fmt in formats}
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        # Mark as recently used
+        now = time.time()
+        os.utime(entry_dir, (now, now))
+        return paths
+
+    def store(self, key, files, meta=None):
+        """
+        Copy {format: path} files into the entry for key and evict least
+        recently used entries beyond the size bound.
+        """
+        entry_dir = self._entry_dir(key)
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+        for fmt, path in files.items():
+            shutil.copyfile(path, os.path.join(staging_dir, f'layout.{fmt}'))
+        with open(os.path.join(staging_dir, META_FILE), 'w') as f:
+            # Keep what is already recorded about an existing entry
+            json.dump(dict(self.read_meta(key) or {}, **(meta or {})), f)
+        if os.path.exists(entry_dir):
+            # Merge newly written formats into the existing entry
+            for name in os.listdir(staging_dir):
+                os.replace(os.path.join(staging_dir, name), os.path.join(entry_dir, name))
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        else:
+            try:
+                os.rename(staging_dir, entry_dir)
+            except OSError:
+                # Another process stored the same entry first
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        self.evict()
+        return self.lookup(key, tuple(files))
+
+    def read_meta(self, key):
+        # Metadata stored with the entry for key, or None if there is no entry
+        try:
+            with open(os.path.join(self._entry_dir(key), META_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update_meta(self, key, **values):
+        # Add values to the metadata of the entry for key, if it exists
+        meta = self.read_meta(key)
+        if meta is None:
+            return
+        meta.update(values)
+        fd, tmp_path = tempfile.mkstemp(prefix='.meta-', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.replace(tmp_path, os.path.join(self._entry_dir(key), META_FILE))
+        except OSError:
+            # The entry was evicted meanwhile
+            os.remove(tmp_path)
+
+    def fetch(self, key, basename, formats=('gds',), output_dir='.'):
+        """
+        Copy the stored files for key to output_dir/<basename>.<format>.
+
+        Returns {format: path} of the copies, or None on a miss.
+        """
+        paths = self.lookup(key, formats)
+        if paths is None:
+            return None
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = {}
+        for fmt, path in paths.items():
+            outputs[fmt] = os.path.join(output_dir, f'{basename}.{fmt}')
+            shutil.copyfile(path, outputs[fmt])
+        return outputs
+
+    def entries(self):
+        # (mtime, size, path) of every entry, oldest first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.stat(path).st_mtime, size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            logger.debug('Evicting cache entry %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def invalidate(self, key=None):
+        # Drop one entry, or every entry when key is None
+        if key is not None:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            return
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def generate(self, generator, cell, params, options=None):
+        """
+        Add the geometry of generator(cell, **params) to cell, loading it from
+        the cache on a hit and storing it on a miss. options are extra keyword
+        arguments that do not change the geometry and are not part of the key.
+        Used by the generator functions when they are called with a cache.
+        The stored GDS is read back with the layout backend of cell.
+        """
+        backend = backend_of(cell)
+        key = self.key(generator, params, backend.name)
+        paths = self.lookup(key)
+        if paths is None:
+            logger.debug('Layout cache miss for %s', generator.__name__)
+            source = backend.new_cell(cell.name)
+            generator(source, **params, **(options or {}))
+            lib = backend.new_library()
+            backend.add_cell(lib, source, include_dependencies=True)
+            with tempfile.TemporaryDirectory(prefix='.tmp-', dir=self.cache_dir) as tmp_dir:
+                gds_file = os.path.join(tmp_dir, 'layout.gds')
+                backend.write_gds(lib, gds_file)
+                self.store(key, {'gds': gds_file}, {'generator': generator.__name__, 'params': _normalize(params)})
+        else:
+            logger.debug('Layout cache hit for %s', generator.__name__)
+            source = backend.read_top_cell(paths['gds'])
+            # Reconnect references to the process-wide shared cells
+            for reference in backend.references(source):
+                backend.set_referenced_cell(reference, register_shared_cell(backend.referenced_cell(reference)))
+        return backend.copy_contents(source, cell)
+
+
+def write_outputs_cached(cache, generator, params, build, basename, formats=DEFAULT_FORMATS, output_dir=OUTPUT_DIR, report=None, backend=DEFAULT_BACKEND):
+    """
+    CLI helper: write the outputs of generator(**params), copying them from
+    the cache on a hit. build() is only called on a miss (or without a
+    cache) and must return the (lib, cell) to write, built with the named
+    layout backend. With a diagnostics.RunReport, the writes or the cache
+    fetch are timed into it.
+
+    Returns ({format: path}, lib), where lib is None on a cache hit.
+    """
+    if cache is None:
+        lib, cell = build()
+        return write_outputs(lib, cell, basename, formats, output_dir, report), lib
+    key = cache.key(generator, params, backend)
+    with report_stage(report, 'cache_fetch'):
+        outputs = cache.fetch(key, basename, formats, output_dir)
+    if outputs is not None:
+        logger.debug('Layout cache hit for %s', basename)
+        if report is not None:
+            report.count_outputs(outputs)
+        return outputs, None
+    lib, cell = build()
+    outputs = write_outputs(lib, cell, basename, formats, output_dir, report)
+    with report_stage(report, 'cache_store'):
+        cache.store(key, outputs, {'generator': generator.__name__, 'params': _normalize(params)})
+    return outputs, lib
+
+
+def add_cache_arguments(parser):
+    # Cache options shared by the generator CLIs
+    parser.add_argument('--cache', action='store_true', default=False, help='Reuse previously generated layouts with identical parameters')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Layout cache directory')
+    parser.add_argument('--cache_max_mb', type=float, default=DEFAULT_MAX_MB, help='Layout cache size bound in MB')
+    parser.add_argument('--clear_cache', action='store_true', default=False, help='Invalidate every cached layout before running')
+    return parser
+
+
+def cache_from_args(args):
+    # LayoutCache configured from add_cache_arguments options, or None if disabled
+    if not (args.cache or args.clear_cache):
+        return None
+    cache = LayoutCache(args.cache_dir, int(args.cache_max_mb * (1 << 20)))
+    if args.clear_cache:
+        cache.invalidate()
+    return cache if args.cache else None
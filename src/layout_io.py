@@ -0,0 +1,169 @@
+import functools
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from diagnostics import report_stage
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, GDS_MAX_POINTS, backend_of, get_backend
+
+PROCESS_CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'configs', 'my_process.json')
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), '..', 'outputs')
+OUTPUT_FORMATS = ('gds', 'svg', 'png', 'npz')
+# The png preview (preview.py) replaces the much slower SVG by default; svg
+# and npz (flat polygon_buffer arrays) are only written on request
+DEFAULT_FORMATS = ('gds', 'png')
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def load_process_config(path=PROCESS_CONFIG_PATH):
+    # Process layer map, read once on first use and shared by all generators
+    with open(path) as f:
+        return json.load(f)
+
+
+_shared_cells = {}
+def shared_cell(name, build, backend=None):
+    # Library-independent cell built once per process and backend by
+    # build(cell) and referenced from many generated cells (e.g. the
+    # transformer via cell).
+    backend = backend or get_backend()
+    if (backend.name, name) not in _shared_cells:
+        cell = backend.new_cell(name)
+        build(cell)
+        _shared_cells[backend.name, name] = cell
+    return _shared_cells[backend.name, name]
+
+
+def register_shared_cell(cell):
+    # Return the shared cell with the same name and backend as cell,
+    # registering cell if there is none yet. Used to reconnect references in
+    # loaded layouts.
+    return _shared_cells.setdefault((backend_of(cell).name, cell.name), cell)
+
+
+def merge_polygons(polygons, layer, datatype):
+    # Boolean union of polygons into as few outlines as possible, fractured
+    # only where an outline would exceed the GDSII point limit. Returns a
+    # gdspy.PolygonSet on layer/datatype, or None if there is nothing to merge.
+    import gdspy
+    if not polygons:
+        return None
+    return gdspy.boolean(polygons, None, 'or', max_points=GDS_MAX_POINTS, layer=layer, datatype=datatype)
+
+
+class GdsStream:
+    """
+    GDSII file written one cell at a time, so that cells can be dropped as
+    soon as they are generated instead of holding a whole library in memory.
+
+    write_cell writes the cell together with any referenced cells that were
+    not written yet (e.g. the shared via cell). References to cells already
+    in the stream can name them with a string instead of holding the cell.
+
+    Parameters:
+    -----------
+    path : str
+        GDS file to write
+    name : str
+        Library name
+    unit, precision : float
+        Library user unit and database precision in meters, as in
+        gdspy.GdsLibrary
+    backend : str
+        Layout backend of the cells written to the stream
+    """
+
+    def __init__(self, path, name='library', unit=1e-6, precision=1e-9, backend=DEFAULT_BACKEND):
+        self.path = path
+        self.written = set()
+        self.backend = get_backend(backend)
+        self._writer = self.backend.gds_writer(path, name=name, unit=unit, precision=precision)
+
+    def write_cell(self, cell):
+        for dependency in self.backend.dependencies(cell):
+            if dependency.name not in self.written:
+                self._write(dependency)
+        if cell.name in self.written:
+            raise ValueError(f'Cell {cell.name!r} was already written to {self.path}')
+        self._write(cell)
+        return self
+
+    def _write(self, cell):
+        self.backend.write_cell(self._writer, cell)
+        self.written.add(cell.name)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_output_arguments(parser):
+    # Output options shared by the generator CLIs
+    parser.add_argument('--formats', nargs='+', choices=OUTPUT_FORMATS, default=list(DEFAULT_FORMATS), help='Output formats to write')
+    parser.add_argument('--output_dir', type=str, default=OUTPUT_DIR, help='Directory to write the outputs to')
+    parser.add_argument('--headless', action='store_true', default=False, help='Do not open the layout viewer')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Layout library used to build and write the geometry')
+    parser.add_argument('--report', type=str, default=None, help='Write a JSON report of the stage times, polygons per layer and bytes written to this file')
+    return parser
+
+
+def write_outputs(lib, cell, basename, formats=DEFAULT_FORMATS, output_dir=OUTPUT_DIR, report=None):
+    """
+    Write lib/cell to output_dir/<basename>.<format> for each requested format.
+    The png format is a preview.py raster of cell and the npz format holds
+    its flattened polygons as a polygon_buffer.PolygonBuffer. With a diagnostics.RunReport, the time of
+    each write (write_gds, write_svg, write_png, write_npz) and the file sizes are
+    added to it.
+
+    Returns a dictionary mapping each format to the file written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    backend = backend_of(cell)
+    outputs = {}
+    if 'gds' in formats:
+        outputs['gds'] = os.path.join(output_dir, f'{basename}.gds')
+        with report_stage(report, 'write_gds'):
+            backend.write_gds(lib, outputs['gds'])
+    if 'svg' in formats:
+        outputs['svg'] = os.path.join(output_dir, f'{basename}.svg')
+        with report_stage(report, 'write_svg'):
+            backend.write_svg(cell, outputs['svg'])
+    if 'png' in formats:
+        from preview import render_cell, write_png
+        outputs['png'] = os.path.join(output_dir, f'{basename}.png')
+        with report_stage(report, 'write_png'):
+            write_png(outputs['png'], render_cell(cell))
+    if 'npz' in formats:
+        from polygon_buffer import PolygonBuffer
+        outputs['npz'] = os.path.join(output_dir, f'{basename}.npz')
+        with report_stage(report, 'write_npz'):
+            PolygonBuffer.from_cell(cell).save_npz(outputs['npz'])
+    if report is not None:
+        report.count_outputs(outputs)
+    return outputs
+
+
+def show_layout(lib):
+    # Blocking gdspy Tk viewer; only usable with a display. Accepts a library
+    # of either backend or the path of a GDS file.
+    if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        logger.warning('No display for the layout viewer, use --headless and the png preview instead')
+        return
+    import gdspy
+    if not isinstance(lib, (str, gdspy.GdsLibrary)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gds_file = os.path.join(tmp_dir, 'layout.gds')
+            backend_of(lib).write_gds(lib, gds_file)
+            lib = gdspy.GdsLibrary(infile=gds_file)
+    if isinstance(lib, str):
+        lib = gdspy.GdsLibrary(infile=lib)
+    gdspy.LayoutViewer(lib)
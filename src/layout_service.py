@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, get_backend
+from layout_cache import DEFAULT_CACHE_DIR
+from layout_io import OUTPUT_DIR, OUTPUT_FORMATS, load_process_config
+from parameter_sweep import normalize_variant, run_variant
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(OUTPUT_DIR, 'service')
+# Request generator names, by function name or parameter_sweep generator
+GENERATORS = {
+    'generate_spiral_transformer': 'transformer',
+    'generate_spiral_inductor': 'inductor',
+    'generate_octagon_spiral': 'octagon',
+    'transformer': 'transformer',
+    'inductor': 'inductor',
+    'octagon': 'octagon',
+}
+# Options a request may set; the cache directory and the root output
+# directory are service settings that requests cannot change
+REQUEST_OPTIONS = ('output_dir', 'formats', 'backend', 'drc', 'inductance', 'report')
+
+
+def _warm_up(backend_names):
+    # Worker initializer: load the process config and layout libraries once
+    load_process_config()
+    for name in backend_names:
+        get_backend(name)
+
+
+def request_output_dir(root, subdir=None):
+    # Output directory of a request: subdir resolved inside the service's
+    # root output directory, which a request cannot leave
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, subdir)) if subdir is not None else root
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f'output_dir {subdir!r} is outside the service output directory')
+    return path
+
+
+def _move_outputs(record, staging_dir, output_dir):
+    # Move the files run_variant wrote to staging_dir into output_dir with
+    # os.replace and point the record (and its report) at them
+    if not record.get('outputs'):
+        return record
+    outputs = {}
+    for fmt, path in record['outputs'].items():
+        outputs[fmt] = os.path.join(output_dir, os.path.relpath(path, staging_dir))
+        os.replace(path, outputs[fmt])
+    record['outputs'] = outputs
+    record['output'] = outputs.get('gds')
+    for fmt, entry in record.get('report', {}).get('outputs', {}).items():
+        entry['path'] = outputs.get(fmt, entry['path'])
+    return record
+
+
+def run_request(request, defaults=None):
+    """
+    Generate the layout of one service request and return its response.
+
+    A request is a dictionary with 'generator' (a key of GENERATORS) and
+    optionally 'id', 'params' and the REQUEST_OPTIONS; missing options take
+    the values in defaults. A request 'output_dir' is a subdirectory of the
+    defaults' output_dir, and the layout cache is only set by defaults
+    ('cache_dir'). The response is the parameter_sweep.run_variant record
+    with the request 'id' added. Never raises.
+    """
+    options = dict(defaults or {})
+    options.update({name: value for name, value in request.items() if name not in ('id', 'generator', 'params')})
+    response = {'id': request.get('id'), 'status': 'error', 'error': None}
+    try:
+        if request.get('generator') not in GENERATORS:
+            raise ValueError(f'Unknown generator {request.get("generator")!r}, expected one of {sorted(GENERATORS)}')
+        unknown = set(request) - {'id', 'generator', 'params', *REQUEST_OPTIONS}
+        if unknown:
+            raise ValueError(f'Unknown request options: {sorted(unknown)}')
+        formats = tuple(options.get('formats', ('gds',)))
+        if set(formats) - set(OUTPUT_FORMATS):
+            raise ValueError(f'Unknown formats {sorted(set(formats) - set(OUTPUT_FORMATS))}, expected some of {OUTPUT_FORMATS}')
+        output_dir = request_output_dir((defaults or {}).get('output_dir', DEFAULT_OUTPUT_DIR), request.get('output_dir'))
+        generator = GENERATORS[request['generator']]
+        params = normalize_variant(generator, request.get('params', {}))
+        # Identical concurrent requests write the same files, so every
+        # request writes into its own staging directory and the finished
+        # files are moved into place atomically
+        os.makedirs(output_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix='.request-', dir=output_dir)
+    except (OSError, TypeError, ValueError) as error:
+        response['error'] = str(error)
+        return response
+    try:
+        record = run_variant(
+            generator, params, staging_dir, (defaults or {}).get('cache_dir'),
+            drc=options.get('drc', False), backend=options.get('backend', DEFAULT_BACKEND),
+            inductance=options.get('inductance', False), formats=formats, report=options.get('report', False))
+        record = _move_outputs(record, staging_dir, output_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return dict(record, id=request.get('id'))
+
+
+class LayoutService:
+    """
+    Long-running layout generator: requests are run on a pool of worker
+    processes that imported the generators and layout libraries once, so a
+    request only pays for its own geometry and file writes.
+
+    Parameters:
+    -----------
+    workers : int
+        Worker processes, defaults to the CPU count
+    defaults : dict
+        Request options used where a request does not set them
+    backends : sequence of str
+        Layout backends the workers import up front
+    """
+
+    def __init__(self, workers=None, defaults=None, backends=(DEFAULT_BACKEND,)):
+        self.defaults = dict(defaults or {})
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_warm_up, initargs=(tuple(backends),))
+
+    def submit(self, line, respond):
+        # Run one JSON request line and call respond(response) when it is
+        # done. Returns an event that is set once respond has returned.
+        received = time.perf_counter()
+        responded = threading.Event()
+
+        def finish(response):
+            try:
+                respond(response)
+            finally:
+                responded.set()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('A request must be a JSON object')
+        except ValueError as error:
+            finish({'id': None, 'status': 'error', 'error': f'Invalid request: {error}'})
+            return responded
+        if request.get('command') == 'ping':
+            finish({'id': request.get('id'), 'status': 'ok'})
+            return responded
+
+        def done(future):
+            try:
+                response = future.result()
+            except Exception as error:
+                # e.g. a worker process died
+                response = {'id': request.get('id'), 'status': 'error', 'error': repr(error)}
+            response['latency_s'] = time.perf_counter() - received
+            finish(response)
+        self.executor.submit(run_request, request, self.defaults).add_done_callback(done)
+        return responded
+
+    def serve_stream(self, lines, output):
+        # Answer the requests of an iterable of lines (e.g. stdin) as JSON
+        # lines on output, in completion order, until the lines run out
+        lock = threading.Lock()
+
+        def respond(response):
+            with lock:
+                try:
+                    output.write(json.dumps(response) + '\n')
+                    output.flush()
+                except OSError as error:
+                    # The client went away; the layout was still written
+                    logger.warning('Could not send the response to request %r: %s', response.get('id'), error)
+        # Only the number of unanswered requests is kept, so a long-lived
+        # connection does not accumulate state per request. It drops once a
+        # response is written, so that this waits for the responses
+        # themselves, not just the results: done callbacks run after a
+        # future's waiters are woken, and a socket connection closes as soon
+        # as this returns.
+        answered = threading.Condition()
+        in_flight = 0
+
+        def respond_counted(response):
+            nonlocal in_flight
+            try:
+                respond(response)
+            finally:
+                with answered:
+                    in_flight -= 1
+                    answered.notify_all()
+        for line in lines:
+            if line.strip():
+                with answered:
+                    in_flight += 1
+                self.submit(line, respond_counted)
+        with answered:
+            answered.wait_for(lambda: not in_flight)
+
+    def serve_socket(self, path):
+        # Answer requests on a Unix socket, one thread per connection, until
+        # interrupted
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                output = _SocketWriter(self.wfile)
+                service.serve_stream((line.decode() for line in self.rfile), output)
+
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            logger.info('Serving on %s', path)
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(path)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _SocketWriter:
+    # Text writes on a socket connection's binary stream
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode())
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def send_requests(path, requests):
+    # Client helper: send requests (dictionaries) to the service on the Unix
+    # socket path and return the responses, in completion order
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile() as responses:
+            return [json.loads(line) for line in responses]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve layout generator requests given as JSON lines on stdin or a Unix socket')
+    parser.add_argument('--socket', type=str, default=None, help='Unix socket path to serve on instead of stdin/stdout')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Output directory of the requests, which may only write inside it')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Default layout backend of the requests')
+    parser.add_argument('--cache', action='store_true', default=False, help='Reuse previously generated layouts with identical parameters')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Layout cache directory')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    defaults = {'output_dir': args.output_dir, 'backend': args.backend}
+    if args.cache:
+        defaults['cache_dir'] = args.cache_dir
+    with LayoutService(args.workers, defaults, (args.backend,)) as service:
+        if args.socket:
+            try:
+                service.serve_socket(args.socket)
+            except KeyboardInterrupt:
+                logger.info('Stopped')
+        else:
+            service.serve_stream(sys.stdin, sys.stdout)
@@ -0,0 +1,150 @@
+# Memoized unit-octagon geometry shared by the spiral generators. The
+# angles, normalized radii and their cosines/sines only depend on the
+# octagon, the start angle and the coil entry mode, so they are computed
+# once per process; a turn for new parameters is the cached template
+# scaled by its radius and offset by the trace width, with no
+# trigonometry. The templates reproduce the arithmetic of the original
+# per-vertex loops exactly, so the generated vertices are unchanged.
+# Cached arrays are read-only since every caller shares them.
+import functools
+
+import numpy as np
+
+POLYGON_NSIDES = 8 # Octagon
+COS_PI_8 = np.cos(np.pi/8)
+
+
+def _read_only(*arrays):
+    for array in arrays:
+        array.setflags(write=False)
+    return arrays
+
+
+@functools.lru_cache(maxsize=None)
+def half_side_table(nsides=POLYGON_NSIDES, start_angle=np.pi/2):
+    """
+    Every corner and side midpoint of a unit octagon, counterclockwise from
+    start_angle, as used by the transformer coils: (angles, normalized
+    radii, cos, sin), each of length 2*nsides. Midpoints (even indices) lie
+    at cos(pi/8) of the corner radius.
+    """
+    outer_angle = (nsides - 2) * np.pi / nsides
+    inner_angle = (np.pi - outer_angle/2 - np.pi/2)*2
+    angles = np.arange(start_angle, 2*np.pi+start_angle, inner_angle/2)
+    normalized_radius = np.ones_like(angles)
+    normalized_radius[np.arange(0, len(angles)) % 2 == 0] = np.cos(np.pi/8)
+    return _read_only(angles, normalized_radius, np.cos(angles), np.sin(angles))
+
+
+@functools.lru_cache(maxsize=None)
+def inductor_vertex_table(nsides=POLYGON_NSIDES):
+    """
+    Vertices of a unit octagon as used by the spiral inductor: the corners
+    and side midpoints starting at 90 degrees, without the midpoints that
+    are a multiple of 45 degrees. Returns (angles, normalized radii, cos,
+    sin), each of length 3*nsides/2.
+    """
+    vertex_indices = np.arange(4, 4+(nsides*2)) % (nsides*2)
+    # Drop vertices that are multiple of 45 degrees
+    vertex_indices = vertex_indices[np.arange(0, len(vertex_indices)) % 4 != 2]
+    angles = np.pi/nsides * vertex_indices
+    normalized_radius = np.ones_like(angles)
+    normalized_radius[vertex_indices % 2 == 0] = np.cos(np.pi/8)
+    return _read_only(angles, normalized_radius, np.cos(angles), np.sin(angles))
+
+
+@functools.lru_cache(maxsize=None)
+def coil_quadrant_template(quad_idx, coil_idx, opposite_side_entry, nsides=POLYGON_NSIDES):
+    """
+    Unit template of one transformer coil segment: the octagon quadrant
+    quad_idx along the inner trace edge and back along the outer one (10
+    points). Returns the arrays (cos, sin, normalized radius, odd, outer,
+    step):
+    - odd: corner vertices, whose outer edge lies trace_width/cos(pi/8) out
+    - outer: points on the outer trace edge
+    - step: y offset in units of 2*(spacing + trace_width) where the coil
+      steps out to its next turn (0, 1 or cos(pi/8))
+    With opposite_side_entry, coil 1 starts half an octagon around.
+    """
+    _, normalized_radius, cos, sin = half_side_table(nsides)
+    num_angles = len(cos)
+    angle_idx = []
+    outer = []
+    for is_outer, stride in [(False, 1), (True, -1)]:
+        for idx in range(4*quad_idx, 4*quad_idx + 5)[::stride]:
+            angle_idx.append(idx + num_angles//2 if opposite_side_entry and coil_idx == 1 else idx)
+            outer.append(is_outer)
+    angle_idx = np.array(angle_idx)
+    step = np.zeros(len(angle_idx))
+    if quad_idx == 3 and (coil_idx == 0 or not opposite_side_entry):
+        step[angle_idx >= 4*quad_idx] = 1
+    elif opposite_side_entry and coil_idx == 1 and quad_idx == 1:
+        step[angle_idx > 4*quad_idx] = 1
+    step[(step == 1) & (angle_idx == num_angles)] = np.cos(np.pi/8)
+    wrapped = angle_idx % num_angles
+    return _read_only(cos[wrapped], sin[wrapped], normalized_radius[wrapped], angle_idx % 2 == 1, np.array(outer), step)
+
+
+@functools.lru_cache(maxsize=None)
+def inductor_quadrant_template(quad_idx, nsides=POLYGON_NSIDES):
+    """
+    Unit template of one spiral inductor segment: quadrant quad_idx along
+    the inner trace edge and back along the outer one (8 points). Returns
+    the arrays (cos, sin, normalized radius, outer, late), late marking the
+    points a quarter turn further out than the start of the quadrant.
+    """
+    _, normalized_radius, cos, sin = inductor_vertex_table(nsides)
+    angle_idx = []
+    outer = []
+    for is_outer, stride in [(False, 1), (True, -1)]:
+        for idx in range(3*quad_idx, 3*quad_idx + 4)[::stride]:
+            angle_idx.append(idx)
+            outer.append(is_outer)
+    angle_idx = np.array(angle_idx)
+    wrapped = angle_idx % len(cos)
+    return _read_only(cos[wrapped], sin[wrapped], normalized_radius[wrapped], np.array(outer), angle_idx > 3*quad_idx + 1)
+
+
+def coil_quadrants(num_turns, coil_idx, opposite_side_entry):
+    # (turn_idx, quad_idx) of every segment of a transformer coil. With
+    # opposite side entry, coil 1 only covers half of its first and last turn.
+    quadrants = []
+    for turn_idx in range(num_turns):
+        quad_range = range(4)
+        if opposite_side_entry and coil_idx == 1 and turn_idx == 0:
+            quad_range = [0,1]
+        elif opposite_side_entry and coil_idx == 1 and turn_idx == num_turns - 1:
+            quad_range = [2,3]
+        quadrants.extend((turn_idx, quad_idx) for quad_idx in quad_range)
+    return quadrants
+
+
+@functools.lru_cache(maxsize=None)
+def coil_template(num_turns, coil_idx, opposite_side_entry, nsides=POLYGON_NSIDES):
+    """
+    coil_quadrant_template of every segment of a transformer coil, stacked
+    into (segments, 10) arrays, plus the (segments, 1) turn pitch multiple:
+    segment i starts at inner_radius + pitch[i]*(spacing + trace_width).
+    """
+    quadrants = coil_quadrants(num_turns, coil_idx, opposite_side_entry)
+    templates = [coil_quadrant_template(quad_idx, coil_idx, opposite_side_entry, nsides) for _, quad_idx in quadrants]
+    stacked = [np.stack(arrays) for arrays in zip(*templates)] if templates else [np.empty((0, 10))]*6
+    pitch = np.array([[2*turn_idx + coil_idx] for turn_idx, _ in quadrants]).reshape(-1, 1)
+    return _read_only(*stacked, pitch)
+
+
+@functools.lru_cache(maxsize=None)
+def inductor_template(num_turns, nsides=POLYGON_NSIDES):
+    """
+    inductor_quadrant_template of every quadrant of every turn, stacked
+    into (4*num_turns, 8) arrays (cos, sin, normalized radius, outer,
+    turns), where turns is the fractional turn index of each point:
+    the radius at a point is inner_radius + turns*(spacing + trace_width).
+    """
+    rows = []
+    for turn_idx in range(num_turns):
+        for quad_idx in range(4):
+            cos, sin, normalized_radius, outer, late = inductor_quadrant_template(quad_idx, nsides)
+            rows.append((cos, sin, normalized_radius, outer, turn_idx + quad_idx/4 + late/4))
+    stacked = [np.stack(arrays) for arrays in zip(*rows)] if rows else [np.empty((0, 8))]*5
+    return _read_only(*stacked)
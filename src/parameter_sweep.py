@@ -0,0 +1,380 @@
+import argparse
+import itertools
+import json
+import logging
+import numbers
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import circular_informed_spiral
+import generate_spiral_inductor
+import generate_spiral_transformer
+from diagnostics import RunReport, add_verbosity_arguments, configure_logging_from_args, report_stage
+from drc import DrcError, check_cell
+from filament_inductance import transformer_inductance
+from layout_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, LayoutCache, write_outputs_cached
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, get_backend
+from layout_io import OUTPUT_DIR, OUTPUT_FORMATS
+from preview import variant_sources, write_contact_sheet
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(OUTPUT_DIR, "sweep")
+MANIFEST_NAME = "manifest.json"
+CONTACT_SHEET_NAME = "contact_sheet.png"
+# Violations listed per failing variant in the manifest
+MAX_REPORTED_VIOLATIONS = 20
+
+# Per-generator defaults for every sweepable parameter, in the order they
+# are passed to the generator function.
+GENERATOR_DEFAULTS = {
+    'transformer': {
+        'trace_width': float(generate_spiral_transformer.DEFAULT_TRACE_WIDTH),
+        'inner_radius': float(generate_spiral_transformer.DEFAULT_INNER_RADIUS),
+        'num_turns': generate_spiral_transformer.DEFAULT_NUM_TURNS,
+        'guard_ring_distance': float(generate_spiral_transformer.DEFAULT_GUARD_RING_DISTANCE),
+        'spacing': float(generate_spiral_transformer.DEFAULT_SPACING),
+        'opposite_side_entry': True,
+        'add_entry_exit_traces': True,
+        'include_vias': True,
+        'merge': False,
+    },
+    'inductor': {
+        'trace_width': float(generate_spiral_inductor.DEFAULT_TRACE_WIDTH),
+        'inner_radius': float(generate_spiral_inductor.DEFAULT_INNER_RADIUS),
+        'num_turns': generate_spiral_inductor.DEFAULT_NUM_TURNS,
+        'guard_ring_distance': float(generate_spiral_inductor.DEFAULT_GUARD_RING_DISTANCE),
+        'spacing': float(generate_spiral_inductor.DEFAULT_SPACING),
+        'merge': False,
+    },
+    'octagon': {
+        'trace_width': float(circular_informed_spiral.DEFAULT_TRACE_WIDTH),
+        'inner_radius': float(circular_informed_spiral.DEFAULT_INNER_RADIUS),
+        'num_turns': circular_informed_spiral.DEFAULT_NUM_TURNS,
+        'spacing': float(circular_informed_spiral.DEFAULT_SPACING),
+        'layer': circular_informed_spiral.DEFAULT_LAYER,
+        'datatype': circular_informed_spiral.DEFAULT_DATATYPE,
+        'labels': True,
+        'merge': False,
+    },
+}
+
+
+def _parameter_value(generator, name, value, default):
+    # value converted to the type of default, so that e.g. 3 and 3.0 give the
+    # same file name. Values that would change in the conversion (the string
+    # "false", 2.7 turns) raise ValueError instead of being coerced.
+    description = f'{generator} parameter {name!r}'
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            try:
+                return parse_bool(value)
+            except argparse.ArgumentTypeError as error:
+                raise ValueError(f'{description}: {error}') from None
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        raise ValueError(f'{description} must be a boolean, got {value!r}')
+    if isinstance(value, (bool, np.bool_)) or not isinstance(value, numbers.Real):
+        raise ValueError(f'{description} must be a number, got {value!r}')
+    if isinstance(default, int):
+        if not np.isfinite(value) or value != int(value):
+            raise ValueError(f'{description} must be an integer, got {value!r}')
+        return int(value)
+    return float(value)
+
+
+def normalize_variant(generator, variant):
+    # Fill in defaults and validate the types so file names match the
+    # single-run CLIs
+    defaults = GENERATOR_DEFAULTS[generator]
+    unknown = set(variant) - set(defaults)
+    if unknown:
+        raise ValueError(f'Unknown {generator} parameters: {sorted(unknown)}')
+    params = dict(defaults, **variant)
+    return {name: _parameter_value(generator, name, params[name], default) for name, default in defaults.items()}
+
+
+def expand_grid(generator, grid):
+    # Cartesian product of a {parameter: [values]} mapping
+    names = list(grid)
+    return [
+        normalize_variant(generator, dict(zip(names, values)))
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def variant_name(generator, params):
+    if generator == 'transformer':
+        suffix = generate_spiral_transformer.variant_suffix(
+            params['trace_width'], params['inner_radius'], params['num_turns'], params['spacing'],
+            params['opposite_side_entry'], params['add_entry_exit_traces'], params['include_vias'],
+            params['merge']
+        )
+        return f'spiral_transformer.{suffix}'
+    if generator == 'octagon':
+        suffix = circular_informed_spiral.variant_suffix(
+            params['trace_width'], params['inner_radius'], params['num_turns'], params['spacing'],
+            params['labels'], params['merge']
+        )
+        return f'octagon_spiral.{suffix}'
+    suffix = generate_spiral_inductor.variant_suffix(
+        params['trace_width'], params['inner_radius'], params['num_turns'], params['spacing'],
+        params['merge']
+    )
+    return f'spiral_inductor.{suffix}'
+
+
+# Overrides of the (layer, datatype) checked per process layer name with
+# --drc; the octagon spiral is drawn on 37/0 and checked as M6
+DRC_LAYERS = {
+    'octagon': {'M6': (37, 0)},
+}
+
+
+GENERATOR_FUNCTIONS = {
+    'transformer': generate_spiral_transformer.generate_spiral_transformer,
+    'inductor': generate_spiral_inductor.generate_spiral_inductor,
+    'octagon': circular_informed_spiral.generate_octagon_spiral,
+}
+
+
+def build_variant(generator, cell, params, report=None):
+    # Add the geometry of one variant to cell, timing it into the optional
+    # diagnostics.RunReport
+    if generator == 'transformer':
+        generate_spiral_transformer.generate_spiral_transformer(
+            cell, params['trace_width'], params['inner_radius'],
+            params['num_turns'], params['guard_ring_distance'],
+            params['spacing'], params['opposite_side_entry'],
+            params['add_entry_exit_traces'], params['include_vias'], params['merge'],
+            report=report
+        )
+    elif generator == 'octagon':
+        # Same geometry as the per-step loop
+        circular_informed_spiral.generate_octagon_spiral(cell, vectorized=True, **params, report=report)
+    else:
+        generate_spiral_inductor.generate_spiral_inductor(
+            cell, params['trace_width'], params['inner_radius'],
+            params['num_turns'], params['guard_ring_distance'], params['spacing'], params['merge'],
+            report=report
+        )
+    return cell
+
+
+def run_variant(generator, params, output_dir, cache_dir=None, cache_max_mb=DEFAULT_MAX_MB, drc=False, backend=DEFAULT_BACKEND, inductance=False, formats=('gds',), report=False):
+    # Generate one variant into its own GDS file. Runs in a worker process and
+    # never raises: failures are reported in the returned manifest record.
+    # With drc the variant is checked against the process rules before its
+    # GDS is written, and nothing is written if it fails. A cache entry is
+    # checked once, on the layout read back from it, and then marked clean
+    # in its metadata (the rules are part of the cache key). With inductance
+    # the filament solver adds L1, L2, M and k of transformer variants. Every
+    # written format is listed in record['outputs'], the GDS also in 'output'.
+    # With report, record['report'] holds the diagnostics.RunReport of the
+    # stage times, polygons per layer and bytes written.
+    name = variant_name(generator, params)
+    record = {'name': name, 'params': params, 'status': 'ok', 'output': None, 'error': None}
+    run_report = RunReport() if report else None
+    start = time.perf_counter()
+    try:
+        def check(cell):
+            with report_stage(run_report, 'drc'):
+                violations = check_cell(cell, layers=DRC_LAYERS.get(generator))
+            record['drc_violations'] = len(violations)
+            if violations:
+                raise DrcError(violations)
+
+        def build():
+            layout = get_backend(backend)
+            lib = layout.new_library()
+            # Cells are independent of any global library, so that workers
+            # can build any number of cells without name clashes
+            cell = layout.new_cell(name)
+            with report_stage(run_report, 'generate'):
+                build_variant(generator, cell, params, run_report)
+            if drc:
+                check(cell)
+            layout.add_cell(lib, cell, include_dependencies=True)
+            return lib, cell
+
+        cache = LayoutCache(cache_dir, int(cache_max_mb * (1 << 20))) if cache_dir else None
+        key = cache.key(GENERATOR_FUNCTIONS[generator], params, backend) if cache is not None else None
+        if drc and cache is not None:
+            paths = cache.lookup(key)
+            if paths is not None and (cache.read_meta(key) or {}).get('drc_clean'):
+                record['drc_violations'] = 0
+            elif paths is not None:
+                check(get_backend(backend).read_top_cell(paths['gds']))
+        outputs, lib = write_outputs_cached(
+            cache, GENERATOR_FUNCTIONS[generator], params, build, name, formats, output_dir, run_report, backend
+        )
+        if drc and cache is not None:
+            cache.update_meta(key, drc_clean=True)
+        record['output'] = outputs.get('gds')
+        record['outputs'] = outputs
+        record['cached'] = lib is None
+        if inductance and generator == 'transformer':
+            with report_stage(run_report, 'inductance'):
+                record['inductance'] = {name: float(value) for name, value in transformer_inductance(
+                    params['trace_width'], params['inner_radius'], params['num_turns'],
+                    params['spacing'], params['opposite_side_entry']).items()}
+    except DrcError as error:
+        record['status'] = 'drc_failed'
+        record['error'] = error.violations[:MAX_REPORTED_VIOLATIONS]
+    except Exception:
+        record['status'] = 'error'
+        record['error'] = traceback.format_exc()
+    record['elapsed_s'] = time.perf_counter() - start
+    if run_report is not None:
+        record['report'] = run_report.to_dict()
+    return record
+
+
+def run_sweep(generator, variants, output_dir=DEFAULT_OUTPUT_DIR, workers=None, manifest_path=None, cache_dir=None, drc=False, backend=DEFAULT_BACKEND, inductance=False, report=False, formats=('gds',), contact_sheet=False):
+    """
+    Generate every variant over a process pool, one GDS file per variant,
+    and write a JSON manifest with the per-variant status and timing.
+
+    Parameters:
+    -----------
+    generator : str
+        One of GENERATOR_DEFAULTS: 'transformer', 'inductor' or 'octagon'
+    variants : list of dict
+        Generator parameters per variant; missing parameters take the defaults
+    output_dir : str
+        Directory for the GDS files and the manifest
+    workers : int
+        Number of worker processes, defaults to the CPU count
+    manifest_path : str
+        Manifest location, defaults to output_dir/manifest.json
+    cache_dir : str
+        Layout cache directory; identical variants are copied from it
+    drc : bool
+        Check every generated variant against the process design rules
+        before writing it; failing variants get status 'drc_failed'
+    backend : str
+        Layout backend building and writing the variants, 'gdspy' or 'gdstk'
+    inductance : bool
+        Compute the inductances and coupling of every transformer variant
+        with filament_inductance.transformer_inductance
+    report : bool
+        Add a diagnostics.RunReport of the stage times, polygons per layer
+        and bytes written to every variant record, and their sum to the
+        manifest
+    formats : sequence of str
+        Output formats of every variant, see layout_io.OUTPUT_FORMATS
+    contact_sheet : bool
+        Also render every variant onto output_dir/contact_sheet.png with
+        preview.write_contact_sheet, at the same scale
+
+    Returns the manifest dictionary.
+    """
+    variants = [normalize_variant(generator, variant) for variant in variants]
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+
+    start = time.perf_counter()
+    records = [None] * len(variants)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_variant, generator, params, output_dir, cache_dir, drc=drc, backend=backend, inductance=inductance, report=report, formats=formats): idx
+            for idx, params in enumerate(variants)
+        }
+        for future in as_completed(futures):
+            records[futures[future]] = future.result()
+
+    manifest = {
+        'generator': generator,
+        'output_dir': output_dir,
+        'num_variants': len(records),
+        'num_failed': sum(record['status'] != 'ok' for record in records),
+        'elapsed_s': time.perf_counter() - start,
+        'variants': records,
+    }
+    if report:
+        total = RunReport()
+        for record in records:
+            if 'report' in record:
+                total.merge(record['report'])
+        manifest['report'] = total.to_dict()
+    if contact_sheet:
+        manifest['contact_sheet'], _ = write_contact_sheet(
+            variant_sources(records, output_dir), os.path.join(output_dir, CONTACT_SHEET_NAME), backend=backend)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def parse_bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'y'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'n'):
+        return False
+    raise argparse.ArgumentTypeError(f'Expected a boolean, got {value!r}')
+
+
+def add_grid_arguments(parser):
+    # Variant selection options shared by the sweep and test chip CLIs
+    parser.add_argument('--generator', choices=sorted(GENERATOR_DEFAULTS), default='transformer', help='Which generator to sweep')
+    parser.add_argument('--variants', type=str, default=None, help='JSON file with a list of parameter dictionaries, used instead of the grid')
+    parser.add_argument('--trace_width', type=float, nargs='+', help='Trace widths to sweep')
+    parser.add_argument('--inner_radius', type=float, nargs='+', help='Inner radii to sweep')
+    parser.add_argument('--num_turns', type=int, nargs='+', help='Numbers of turns to sweep')
+    parser.add_argument('--spacing', type=float, nargs='+', help='Turn spacings to sweep')
+    parser.add_argument('--guard_ring_distance', type=float, nargs='+', help='Guard ring distances to sweep')
+    parser.add_argument('--opposite_side_entry', type=parse_bool, nargs='+', help='Transformer only: opposite side entry values to sweep')
+    parser.add_argument('--add_entry_exit_traces', type=parse_bool, nargs='+', help='Transformer only: entry/exit trace values to sweep')
+    parser.add_argument('--include_vias', type=parse_bool, nargs='+', help='Transformer only: via values to sweep')
+    parser.add_argument('--merge', type=parse_bool, nargs='+', help='Merged single-outline coil values to sweep')
+    parser.add_argument('--labels', type=parse_bool, nargs='+', help='Octagon only: step index label values to sweep')
+    return parser
+
+
+def variants_from_args(args):
+    # Variant dictionaries from the --variants file, or else the grid options
+    if args.variants:
+        with open(args.variants) as f:
+            return json.load(f)
+    grid = {
+        name: getattr(args, name)
+        for name in GENERATOR_DEFAULTS[args.generator]
+        if getattr(args, name, None) is not None
+    }
+    return expand_grid(args.generator, grid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a parameter sweep of spiral transformers or inductors in parallel')
+    add_grid_arguments(parser)
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Output directory for GDS files and the manifest')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifest path (default: <output_dir>/manifest.json)')
+    parser.add_argument('--cache', action='store_true', default=False, help='Reuse previously generated layouts with identical parameters')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Layout cache directory')
+    parser.add_argument('--drc', action='store_true', default=False, help='Check each variant against the process design rules before writing it')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Layout library used to build and write the variants')
+    parser.add_argument('--inductance', action='store_true', default=False, help='Compute L1, L2, M and k of each transformer variant with the filament solver')
+    parser.add_argument('--report', action='store_true', default=False, help='Add stage times, polygons per layer and bytes written per variant and in total to the manifest')
+    parser.add_argument('--formats', nargs='+', choices=OUTPUT_FORMATS, default=['gds'], help='Output formats of every variant')
+    parser.add_argument('--contact_sheet', action='store_true', default=False, help='Render every variant onto one PNG contact sheet next to the manifest')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    try:
+        variants = [normalize_variant(args.generator, variant) for variant in variants_from_args(args)]
+    except ValueError as error:
+        parser.error(str(error))
+    manifest = run_sweep(
+        args.generator, variants, args.output_dir, args.workers, args.manifest,
+        args.cache_dir if args.cache else None, args.drc, args.backend, args.inductance, args.report,
+        args.formats, args.contact_sheet
+    )
+    logger.info("%d variants (%d failed) in %.2fs", manifest['num_variants'], manifest['num_failed'], manifest['elapsed_s'])
+    logger.info("Manifest saved to %s", args.manifest or os.path.join(args.output_dir, MANIFEST_NAME))
+    if args.contact_sheet:
+        logger.info("Contact sheet saved to %s", manifest['contact_sheet'])
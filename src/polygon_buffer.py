@@ -0,0 +1,264 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, backend_of, get_backend
+from layout_io import merge_polygons
+
+logger = logging.getLogger(__name__)
+
+# Initial vertex capacity of an empty buffer; grows by doubling
+DEFAULT_CAPACITY = 1024
+# Arrays of a saved buffer, one .npy file each in the memory-mappable format
+ARRAY_NAMES = ('vertices', 'offsets', 'layers', 'datatypes')
+
+
+class PolygonBuffer:
+    """
+    Flat polygon storage: every vertex of every polygon in one contiguous
+    (N, 2) float64 array.
+
+    Polygon i has the vertices vertices[offsets[i]:offsets[i + 1]] and lies
+    on layers[i]/datatypes[i]. The generators accept a buffer in place of a
+    cell (see BufferBackend), so geometry can be generated without creating
+    any gdspy/gdstk objects, saved with save_npz/save_npy for meshing and
+    analysis tools, and added to a cell in bulk with to_cell.
+
+    Parameters:
+    -----------
+    name : str
+        Name of the cell the buffer stands in for
+    capacity : int
+        Number of vertices to allocate up front
+    """
+    layout_backend = None  # BufferBackend, set below
+
+    def __init__(self, name='buffer', capacity=DEFAULT_CAPACITY):
+        self.name = name
+        self._vertices = np.empty((max(capacity, 1), 2))
+        self._offsets = [0]
+        self._layers = []
+        self._datatypes = []
+
+    @classmethod
+    def from_arrays(cls, vertices, offsets, layers, datatypes, name='buffer'):
+        # Read-only buffer over existing arrays (e.g. memory-mapped), without
+        # copying them. Use extend on a new buffer to add to it.
+        buffer = cls(name, capacity=1)
+        buffer._vertices = vertices
+        buffer._offsets = offsets
+        buffer._layers = layers
+        buffer._datatypes = datatypes
+        return buffer
+
+    @classmethod
+    def from_cell(cls, cell, name=None):
+        # Flattened polygons of a gdspy/gdstk cell
+        buffer = cls(name or cell.name)
+        for (layer, datatype), polygons in sorted(backend_of(cell).polygons_by_spec(cell).items()):
+            buffer.add_polygons(polygons, layer, datatype)
+        return buffer
+
+    @property
+    def num_vertices(self):
+        return int(self._offsets[-1])
+
+    @property
+    def vertices(self):
+        return self._vertices[:self.num_vertices]
+
+    @property
+    def offsets(self):
+        return np.asarray(self._offsets, dtype=np.int64)
+
+    @property
+    def layers(self):
+        return np.asarray(self._layers, dtype=np.int16)
+
+    @property
+    def datatypes(self):
+        return np.asarray(self._datatypes, dtype=np.int16)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._vertices[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def _reserve(self, num_vertices):
+        # Grow the vertex array to hold num_vertices more, doubling its size
+        needed = self.num_vertices + num_vertices
+        if needed > len(self._vertices):
+            vertices = np.empty((max(needed, 2*len(self._vertices)), 2))
+            vertices[:self.num_vertices] = self.vertices
+            self._vertices = vertices
+
+    def add_polygons(self, polygons, layer=0, datatype=0):
+        """
+        Append polygons given as a list of (n, 2) point sequences, or as one
+        (k, n, 2) array of k polygons with n vertices each.
+        """
+        if not len(polygons):
+            return self
+        lengths = [len(points) for points in polygons]
+        if isinstance(polygons, np.ndarray) or len(set(lengths)) == 1:
+            points = np.asarray(polygons, dtype=float).reshape(-1, 2)
+        else:
+            points = np.concatenate([np.asarray(points, dtype=float) for points in polygons])
+        start = self.num_vertices
+        self._reserve(len(points))
+        self._vertices[start:start + len(points)] = points
+        self._offsets.extend((start + np.cumsum(lengths)).tolist())
+        self._layers.extend([layer]*len(lengths))
+        self._datatypes.extend([datatype]*len(lengths))
+        return self
+
+    def extend(self, other):
+        # Append every polygon of another buffer
+        start = self.num_vertices
+        self._reserve(other.num_vertices)
+        self._vertices[start:start + other.num_vertices] = other.vertices
+        self._offsets.extend((start + other.offsets[1:]).tolist())
+        self._layers.extend(other.layers.tolist())
+        self._datatypes.extend(other.datatypes.tolist())
+        return self
+
+    def translated(self, offsets):
+        # New buffer with a copy of every polygon per (dx, dy) in offsets
+        offsets = np.asarray(offsets, dtype=float).reshape(-1, 1, 2)
+        copies = (self.vertices[np.newaxis] + offsets).reshape(-1, 2)
+        lengths = np.diff(self.offsets)
+        buffer = PolygonBuffer(self.name, capacity=len(copies))
+        buffer._vertices[:len(copies)] = copies
+        buffer._offsets = [0] + np.cumsum(np.tile(lengths, len(offsets))).tolist()
+        buffer._layers = np.tile(self.layers, len(offsets)).tolist()
+        buffer._datatypes = np.tile(self.datatypes, len(offsets)).tolist()
+        return buffer
+
+    def polygons_by_spec(self):
+        # {(layer, datatype): [vertex arrays]}, the arrays being views of the buffer
+        if not len(self):
+            return {}
+        views = np.split(self.vertices, self.offsets[1:-1])
+        specs = np.stack([self.layers, self.datatypes], axis=1)
+        unique, inverse = np.unique(specs, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        return {
+            (int(layer), int(datatype)): [views[idx] for idx in np.flatnonzero(inverse == spec_idx)]
+            for spec_idx, (layer, datatype) in enumerate(unique)
+        }
+
+    def bounding_box(self):
+        if not len(self):
+            return None
+        vertices = self.vertices
+        return np.array([vertices.min(axis=0), vertices.max(axis=0)])
+
+    def to_cell(self, cell, merge=False):
+        """
+        Add every polygon to a gdspy/gdstk cell with one bulk call per layer
+        and datatype, optionally merged into single outlines.
+        """
+        backend = backend_of(cell)
+        for (layer, datatype), polygons in self.polygons_by_spec().items():
+            backend.add_polygons(cell, polygons, layer=layer, datatype=datatype, merge=merge)
+        return cell
+
+    def arrays(self):
+        return dict(zip(ARRAY_NAMES, (self.vertices, self.offsets, self.layers, self.datatypes)))
+
+    def save_npz(self, path, compress=False):
+        # Single-file archive; np.load reads it back into memory
+        (np.savez_compressed if compress else np.savez)(path, name=np.array(self.name), **self.arrays())
+        return path
+
+    def save_npy(self, directory):
+        # One .npy file per array, which np.load can memory-map
+        os.makedirs(directory, exist_ok=True)
+        for array_name, array in self.arrays().items():
+            np.save(os.path.join(directory, f'{array_name}.npy'), array)
+        with open(os.path.join(directory, 'name.txt'), 'w') as f:
+            f.write(self.name)
+        return directory
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a buffer saved with save_npz or save_npy. The arrays of a
+        save_npy directory are memory-mapped with mmap_mode ('r', 'r+', 'c',
+        or None to read them into memory).
+        """
+        if os.path.isdir(path):
+            arrays = [np.load(os.path.join(path, f'{array_name}.npy'), mmap_mode=mmap_mode) for array_name in ARRAY_NAMES]
+            with open(os.path.join(path, 'name.txt')) as f:
+                name = f.read()
+        else:
+            with np.load(path) as archive:
+                arrays = [archive[array_name] for array_name in ARRAY_NAMES]
+                name = str(archive['name'])
+        return cls.from_arrays(*arrays, name=name)
+
+
+class BufferBackend:
+    # Layout backend building geometry into PolygonBuffers instead of cells.
+    # Elements (rectangles, text, arrays) are buffers themselves, and cell
+    # arrays are flattened into copies of the referenced polygons.
+    name = 'buffer'
+
+    def new_cell(self, name):
+        return PolygonBuffer(name)
+
+    def add(self, cell, elements):
+        for element in elements if isinstance(elements, (list, tuple)) else [elements]:
+            cell.extend(element)
+        return cell
+
+    def add_polygons(self, cell, polygons, layer=0, datatype=0, merge=False):
+        if merge:
+            merged = merge_polygons([np.asarray(points) for points in polygons], layer, datatype)
+            polygons = merged.polygons if merged is not None else []
+        return cell.add_polygons(polygons, layer, datatype)
+
+    def rectangle(self, point1, point2, layer=0, datatype=0):
+        # Same vertex order as gdspy.Rectangle
+        (x1, y1), (x2, y2) = point1, point2
+        return PolygonBuffer('rectangle', capacity=4).add_polygons([[(x1, y1), (x1, y2), (x2, y2), (x2, y1)]], layer, datatype)
+
+    def text(self, text, size, position, layer=0, datatype=0):
+        return PolygonBuffer('text').add_polygons(
+            get_backend('gdspy').text(text, size, position, layer, datatype).polygons, layer, datatype)
+
+    def cell_array(self, cell, columns, rows, spacing, origin):
+        x, y = np.meshgrid(np.arange(columns)*spacing[0], np.arange(rows)*spacing[1])
+        return cell.translated(np.stack([x.ravel(), y.ravel()], axis=1) + origin)
+
+    def polygons_by_spec(self, cell):
+        return cell.polygons_by_spec()
+
+    def bounding_box(self, cell):
+        return cell.bounding_box()
+
+
+PolygonBuffer.layout_backend = BufferBackend()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the flattened polygons of a GDS file to flat vertex arrays')
+    parser.add_argument('gds_file', type=str, help='GDS file to convert')
+    parser.add_argument('output', type=str, help='Output .npz file, or directory of memory-mappable .npy files with --npy')
+    parser.add_argument('--npy', action='store_true', default=False, help='Write one .npy file per array instead of an .npz archive')
+    parser.add_argument('--compress', action='store_true', default=False, help='Compress the .npz archive')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Layout library used to read the GDS file')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    buffer = PolygonBuffer.from_cell(get_backend(args.backend).read_top_cell(args.gds_file))
+    if args.npy:
+        buffer.save_npy(args.output)
+    else:
+        buffer.save_npz(args.output, args.compress)
+    logger.info('Saved %d polygons with %d vertices to %s', len(buffer), buffer.num_vertices, args.output)
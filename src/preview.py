@@ -0,0 +1,294 @@
+import argparse
+import json
+import logging
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_backend import BACKEND_NAMES, DEFAULT_BACKEND, get_backend
+from layout_io import load_process_config
+from polygon_buffer import PolygonBuffer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 512 #px, longer side of a preview
+DEFAULT_TILE_SIZE = 128 #px, contact sheet tile side
+DEFAULT_PADDING = 4 #px, between contact sheet tiles
+DEFAULT_ALPHA = 0.6 # opacity of each layer, so overlaps (e.g. vias on M5) show
+BACKGROUND = (255, 255, 255)
+# Distinct layer/datatype pairs per preview, one bit each of a pixel code
+MAX_LAYERS = 16
+# Colors of the process layers by name; other layers cycle through PALETTE
+PROCESS_LAYER_COLORS = {'M6': (31, 119, 180), 'M5': (214, 39, 40), 'vias': (0, 0, 0)}
+PALETTE = [(44, 160, 44), (255, 127, 14), (148, 103, 189), (140, 86, 75), (227, 119, 194), (127, 127, 127)]
+
+
+def layer_color(layer, datatype=0):
+    for name, color in PROCESS_LAYER_COLORS.items():
+        spec = load_process_config()[name]
+        if (spec['layer'], spec['datatype']) == (layer, datatype):
+            return color
+    return PALETTE[layer % len(PALETTE)]
+
+
+def rasterize(points, offsets, shape):
+    """
+    Fill mask of polygons given in pixel coordinates (x to the right, y
+    down), sampled at the pixel centers with the nonzero winding rule, so
+    overlapping polygons fill as their union.
+
+    Every edge is expanded into its crossings with the pixel center rows
+    in one vectorized pass; each crossing adds its winding direction at its
+    column and a cumulative sum along each row gives the winding number of
+    every pixel.
+
+    Parameters:
+    -----------
+    points : (N, 2) array
+        Vertices of all polygons, one after the other
+    offsets : (P+1,) int array
+        Polygon i has the vertices points[offsets[i]:offsets[i + 1]]
+    shape : (int, int)
+        Height and width of the mask
+
+    Returns a boolean (height, width) array.
+    """
+    height, width = shape
+    if len(points) == 0:
+        return np.zeros(shape, dtype=bool)
+    # Edge i runs from vertex i to the next one, the last vertex of each
+    # polygon back to its first
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = points[following, 0], points[following, 1]
+
+    # Rows whose center lies in [min(y0, y1), max(y0, y1)), half open so
+    # that a crossing at a shared vertex counts once
+    first_row = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    end_row = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, height).astype(np.int64)
+    counts = end_row - first_row
+    edge = np.repeat(np.arange(len(points)), counts)
+    row = np.repeat(first_row - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    y_center = row + 0.5
+    crossing_x = x0[edge] + (y_center - y0[edge])*(x1[edge] - x0[edge])/(y1[edge] - y0[edge])
+    column = np.clip(np.ceil(crossing_x - 0.5), 0, width).astype(np.int64)
+    direction = np.sign(y1 - y0)[edge]
+
+    winding = np.bincount(row*(width + 1) + column, weights=direction, minlength=height*(width + 1)).astype(np.int32)
+    return np.cumsum(winding.reshape(height, width + 1)[:, :width], axis=1) != 0
+
+
+def preview_shape(bounds, size=DEFAULT_SIZE):
+    # (height, width) of a preview of bounds ((x_min, y_min), (x_max, y_max))
+    # whose longer side is size pixels, and its pixel size
+    (x_min, y_min), (x_max, y_max) = bounds
+    pixel_size = max(x_max - x_min, y_max - y_min)/size or 1
+    return (
+        max(1, math.ceil((y_max - y_min)/pixel_size)),
+        max(1, math.ceil((x_max - x_min)/pixel_size)),
+    ), pixel_size
+
+
+def render_buffer(buffer, size=DEFAULT_SIZE, bounds=None, alpha=DEFAULT_ALPHA):
+    """
+    Rasterize the polygons of a polygon_buffer.PolygonBuffer into an RGB
+    image, one translucent color per layer and datatype, drawn in layer
+    order.
+
+    Parameters:
+    -----------
+    buffer : polygon_buffer.PolygonBuffer
+        Polygons to draw
+    size : int
+        Pixels along the longer side of bounds
+    bounds : ((x_min, y_min), (x_max, y_max))
+        Area to draw, defaults to the bounding box of buffer. Shared bounds
+        draw several buffers at the same scale.
+    alpha : float
+        Opacity of each layer
+
+    Returns a (height, width, 3) uint8 array, row 0 at the top (max y).
+    """
+    bounds = bounds if bounds is not None else buffer.bounding_box()
+    if bounds is None:
+        return np.full((1, 1, 3), BACKGROUND, dtype=np.uint8)
+    shape, pixel_size = preview_shape(bounds, size)
+    (x_min, _), (_, y_max) = bounds
+    points = np.column_stack([
+        (buffer.vertices[:, 0] - x_min)/pixel_size,
+        (y_max - buffer.vertices[:, 1])/pixel_size,
+    ])
+    offsets = buffer.offsets
+    specs = np.stack([buffer.layers, buffer.datatypes], axis=1)
+    # Bit i of a pixel's code is set where the i-th layer covers it; the
+    # colors of every code are blended once and looked up per pixel
+    unique_specs = np.unique(specs, axis=0) if len(specs) else []
+    if len(unique_specs) > MAX_LAYERS:
+        raise ValueError(f'Cannot preview more than {MAX_LAYERS} layers/datatypes, got {len(unique_specs)}')
+    code = np.zeros(shape, dtype=np.uint16)
+    colors = np.array([BACKGROUND], dtype=float)
+    for bit, (layer, datatype) in enumerate(unique_specs):
+        selected = np.flatnonzero((specs[:, 0] == layer) & (specs[:, 1] == datatype))
+        lengths = offsets[selected + 1] - offsets[selected]
+        vertex_idx = np.repeat(offsets[selected] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        mask = rasterize(points[vertex_idx], np.concatenate([[0], np.cumsum(lengths)]), shape)
+        code |= mask.view(np.uint8).astype(np.uint16) << bit
+        colors = np.concatenate([colors, (1 - alpha)*colors + alpha*np.array(layer_color(int(layer), int(datatype)))])
+    return np.round(colors).astype(np.uint8)[code]
+
+
+def render_cell(cell, size=DEFAULT_SIZE, bounds=None, alpha=DEFAULT_ALPHA):
+    # Preview of the flattened polygons of a gdspy/gdstk cell
+    return render_buffer(PolygonBuffer.from_cell(cell), size, bounds, alpha)
+
+
+def write_png(path, image):
+    # Write an (height, width, 3) uint8 RGB image as an 8-bit PNG file
+    height, width, _ = image.shape
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    # Filter type 0 (none) in front of every row
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+    return path
+
+
+def load_buffer(path, backend=DEFAULT_BACKEND):
+    # Polygons of a GDS file (flattened top cell), or of an .npz archive or
+    # .npy directory saved by polygon_buffer
+    if path.endswith('.gds'):
+        return PolygonBuffer.from_cell(get_backend(backend).read_top_cell(path))
+    return PolygonBuffer.load(path)
+
+
+def contact_sheet(buffers, columns=None, tile_size=DEFAULT_TILE_SIZE, padding=DEFAULT_PADDING, same_scale=True, alpha=DEFAULT_ALPHA):
+    """
+    Tile previews of many layouts into one image, in row-major order.
+
+    Parameters:
+    -----------
+    buffers : list of polygon_buffer.PolygonBuffer or None
+        Layouts to draw; None leaves its tile blank (e.g. a failed variant)
+    columns : int
+        Number of tile columns, defaults to a square-ish grid
+    tile_size : int
+        Tile side in pixels
+    padding : int
+        Pixels between tiles
+    same_scale : bool
+        Draw every layout at the scale of the largest one, centered in its
+        tile, so sizes compare; otherwise each layout fills its tile
+    alpha : float
+        Opacity of each layer
+
+    Returns the (height, width, 3) uint8 image and the (row, column) of
+    each tile.
+    """
+    columns = columns or max(1, math.ceil(math.sqrt(len(buffers))))
+    rows = max(1, math.ceil(len(buffers)/columns))
+    pitch = tile_size + padding
+    sheet = np.empty((rows*pitch + padding, columns*pitch + padding, 3), dtype=np.uint8)
+    sheet[:] = (224, 224, 224)
+    boxes = [buffer.bounding_box() if buffer is not None else None for buffer in buffers]
+    largest = max((np.ptp(box, axis=0).max() for box in boxes if box is not None), default=0)
+    positions = []
+    for idx, (buffer, box) in enumerate(zip(buffers, boxes)):
+        row, column = divmod(idx, columns)
+        positions.append((row, column))
+        top, left = padding + row*pitch, padding + column*pitch
+        sheet[top:top + tile_size, left:left + tile_size] = BACKGROUND
+        if box is None:
+            continue
+        # Square bounds centered on the layout, as wide as the largest layout
+        # or as the layout itself
+        half = (largest if same_scale else np.ptp(box, axis=0).max())/2
+        center = box.mean(axis=0)
+        tile = render_buffer(buffer, tile_size, (center - half, center + half), alpha)[:tile_size, :tile_size]
+        sheet[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+    return sheet, positions
+
+
+def variant_sources(records, base_dir='.'):
+    # (name, layout file or None) of parameter sweep manifest records,
+    # preferring the flat npz output over the GDS
+    sources = []
+    for record in records:
+        outputs = record.get('outputs') or {}
+        path = outputs.get('npz') or record.get('output')
+        if path is not None and not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        sources.append((record['name'], path))
+    return sources
+
+
+def manifest_sources(manifest_path):
+    with open(manifest_path) as f:
+        return variant_sources(json.load(f)['variants'], os.path.dirname(manifest_path))
+
+
+def write_contact_sheet(sources, path, columns=None, tile_size=DEFAULT_TILE_SIZE, same_scale=True, backend=DEFAULT_BACKEND):
+    """
+    Render a contact sheet of the (name, layout file or None) sources to
+    the PNG file path, and an index of the tile of every name next to it
+    (<path without .png>.json).
+
+    Returns the paths of the PNG and the index.
+    """
+    buffers = [load_buffer(source, backend) if source is not None else None for _, source in sources]
+    sheet, positions = contact_sheet(buffers, columns, tile_size, same_scale=same_scale)
+    write_png(path, sheet)
+    index_path = os.path.splitext(path)[0] + '.json'
+    with open(index_path, 'w') as f:
+        json.dump({
+            'image': os.path.basename(path),
+            'tile_size': tile_size,
+            'padding': DEFAULT_PADDING,
+            'same_scale': same_scale,
+            'tiles': [
+                {'name': name, 'source': source, 'row': row, 'column': column}
+                for (name, source), (row, column) in zip(sources, positions)
+            ],
+        }, f, indent=2)
+    return path, index_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render PNG previews of layouts, or a contact sheet of many')
+    parser.add_argument('layouts', type=str, nargs='*', help='GDS files, .npz archives or .npy directories to preview')
+    parser.add_argument('--manifest', type=str, default=None, help='Parameter sweep manifest whose variants go on a contact sheet')
+    parser.add_argument('--output', type=str, default=None, help='Contact sheet PNG (default: next to the manifest, or preview.png); single layouts are written next to their file')
+    parser.add_argument('--sheet', action='store_true', default=False, help='Put the given layouts on one contact sheet instead of one preview each')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='Longer side of a single preview in pixels')
+    parser.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE, help='Contact sheet tile side in pixels')
+    parser.add_argument('--columns', type=int, default=None, help='Contact sheet columns (default: square-ish grid)')
+    parser.add_argument('--fit', action='store_true', default=False, help='Scale every layout to fill its tile instead of drawing all at the same scale')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default=DEFAULT_BACKEND, help='Layout library used to read GDS files')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    if args.manifest or args.sheet:
+        if args.manifest:
+            sources = manifest_sources(args.manifest)
+            default_output = os.path.join(os.path.dirname(args.manifest), 'contact_sheet.png')
+        else:
+            sources = [(os.path.basename(layout), layout) for layout in args.layouts]
+            default_output = 'preview.png'
+        png_file, index_file = write_contact_sheet(
+            sources, args.output or default_output, args.columns, args.tile_size, not args.fit, args.backend)
+        logger.info('Saved a contact sheet of %d layouts to %s (index %s)', len(sources), png_file, index_file)
+    else:
+        for layout in args.layouts:
+            png_file = write_png(os.path.splitext(layout.rstrip('/'))[0] + '.png', render_buffer(load_buffer(layout, args.backend), args.size))
+            logger.info('Saved %s', png_file)
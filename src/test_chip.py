@@ -0,0 +1,265 @@
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+from diagnostics import RunReport, add_verbosity_arguments, configure_logging_from_args, report_stage
+from layout_backend import DEFAULT_BACKEND, get_backend
+from layout_io import GdsStream, add_output_arguments, show_layout, write_outputs
+from parameter_sweep import add_grid_arguments, build_variant, normalize_variant, variant_name, variants_from_args
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHIP_NAME = 'test_chip'
+DEFAULT_MARGIN = 50 #um, clearance between neighbouring instance bounding boxes
+DEFAULT_LABEL_SIZE = 10 #um
+DEFAULT_LABEL_LAYER = 63
+DEFAULT_LABEL_DATATYPE = 0
+LABEL_STYLES = ('text', 'polygon')
+
+
+def variant_key(generator, params):
+    # Instances with equal keys share one variant cell
+    return generator, json.dumps(params, sort_keys=True)
+
+
+def build_variant_cells(instances, default_generator='transformer', stream=None, backend=DEFAULT_BACKEND, report=None):
+    """
+    Build one cell per unique variant.
+
+    instances is a list of parameter dictionaries, each optionally holding
+    'generator' (defaults to default_generator), 'label' and 'copies' (number
+    of instances of the variant, default 1) next to the generator parameters.
+
+    With a layout_io.GdsStream, every variant cell is written to the stream
+    as soon as it is built and not kept in memory. The cells are built with
+    the stream's backend, or else the named layout backend. The generator
+    stages and streamed writes are timed into the optional
+    diagnostics.RunReport.
+
+    Returns (cells, bounding_boxes, placements): the unique variant cells by
+    name (empty when streaming), their bounding boxes by name, and one
+    (cell name, label) entry per instance to place.
+    """
+    layout = stream.backend if stream is not None else get_backend(backend)
+    names = {}
+    cells = {}
+    bounding_boxes = {}
+    placements = []
+    for instance in instances:
+        instance = dict(instance)
+        generator = instance.pop('generator', default_generator)
+        label = instance.pop('label', None)
+        copies = int(instance.pop('copies', 1))
+        params = normalize_variant(generator, instance)
+        key = variant_key(generator, params)
+        if key not in names:
+            name = variant_name(generator, params)
+            # Variants differing only in parameters left out of the name
+            # (e.g. guard_ring_distance) still need distinct cell names
+            unique_name, idx = name, 1
+            while unique_name in bounding_boxes:
+                unique_name, idx = f'{name}.{idx}', idx + 1
+            cell = build_variant(generator, layout.new_cell(unique_name), params, report)
+            bounding_boxes[unique_name] = layout.bounding_box(cell)
+            if bounding_boxes[unique_name] is None:
+                bounding_boxes[unique_name] = ((0, 0), (0, 0))
+            if stream is None:
+                cells[unique_name] = cell
+            else:
+                with report_stage(report, 'write_gds'):
+                    stream.write_cell(cell)
+            names[key] = unique_name
+            logger.debug('Built variant cell %s', unique_name)
+        name = names[key]
+        placements.extend([(name, label if label is not None else name)] * copies)
+    return cells, bounding_boxes, placements
+
+
+def grid_pitches(bounding_boxes, columns, margin, label_height=0):
+    """
+    Column widths and row heights of a grid holding instances with the given
+    bounding boxes in row-major order. Each column is as wide as its widest
+    instance and each row as tall as its tallest one, plus margin (and the
+    label height below each instance). Pass slot_box bounding boxes to make
+    room for labels wider than their instance.
+    """
+    rows = math.ceil(len(bounding_boxes)/columns)
+    widths = [0]*columns
+    heights = [0]*rows
+    for idx, ((x_min, y_min), (x_max, y_max)) in enumerate(bounding_boxes):
+        row, column = divmod(idx, columns)
+        widths[column] = max(widths[column], x_max - x_min + margin)
+        heights[row] = max(heights[row], y_max - y_min + margin + label_height)
+    return widths, heights
+
+
+def label_offset(bounding_box, label_height):
+    # Label position relative to the instance origin: left aligned below it
+    (x_min, y_min), _ = bounding_box
+    return x_min, y_min - label_height*3/4
+
+
+def slot_box(bounding_box, label_box=None, label_height=0):
+    # Bounding box of an instance together with its label, given the label
+    # bounding box relative to its position (None when not labelled)
+    (x_min, y_min), (x_max, y_max) = bounding_box
+    if label_box is None:
+        return (x_min, y_min), (x_max, y_max)
+    x, y = label_offset(bounding_box, label_height)
+    (label_x_min, label_y_min), (label_x_max, label_y_max) = label_box
+    return (
+        (min(x_min, x + label_x_min), min(y_min, y + label_y_min)),
+        (max(x_max, x + label_x_max), max(y_max, y + label_y_max)),
+    )
+
+
+def tile_variants(
+    instances, default_generator='transformer', columns=None, margin=DEFAULT_MARGIN,
+    labels=True, label_style='text', label_size=DEFAULT_LABEL_SIZE,
+    label_layer=DEFAULT_LABEL_LAYER, label_datatype=DEFAULT_LABEL_DATATYPE,
+    name=DEFAULT_CHIP_NAME, stream=None, backend=DEFAULT_BACKEND, report=None):
+    """
+    Place many spiral variants on a test chip grid.
+
+    Every unique variant is generated once and each instance is a reference
+    to its cell, so memory and file size grow with the number of unique
+    variants rather than the number of instances.
+
+    Parameters:
+    -----------
+    instances : list of dict
+        Instance parameters, see build_variant_cells
+    default_generator : str
+        Generator of instances without a 'generator' entry
+    columns : int
+        Number of grid columns, defaults to a square-ish grid
+    margin : float
+        Clearance between neighbouring instance bounding boxes in um
+    labels : bool
+        Add a label below each instance
+    label_style : str
+        'text' for GDS text elements, which do not print, or 'polygon' to
+        draw the labels as polygons on the label layer
+    label_size : float
+        Label height in um
+    label_layer, label_datatype : int
+        Layer and datatype of the labels
+    name : str
+        Name of the top cell
+    stream : layout_io.GdsStream
+        Write every cell to this stream as soon as it is built instead of
+        collecting a library; the top cell then references the variants by
+        name and peak memory no longer grows with the number of variants
+    backend : str
+        Layout backend building the cells when not streaming
+    report : diagnostics.RunReport
+        Optional report to time the variant generation, the placement and
+        the streamed writes into
+
+    Returns (lib, top): a library with the top cell and every variant cell
+    it references, or None and the top cell when streaming.
+    """
+    layout = stream.backend if stream is not None else get_backend(backend)
+    if label_style not in LABEL_STYLES:
+        raise ValueError(f'Unknown label style {label_style!r}, expected one of {LABEL_STYLES}')
+    cells, bounding_boxes, placements = build_variant_cells(instances, default_generator, stream, backend, report)
+    start = time.perf_counter()
+    top = layout.new_cell(name)
+
+    columns = columns or max(1, math.ceil(math.sqrt(len(placements))))
+    label_height = 2*label_size if labels else 0
+    # Labels (the variant names by default) are often wider than their
+    # instance; the slots make room for the label extent as drawn, which
+    # text labels also take up in a viewer
+    label_boxes = {}
+    if labels:
+        for label in {label for _, label in placements}:
+            label_boxes[label] = layout.text_bounding_box(label, label_size)
+    slots = [
+        slot_box(bounding_boxes[cell_name], label_boxes.get(label), label_height)
+        for cell_name, label in placements
+    ]
+    widths, heights = grid_pitches(slots, columns, margin)
+    # Column left edges and row top edges; rows run from the top down
+    x_edges = [sum(widths[:column]) for column in range(columns)]
+    y_edges = [-sum(heights[:row]) for row in range(len(heights))]
+
+    for idx, ((cell_name, label), slot) in enumerate(zip(placements, slots)):
+        row, column = divmod(idx, columns)
+        (slot_x_min, _), (slot_x_max, _) = slot
+        _, (_, y_max) = bounding_boxes[cell_name]
+        # Center the instance and its label horizontally in their slot, top
+        # aligned below the margin
+        origin = (
+            x_edges[column] + widths[column]/2 - (slot_x_min + slot_x_max)/2,
+            y_edges[row] - margin/2 - y_max,
+        )
+        # Streamed variants are referenced by name
+        layout.add(top, layout.reference(cells.get(cell_name, cell_name), origin))
+        if labels:
+            x, y = label_offset(bounding_boxes[cell_name], label_height)
+            position = (origin[0] + x, origin[1] + y)
+            if label_style == 'polygon':
+                layout.add(top, layout.text(label, label_size, position, layer=label_layer, datatype=label_datatype))
+            else:
+                layout.add(top, layout.label(label, position, layer=label_layer, texttype=label_datatype, magnification=label_size))
+    logger.info('Placed %d instances of %d unique variants on a %dx%d grid',
+                len(placements), len(bounding_boxes), len(heights), columns)
+    if report is not None:
+        report.add_time('place', time.perf_counter() - start)
+    if stream is not None:
+        with report_stage(report, 'write_gds'):
+            stream.write_cell(top)
+        return None, top
+    lib = layout.new_library()
+    layout.add_cell(lib, top, include_dependencies=True)
+    return lib, top
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tile many spiral transformer/inductor variants on one test chip')
+    add_grid_arguments(parser)
+    parser.add_argument('--columns', type=int, default=None, help='Number of grid columns (default: square-ish grid)')
+    parser.add_argument('--margin', type=float, default=DEFAULT_MARGIN, help='Clearance between instances in um')
+    parser.add_argument('--no_labels', action='store_true', default=False, help='Do not label the instances')
+    parser.add_argument('--label_style', choices=LABEL_STYLES, default='text', help='GDS text elements or polygon labels')
+    parser.add_argument('--label_size', type=float, default=DEFAULT_LABEL_SIZE, help='Label height in um')
+    parser.add_argument('--label_layer', type=int, default=DEFAULT_LABEL_LAYER, help='Label layer')
+    parser.add_argument('--name', type=str, default=DEFAULT_CHIP_NAME, help='Top cell and output file name')
+    parser.add_argument('--stream', action='store_true', default=False, help='Write each variant cell to the GDS file as soon as it is built (GDS output only)')
+    add_output_arguments(parser)
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    report = RunReport() if args.report else None
+    variants = variants_from_args(args)
+    tile_args = (
+        variants, args.generator, args.columns, args.margin,
+        not args.no_labels, args.label_style, args.label_size, args.label_layer
+    )
+    if args.stream:
+        # Only the GDS can be streamed; SVG and npz need the whole cell hierarchy
+        for fmt in sorted(set(args.formats) - {'gds'}):
+            logger.warning('Skipping the %s output, it is not supported with --stream', fmt.upper())
+        os.makedirs(args.output_dir, exist_ok=True)
+        gds_file = os.path.join(args.output_dir, f'{args.name}.gds')
+        with GdsStream(gds_file, backend=args.backend) as stream:
+            tile_variants(*tile_args, name=args.name, stream=stream, report=report)
+        outputs = {'gds': gds_file}
+        if report is not None:
+            report.count_outputs(outputs)
+        lib = gds_file
+    else:
+        lib, top = tile_variants(*tile_args, name=args.name, backend=args.backend, report=report)
+        outputs = write_outputs(lib, top, args.name, args.formats, args.output_dir, report)
+    for output_file in outputs.values():
+        logger.info('Saved %s', output_file)
+    if report is not None:
+        logger.info('Report saved to %s', report.write(args.report))
+
+    if not args.headless:
+        show_layout(lib)
@@ -1,26 +1,191 @@
 # Design a transformer model to using the Aoki equations
 
+import argparse
 import numpy as np
-import skrf as rf
-
-RL = 10.2
-Q1 = 7
-Q2 = 7
-CL = 103e-15
-f = 5.8e9
-w = 2*np.pi*f
-#L1=954e-12
-n=1
-L2 = 1/(w**2.0*CL)
-L1 = L2/n**2.0
-print(f'L1: {L1} L2: {L2}')
-k = 0.7
-# Calculate the inductance of the transformer
-L = RL * Q1 * Q2 * CL
-
-eta = (
-    (RL / n**2.0) / 
-    ((w*L1/Q2 + RL/n**2.0)/(w*k*L1)**2.0 * w*L1/Q1 + w*L1/Q2 + RL/n**2.0)
-)
-print(eta)
-print(10.0*np.log10(eta))
\ No newline at end of file
+
+DEFAULT_RL = 10.2
+DEFAULT_Q1 = 7
+DEFAULT_Q2 = 7
+DEFAULT_CL = 103e-15
+DEFAULT_F = 5.8e9
+DEFAULT_K = 0.7
+DEFAULT_N = 1
+# Points in the random sample used to prefilter large Pareto searches
+PARETO_SAMPLE_SIZE = 100_000
+
+
+def aoki_inductances(CL, f, n):
+    # Secondary inductance resonating with the load capacitance at f, and the
+    # primary inductance for turns ratio n. Broadcasts over array inputs.
+    w = 2*np.pi*np.asarray(f, dtype=float)
+    L2 = 1/(w**2.0*np.asarray(CL, dtype=float))
+    L1 = L2/np.asarray(n, dtype=float)**2.0
+    return L1, L2
+
+
+def aoki_efficiency(RL, Q1, Q2, CL, f, k, n, L1=None):
+    """
+    Transformer power efficiency from the Aoki equations.
+
+    All inputs broadcast against each other with the usual NumPy rules, so a
+    whole design space evaluates in one vectorized call.
+
+    Parameters:
+    -----------
+    RL : float or array
+        Load resistance
+    Q1, Q2 : float or array
+        Quality factors of the primary and secondary
+    CL : float or array
+        Load capacitance
+    f : float or array
+        Operating frequency
+    k : float or array
+        Magnetic coupling coefficient
+    n : float or array
+        Turns ratio
+    L1 : float or array
+        Primary inductance; derived from CL, f and n with aoki_inductances
+        when not given
+
+    Returns the efficiency eta (linear, not dB).
+    """
+    RL, Q1, Q2, k, n = (np.asarray(x, dtype=float) for x in (RL, Q1, Q2, k, n))
+    w = 2*np.pi*np.asarray(f, dtype=float)
+    if L1 is None:
+        L1, _ = aoki_inductances(CL, f, n)
+    L1 = np.asarray(L1, dtype=float)
+    # Secondary loss and load referred to the primary; the secondary loop
+    # is resonant, so it reflects (w*k*L1)**2/(R2 + RL) into the primary
+    return (
+        (RL / n**2.0) /
+        ((w*L1/Q2 + RL/n**2.0)**2.0/(w*k*L1)**2.0 * w*L1/Q1 + w*L1/Q2 + RL/n**2.0)
+    )
+
+
+def design_grid(**params):
+    # Place each 1D parameter array on its own axis so that the parameters
+    # broadcast to their full Cartesian product
+    names = list(params)
+    grid = {}
+    for axis, name in enumerate(names):
+        shape = [1]*len(names)
+        values = np.atleast_1d(np.asarray(params[name], dtype=float))
+        shape[axis] = len(values)
+        grid[name] = values.reshape(shape)
+    return grid
+
+
+def pareto_front(objectives, maximize):
+    """
+    Indices of the non-dominated rows of objectives.
+
+    Parameters:
+    -----------
+    objectives : (N, M) array
+        One row per design point, one column per objective
+    maximize : sequence of M bools
+        Whether each objective is maximized (True) or minimized (False)
+
+    Duplicated points are reported once.
+    """
+    costs = np.where(np.asarray(maximize), -1.0, 1.0) * np.asarray(objectives, dtype=float)
+    columns = [np.ascontiguousarray(column) for column in costs.T]
+    candidates = np.arange(len(costs))
+    if len(costs) > PARETO_SAMPLE_SIZE:
+        # The front of a random sample dominates most of the design space;
+        # discarding what it dominates first leaves few points for the
+        # exact pass below
+        sample = np.random.default_rng(0).choice(len(costs), PARETO_SAMPLE_SIZE, replace=False)
+        sample = sample[_pareto_front_exact([column[sample] for column in columns])]
+        keep = np.ones(len(costs), dtype=bool)
+        for point in costs[sample]:
+            keep &= _not_dominated_by(columns, point)
+        # Points equal to a sample front point were dropped too; keep one copy
+        keep[sample] = True
+        candidates = candidates[keep]
+        columns = [column[keep] for column in columns]
+    return candidates[_pareto_front_exact(columns)]
+
+
+def _not_dominated_by(columns, point):
+    # Points that beat point in at least one objective
+    keep = columns[0] < point[0]
+    for column, value in zip(columns[1:], point[1:]):
+        keep |= column < value
+    return keep
+
+
+def _pareto_front_exact(columns):
+    # The minimizer of a positively weighted sum of the costs is always
+    # non-dominated, so each pass picks one front point that way and drops
+    # every remaining point it dominates, without sorting the whole set
+    weighted = np.zeros(len(columns[0]))
+    for column in columns:
+        span = np.ptp(column) if len(column) else 0
+        weighted += column/(span if span > 0 else 1)
+    candidates = np.arange(len(weighted))
+    front = []
+    while len(candidates):
+        best = np.argmin(weighted)
+        front.append(candidates[best])
+        keep = _not_dominated_by(columns, [column[best] for column in columns])
+        candidates, weighted = candidates[keep], weighted[keep]
+        columns = [column[keep] for column in columns]
+    return np.array(front, dtype=int)
+
+
+def pareto_search(RL, Q1, Q2, CL, f, k, n, L1=None, maximize_n=False):
+    """
+    Evaluate aoki_efficiency over the broadcast design space and return the
+    Pareto front of efficiency (maximized) against primary inductance
+    (minimized) and turns ratio (minimized unless maximize_n).
+
+    Inputs broadcast like aoki_efficiency; use design_grid to build a full
+    grid from 1D value lists. Returns a dictionary of 1D arrays, one entry
+    per front point, with 'eta', 'L1', 'L2' and every input parameter.
+    """
+    if L1 is None:
+        L1, _ = aoki_inductances(CL, f, n)
+    eta = aoki_efficiency(RL, Q1, Q2, CL, f, k, n, L1)
+    columns = dict(zip(
+        ('eta', 'RL', 'Q1', 'Q2', 'CL', 'f', 'k', 'n', 'L1'),
+        (np.ravel(x) for x in np.broadcast_arrays(eta, RL, Q1, Q2, CL, f, k, n, L1))
+    ))
+    columns['L2'] = columns['L1']*columns['n']**2.0
+    front = pareto_front(
+        np.stack([columns['eta'], columns['L1'], columns['n']], axis=1),
+        maximize=(True, False, maximize_n)
+    )
+    # Highest efficiency first
+    front = front[np.argsort(-columns['eta'][front], kind='stable')]
+    return {name: values[front] for name, values in columns.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate transformer efficiency with the Aoki equations')
+    parser.add_argument('--RL', type=float, nargs='+', default=[DEFAULT_RL], help='Load resistance(s) in ohms')
+    parser.add_argument('--Q1', type=float, nargs='+', default=[DEFAULT_Q1], help='Primary quality factor(s)')
+    parser.add_argument('--Q2', type=float, nargs='+', default=[DEFAULT_Q2], help='Secondary quality factor(s)')
+    parser.add_argument('--CL', type=float, nargs='+', default=[DEFAULT_CL], help='Load capacitance(s) in farads')
+    parser.add_argument('--f', type=float, nargs='+', default=[DEFAULT_F], help='Frequency(ies) in hertz')
+    parser.add_argument('--k', type=float, nargs='+', default=[DEFAULT_K], help='Coupling coefficient(s)')
+    parser.add_argument('--n', type=float, nargs='+', default=[DEFAULT_N], help='Turns ratio(s)')
+    parser.add_argument('--pareto', action='store_true', default=False, help='Print the Pareto front of efficiency against L1 and n over the grid')
+    parser.add_argument('--maximize_n', action='store_true', default=False, help='Prefer larger turns ratios on the Pareto front')
+    args = parser.parse_args()
+
+    grid = design_grid(RL=args.RL, Q1=args.Q1, Q2=args.Q2, CL=args.CL, f=args.f, k=args.k, n=args.n)
+    if args.pareto:
+        front = pareto_search(**grid, maximize_n=args.maximize_n)
+        print(f'{len(front["eta"])} Pareto-optimal points out of {np.broadcast(*grid.values()).size}')
+        names = list(front)
+        print(' '.join(f'{name:>11}' for name in names))
+        for row in zip(*front.values()):
+            print(' '.join(f'{value:11.4g}' for value in row))
+    else:
+        L1, L2 = aoki_inductances(grid['CL'], grid['f'], grid['n'])
+        eta = aoki_efficiency(**grid)
+        print(f'L1: {np.squeeze(L1)} L2: {np.squeeze(L2)}')
+        print(np.squeeze(eta))
+        print(10.0*np.log10(np.squeeze(eta)))
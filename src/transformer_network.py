@@ -0,0 +1,160 @@
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from diagnostics import add_verbosity_arguments, configure_logging_from_args
+from layout_io import OUTPUT_DIR
+from transformer_aoki_equations import DEFAULT_CL, DEFAULT_F, DEFAULT_K, DEFAULT_N, DEFAULT_Q1, DEFAULT_Q2, DEFAULT_RL, aoki_inductances
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(OUTPUT_DIR, 'sparameters')
+DEFAULT_Z0 = 50 #ohm, port reference impedance
+DEFAULT_F_START = 0.1e9
+DEFAULT_F_STOP = 20e9
+DEFAULT_POINTS = 2001
+
+
+def _variant_axis(x):
+    # Variant parameters on a leading axis, broadcast against (frequency, 2, 2)
+    return np.atleast_1d(np.asarray(x, dtype=float))[:, np.newaxis]
+
+
+def lumped_z_parameters(f, L1, L2, k, Q1=DEFAULT_Q1, Q2=DEFAULT_Q2, CL=DEFAULT_CL, f_q=DEFAULT_F):
+    """
+    Z parameters of the lumped transformer two-port for many variants and
+    frequencies at once.
+
+    Each coil is its inductance in series with the loss resistance
+    2*pi*f_q*L/Q, so Q1 and Q2 hold at f_q. The coils couple through
+    M = k*sqrt(L1*L2), and CL is in series with the secondary (port 2) to
+    resonate it, as in the Aoki efficiency model.
+
+    Parameters:
+    -----------
+    f : (F,) array
+        Frequencies in Hz
+    L1, L2 : float or (V,) array
+        Primary and secondary inductance in H
+    k : float or (V,) array
+        Coupling coefficient
+    Q1, Q2 : float or (V,) array
+        Quality factors of the primary and secondary at f_q
+    CL : float or (V,) array
+        Secondary tuning capacitance in F
+    f_q : float
+        Frequency in Hz the quality factors are given at
+
+    Returns a complex (V, F, 2, 2) array in ohms.
+    """
+    w = 2*np.pi*np.asarray(f, dtype=float)[np.newaxis]
+    L1, L2, k, Q1, Q2, CL = np.broadcast_arrays(*(_variant_axis(x) for x in (L1, L2, k, Q1, Q2, CL)))
+    w_q = 2*np.pi*f_q
+    M = k*np.sqrt(L1*L2)
+    z = np.empty(np.broadcast_shapes(L1.shape, w.shape) + (2, 2), dtype=complex)
+    z[..., 0, 0] = w_q*L1/Q1 + 1j*w*L1
+    z[..., 1, 1] = w_q*L2/Q2 + 1j*w*L2 + 1/(1j*w*CL)
+    z[..., 0, 1] = z[..., 1, 0] = 1j*w*M
+    return z
+
+
+def z_to_s(z, z0=DEFAULT_Z0):
+    # Power-wave S parameters of (..., 2, 2) Z parameters for real reference
+    # impedances z0 (scalar or one per port), in closed form
+    z01, z02 = np.broadcast_to(np.asarray(z0, dtype=float), (2,))
+    z11, z12, z21, z22 = z[..., 0, 0], z[..., 0, 1], z[..., 1, 0], z[..., 1, 1]
+    determinant = (z11 + z01)*(z22 + z02) - z12*z21
+    s = np.empty_like(z)
+    s[..., 0, 0] = ((z11 - z01)*(z22 + z02) - z12*z21)/determinant
+    s[..., 1, 1] = ((z11 + z01)*(z22 - z02) - z12*z21)/determinant
+    s[..., 0, 1] = 2*np.sqrt(z01*z02)*z12/determinant
+    s[..., 1, 0] = 2*np.sqrt(z01*z02)*z21/determinant
+    return s
+
+
+def load_efficiency(z, RL=DEFAULT_RL):
+    # Fraction of the power into port 1 delivered to RL on port 2, (V, F).
+    # At f_q with CL resonating L2 = n**2*L1 this is exactly
+    # transformer_aoki_equations.aoki_efficiency; elsewhere it also
+    # accounts for the detuned secondary, which the Aoki model assumes away
+    RL = np.atleast_1d(np.asarray(RL, dtype=float))[:, np.newaxis]
+    z11, z12, z21, z22 = z[..., 0, 0], z[..., 0, 1], z[..., 1, 0], z[..., 1, 1]
+    z_in = z11 - z12*z21/(z22 + RL)
+    return np.abs(z21)**2*RL/(np.abs(z22 + RL)**2*z_in.real)
+
+
+def transformer_networks(f, s, names, z0=DEFAULT_Z0):
+    # One skrf.Network per variant of a (V, F, 2, 2) S parameter array
+    import skrf
+    frequency = skrf.Frequency.from_f(f, unit='Hz')
+    return [skrf.Network(frequency=frequency, s=variant_s, z0=z0, name=name) for variant_s, name in zip(s, names)]
+
+
+def write_touchstone(networks, output_dir=DEFAULT_OUTPUT_DIR):
+    # Write every network to output_dir/<name>.s2p and return the paths
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for network in networks:
+        # Variant names contain dots, so the extension is always given
+        filename = f'{network.name}.s{network.nports}p'
+        network.write_touchstone(filename, output_dir)
+        paths.append(os.path.join(output_dir, filename))
+    return paths
+
+
+def variants_from_manifest(path):
+    # Names and filament inductances of the transformer variants of a
+    # parameter sweep run with --inductance
+    with open(path) as f:
+        manifest = json.load(f)
+    records = [record for record in manifest['variants'] if 'inductance' in record]
+    if not records:
+        raise ValueError(f'{path} has no inductances, run the sweep with --inductance')
+    return (
+        [record['name'] for record in records],
+        *(np.array([record['inductance'][name] for record in records]) for name in ('L1', 'L2', 'k'))
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write lumped two-port transformer models as Touchstone files')
+    parser.add_argument('--manifest', type=str, default=None, help='Parameter sweep manifest with filament inductances (sweep --inductance)')
+    parser.add_argument('--L1', type=float, nargs='+', default=None, help='Primary inductance(s) in H (default: from --CL, --f and --n)')
+    parser.add_argument('--L2', type=float, nargs='+', default=None, help='Secondary inductance(s) in H (default: from --CL and --f)')
+    parser.add_argument('--k', type=float, nargs='+', default=[DEFAULT_K], help='Coupling coefficient(s)')
+    parser.add_argument('--n', type=float, default=DEFAULT_N, help='Turns ratio of the default inductances')
+    parser.add_argument('--Q1', type=float, default=DEFAULT_Q1, help='Primary quality factor at --f')
+    parser.add_argument('--Q2', type=float, default=DEFAULT_Q2, help='Secondary quality factor at --f')
+    parser.add_argument('--CL', type=float, default=DEFAULT_CL, help='Secondary tuning capacitance in F')
+    parser.add_argument('--resonate', action='store_true', default=False, help='Tune CL per variant to resonate L2 at --f instead of using --CL')
+    parser.add_argument('--RL', type=float, default=DEFAULT_RL, help='Load resistance in ohms, used for the efficiency')
+    parser.add_argument('--f', type=float, default=DEFAULT_F, help='Operating frequency in Hz')
+    parser.add_argument('--f_start', type=float, default=DEFAULT_F_START, help='First frequency point in Hz')
+    parser.add_argument('--f_stop', type=float, default=DEFAULT_F_STOP, help='Last frequency point in Hz')
+    parser.add_argument('--points', type=int, default=DEFAULT_POINTS, help='Number of frequency points')
+    parser.add_argument('--z0', type=float, default=DEFAULT_Z0, help='Port reference impedance in ohms')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Directory for the Touchstone files')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_args(args)
+
+    if args.manifest:
+        names, L1, L2, k = variants_from_manifest(args.manifest)
+    else:
+        derived_L1, derived_L2 = aoki_inductances(args.CL, args.f, args.n)
+        L1, L2, k = np.broadcast_arrays(
+            np.asarray(args.L1 or [float(derived_L1)]), np.asarray(args.L2 or [float(derived_L2)]), np.asarray(args.k))
+        names = [f'transformer.L1_{l1:.4g}_L2_{l2:.4g}_k{kk:.3g}' for l1, l2, kk in zip(L1, L2, k)]
+    CL = 1/((2*np.pi*args.f)**2*L2) if args.resonate else args.CL
+    f = np.linspace(args.f_start, args.f_stop, args.points)
+    z = lumped_z_parameters(f, L1, L2, k, args.Q1, args.Q2, CL, args.f)
+    efficiency = load_efficiency(z, args.RL)
+    at_f = load_efficiency(lumped_z_parameters([args.f], L1, L2, k, args.Q1, args.Q2, CL, args.f), args.RL)[:, 0]
+    paths = write_touchstone(transformer_networks(f, z_to_s(z, args.z0), names, args.z0), args.output_dir)
+    print(f'{"variant":>48} {"eta(f)":>8} {"max eta":>8} {"at (Hz)":>10}')
+    for name, eta, curve in zip(names, at_f, efficiency):
+        print(f'{name:>48} {eta:8.4f} {curve.max():8.4f} {f[np.argmax(curve)]:10.4g}')
+    logger.info('Wrote %d Touchstone files to %s', len(paths), args.output_dir)